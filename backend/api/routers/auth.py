@@ -26,7 +26,11 @@ def get_current_user(
     db: Session = Depends(get_db),
     authorization: Optional[str] = Header(default=None),
 ) -> User:
-    token = _get_bearer_token(authorization)
+    return user_for_token(db, _get_bearer_token(authorization))
+
+
+def user_for_token(db: Session, token: Optional[str]) -> User:
+    """Valida el token de sesión (para endpoints que no pueden usar el Depends, p.ej. streams)."""
     if not token:
         raise HTTPException(status_code=401, detail="Token requerido")
     token_hash = hash_token(token)
@@ -5,6 +5,7 @@ from typing import Optional
 from datetime import datetime, date, timedelta
 
 from core.database import get_db, Empresa, BuzonRun
+from core.events import CHANNEL_BUZON, notify
 from api import schemas
 
 router = APIRouter(
@@ -90,6 +91,8 @@ async def run_automation(req: schemas.AutomationRunRequest, db: Session = Depend
         db.flush()
         runs.append(run)
 
+    if runs:
+        notify(db, CHANNEL_BUZON, {"event": "run", "run_ids": [r.id for r in runs]})
     db.commit()
     return {"ok": len(runs) > 0, "runs": runs, "errors": errors}
 
@@ -108,6 +111,7 @@ def stop_automation(
         running = running.filter(BuzonRun.ruc_empresa == ruc)
     if fecha_desde:
         running = running.filter(BuzonRun.fecha_desde == fecha_desde)
+    running_ids = [r[0] for r in running.with_entities(BuzonRun.id).all()]
     updated = running.update({"stop_requested": True}, synchronize_session=False)
 
     pending = db.query(BuzonRun).filter(BuzonRun.status == "PENDING")
@@ -116,6 +120,8 @@ def stop_automation(
     if fecha_desde:
         pending = pending.filter(BuzonRun.fecha_desde == fecha_desde)
     stopped = pending.update({"status": "STOPPED"}, synchronize_session=False)
+    if running_ids:
+        notify(db, CHANNEL_BUZON, {"event": "stop", "run_ids": running_ids})
     db.commit()
     return {
         "message": "Se ha solicitado detener la automatización.",
@@ -16,6 +16,7 @@ from core.database import (
     CPEEvidencia,
     CPEDetalle,
     BuzonRun,
+    XMLProgressCounter,
 )
 from api import schemas
 from api.routers.auth import get_current_user
@@ -80,6 +81,7 @@ def eliminar_empresa(ruc: str, db: Session = Depends(get_db)):
     db.query(Notificacion).filter(Notificacion.ruc_empresa == ruc).delete(synchronize_session=False)
     db.query(BuzonRun).filter(BuzonRun.ruc_empresa == ruc).delete(synchronize_session=False)
     db.query(EmpresaSire).filter(EmpresaSire.ruc_empresa == ruc).delete(synchronize_session=False)
+    db.query(XMLProgressCounter).filter(XMLProgressCounter.ruc_empresa == ruc).delete(synchronize_session=False)
 
     db.delete(emp)
     db.commit()
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from core.database import User, db_session
+from core.events import CHANNEL_BUZON_PROGRESS, CHANNEL_XML_PROGRESS, EventBroker
+from api import schemas
+from api.routers.auth import _get_bearer_token, get_current_user, user_for_token
+
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+# Un comentario SSE cada N segundos mantiene viva la conexión (proxy_read_timeout de nginx)
+KEEPALIVE_SECONDS = int(os.getenv("EVENTS_SSE_KEEPALIVE_SECONDS", "15"))
+
+_CHANNELS = {"xml": CHANNEL_XML_PROGRESS, "buzon": CHANNEL_BUZON_PROGRESS}
+
+# Ticket de un solo uso para abrir el stream: EventSource no manda headers y el
+# token de sesión por query terminaría en los access logs.
+TICKET_TTL_SECONDS = int(os.getenv("EVENTS_TICKET_TTL_SECONDS", "30"))
+
+# Un solo LISTEN por proceso API, compartido por todos los dashboards abiertos
+BROKER = EventBroker(_CHANNELS.values())
+
+_tickets_lock = threading.Lock()
+_tickets: Dict[str, Tuple[int, float]] = {}  # ticket -> (user_id, vence)
+
+
+def _issue_ticket(user_id: int) -> str:
+    now = time.monotonic()
+    ticket = secrets.token_urlsafe(24)
+    with _tickets_lock:
+        for t in [t for t, (_, exp) in _tickets.items() if exp <= now]:
+            del _tickets[t]
+        _tickets[ticket] = (user_id, now + TICKET_TTL_SECONDS)
+    return ticket
+
+
+def _redeem_ticket(ticket: Optional[str]) -> None:
+    with _tickets_lock:
+        entry = _tickets.pop(ticket, None) if ticket else None
+    if not entry or entry[1] <= time.monotonic():
+        raise HTTPException(status_code=401, detail="Ticket inválido o expirado")
+
+
+def _check_token(token: Optional[str]) -> None:
+    # sesión corta: el stream no debe retener una conexión del pool mientras dure
+    with db_session() as db:
+        user_for_token(db, token)
+
+
+def _sse(event: dict) -> str:
+    return f"event: {event.get('event', 'message')}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+@router.post("/ticket", response_model=schemas.EventStreamTicketResponse)
+def create_ticket(user: User = Depends(get_current_user)):
+    """Ticket de un solo uso (TICKET_TTL_SECONDS) para abrir /events/stream."""
+    return schemas.EventStreamTicketResponse(ok=True, ticket=_issue_ticket(user.id), expires_in=TICKET_TTL_SECONDS)
+
+
+@router.get("/stream")
+async def stream(
+    request: Request,
+    channels: str = "xml,buzon",
+    ruc: Optional[str] = None,
+    periodo: Optional[str] = None,
+    ticket: Optional[str] = None,
+    authorization: Optional[str] = Header(default=None),
+):
+    """
+    Server-Sent Events con el avance de los jobs XML y buzón (eventos run/item/
+    progress/empresa/message). EventSource no manda headers: se abre con un
+    `ticket` de POST /events/ticket (un solo uso); clientes que sí pueden usan Bearer.
+    """
+    bearer = _get_bearer_token(authorization)
+    if bearer:
+        await run_in_threadpool(_check_token, bearer)
+    else:
+        _redeem_ticket(ticket)
+    wanted = {_CHANNELS[c.strip()] for c in channels.split(",") if c.strip() in _CHANNELS}
+    queue = BROKER.subscribe(wanted or set(_CHANNELS.values()))
+
+    async def gen():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if ruc and event.get("ruc") != ruc:
+                    continue
+                if periodo and event.get("periodo") not in (None, periodo):
+                    continue
+                yield _sse(event)
+        finally:
+            BROKER.unsubscribe(queue)
+
+    return StreamingResponse(
+        gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -9,6 +9,7 @@ from datetime import datetime
 
 from core.database import get_db, Notificacion, Empresa
 from rce.propuesta.config import REGISTROS_DIR
+from rce.derived_files import resolve_download
 
 router = APIRouter(
     prefix="/files",
@@ -88,9 +89,14 @@ def download_zip(
 
 
 @router.get("/download")
-def download_file(path: str = Query(..., description="Ruta absoluta dentro de REGISTROS_DIR")):
+def download_file(
+    path: str = Query(..., description="Ruta absoluta dentro de REGISTROS_DIR"),
+    db: Session = Depends(get_db),
+):
     """
     Descarga un archivo arbitrario siempre que esté dentro de REGISTROS_DIR o downloads.
+    Los XLSX derivados (propuesta/reporte) se sirven desde la cache por contenido
+    y se generan recién aquí, al primer pedido.
     """
     if not path:
         raise HTTPException(status_code=400, detail="path es requerido")
@@ -107,10 +113,14 @@ def download_file(path: str = Query(..., description="Ruta absoluta dentro de RE
 
     if not allowed:
         raise HTTPException(status_code=403, detail="Ruta no permitida")
+    filename = os.path.basename(target)
+    if target.lower().endswith(".xlsx"):
+        cached = resolve_download(db, target)
+        if cached:
+            return FileResponse(cached, filename=filename)
     if not os.path.exists(target):
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
     if os.path.isdir(target):
         raise HTTPException(status_code=400, detail="La ruta no es un archivo")
 
-    filename = os.path.basename(target)
     return FileResponse(target, filename=filename)
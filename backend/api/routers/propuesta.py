@@ -5,7 +5,7 @@ from typing import List
 from core.database import get_db, db_session, Empresa, EmpresaSire, RCEPropuestaFile, RCEPropuestaItem
 from api import schemas
 from api.routers.auth import get_current_user
-from rce.propuesta.run import procesar_empresa
+from rce.propuesta.async_pipeline import run_propuesta_concurrente
 
 
 router = APIRouter(
@@ -18,7 +18,6 @@ router = APIRouter(
 @router.post("/run", response_model=schemas.PropuestaRunResponse)
 def run_propuesta(req: schemas.PropuestaRunRequest):
     results = []
-    errors = []
 
     with db_session() as db:
         q = (
@@ -36,12 +35,10 @@ def run_propuesta(req: schemas.PropuestaRunRequest):
         if (req.ruc or req.rucs) and not pairs:
             raise HTTPException(status_code=404, detail="Empresa no encontrada o sin credenciales SIRE activas")
 
-        for emp, cred in pairs:
-            try:
-                res = procesar_empresa(db, emp, cred, req.periodo, req.fec_ini, req.fec_fin)
-                results.append(schemas.PropuestaRunItem(periodo=req.periodo, **res))
-            except Exception as e:
-                errors.append(f"{emp.ruc}: {e}")
+    # todas las empresas en paralelo: el request dura lo que el ticket más lento
+    done, errors = run_propuesta_concurrente(pairs, req.periodo, req.fec_ini, req.fec_fin)
+    for res in done:
+        results.append(schemas.PropuestaRunItem(periodo=req.periodo, **res))
 
     return schemas.PropuestaRunResponse(ok=len(errors) == 0, results=results, errors=errors)
 
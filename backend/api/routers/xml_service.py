@@ -1,14 +1,25 @@
+import json
+import threading
+import time
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
-from typing import List, Optional
+from sqlalchemy import Text, cast, func, and_
+from typing import Dict, List, Optional, Tuple
 
-from core.database import get_db, db_session, Empresa, RCEPropuestaItem, CPEEvidencia, CPEDetalle, RCERun
+from core.database import (
+    get_db, db_session, Empresa, RCEPropuestaItem, CPEEvidencia, CPEDetalle, RCERun,
+    XMLProgressCounter, XML_PROGRESS_ITEMS,
+)
+from core.events import CHANNEL_XML, notify
 from api import schemas
 from api.routers.auth import get_current_user
 from rce.xml_service.job import run_xml_job_for_empresa_periodo, request_stop
-from rce.xml_detail.report import build_reporte_detalle
-from rce.xml_service.repository import fetch_items_pendientes_xml
+from rce.derived_files import reporte_xlsx
+from rce.xml_detail import EXTRACTOR_VERSION, latest_detalle_clause
+from rce.xml_detail import reextract as reextract_job
+from rce.xml_service.repository import fetch_items_pendientes_xml, fetch_progress, progress_from_counters
+from rce.xml_service.config import REPORT_STREAM_BATCH, REPOSITORY_COUNT_TTL_SECONDS
 
 
 router = APIRouter(
@@ -59,6 +70,8 @@ def run_xml(req: schemas.XMLRunRequest):
                 stats["headless"] = req.headless
                 if req.mode:
                     stats["mode"] = req.mode
+                if req.shards is not None:
+                    stats["shards"] = req.shards
                 existing.stats_json = stats
                 if req.resume and existing.status in ["ERROR", "PARTIAL", "STOPPED"]:
                     existing.status = "PENDING"
@@ -71,10 +84,17 @@ def run_xml(req: schemas.XMLRunRequest):
                 periodo=req.periodo,
                 modulo="XML",
                 status="PENDING",
-                stats_json={"limit": req.limit, "headless": req.headless, "mode": req.mode},
+                stats_json={
+                    "limit": req.limit,
+                    "headless": req.headless,
+                    "mode": req.mode,
+                    "shards": req.shards,
+                },
             )
             db.add(run)
             processed.append(ruc)
+        if processed:
+            notify(db, CHANNEL_XML, {"event": "run", "periodo": req.periodo, "rucs": processed})
         db.commit()
 
     return schemas.XMLRunResponse(ok=len(errors) == 0, processed_rucs=processed, errors=errors)
@@ -89,6 +109,52 @@ def stop_xml(req: schemas.XMLStopRequest):
     return schemas.XMLStopResponse(ok=True, message=msg)
 
 
+@router.post("/reextract", response_model=schemas.XMLReextractResponse)
+def start_reextract(req: schemas.XMLReextractRequest):
+    """Re-extrae cpe_detalle desde los XML ya descargados (pool de procesos, en segundo plano)."""
+    version = req.version or EXTRACTOR_VERSION
+    if version not in reextract_job.EXTRACTORS:
+        raise HTTPException(status_code=400, detail=f"extractor_version desconocida: {version}")
+    kwargs = {
+        "version": version,
+        "ruc": req.ruc,
+        "periodo": req.periodo,
+        "force": req.force,
+        "restart": req.restart,
+    }
+    if req.workers:
+        kwargs["workers"] = req.workers
+    started = reextract_job.start_background(**kwargs)
+    return schemas.XMLReextractResponse(
+        ok=started,
+        running=reextract_job.is_running(),
+        message="Re-extracción iniciada" if started else "Ya hay una re-extracción en curso",
+        checkpoint=reextract_job.load_checkpoint(version, req.ruc, req.periodo),
+    )
+
+
+@router.get("/reextract/status", response_model=schemas.XMLReextractResponse)
+def reextract_status(version: Optional[str] = None, ruc: Optional[str] = None, periodo: Optional[str] = None):
+    version = version or EXTRACTOR_VERSION
+    running = reextract_job.is_running()
+    return schemas.XMLReextractResponse(
+        ok=True,
+        running=running,
+        message="En curso" if running else "Sin re-extracción en curso",
+        checkpoint=reextract_job.load_checkpoint(version, ruc, periodo),
+    )
+
+
+@router.post("/reextract/stop", response_model=schemas.XMLReextractResponse)
+def stop_reextract():
+    stopped = reextract_job.stop_background()
+    return schemas.XMLReextractResponse(
+        ok=stopped,
+        running=reextract_job.is_running(),
+        message="Stop solicitado (termina el lote en curso)" if stopped else "Sin re-extracción en curso",
+    )
+
+
 @router.get("/pending", response_model=List[schemas.PropuestaItemResponse])
 def pending_items(
     ruc: str,
@@ -137,14 +203,16 @@ def list_evidencias(
 @router.get("/detalle", response_model=schemas.DetalleResponse)
 def get_detalle(
     item_id: int,
-    extractor_version: str = "v1",
+    extractor_version: Optional[str] = None,
     db: Session = Depends(get_db),
 ):
-    row = (
-        db.query(CPEDetalle)
-        .filter(CPEDetalle.propuesta_item_id == item_id, CPEDetalle.extractor_version == extractor_version)
-        .first()
-    )
+    """Detalle extraído del XML; sin extractor_version devuelve la extracción más reciente."""
+    q = db.query(CPEDetalle).filter(CPEDetalle.propuesta_item_id == item_id)
+    if extractor_version:
+        q = q.filter(CPEDetalle.extractor_version == extractor_version)
+    else:
+        q = q.filter(latest_detalle_clause())
+    row = q.first()
     if not row:
         raise HTTPException(status_code=404, detail="Detalle no encontrado")
     return row
@@ -152,38 +220,8 @@ def get_detalle(
 
 @router.get("/progress", response_model=schemas.XMLProgressResponse)
 def get_progress(ruc: str, periodo: str, db: Session = Depends(get_db)):
-    total_items = (
-        db.query(func.count(RCEPropuestaItem.id))
-        .filter(
-            RCEPropuestaItem.ruc_empresa == ruc,
-            RCEPropuestaItem.periodo == periodo,
-            RCEPropuestaItem.vigente == True,
-        )
-        .scalar()
-    )
-
-    rows = (
-        db.query(CPEEvidencia.status, func.count(CPEEvidencia.id))
-        .join(RCEPropuestaItem, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
-        .filter(
-            RCEPropuestaItem.ruc_empresa == ruc,
-            RCEPropuestaItem.periodo == periodo,
-            RCEPropuestaItem.vigente == True,
-        )
-        .filter(CPEEvidencia.tipo == "XML")
-        .group_by(CPEEvidencia.status)
-        .all()
-    )
-
-    counts = {status: count for status, count in rows}
-    ok = counts.get("OK", 0)
-    error = counts.get("ERROR", 0)
-    not_found = counts.get("NOT_FOUND", 0)
-    auth = counts.get("AUTH", 0)
-    pending = counts.get("PENDING", 0)
-    total_evidencias = sum(counts.values())
-
-    remaining = max(total_items - ok - not_found, 0)
+    # xml_progress_counters lo mantienen los triggers: lectura por PK, sin contar evidencias
+    counts = fetch_progress(db, ruc, periodo)
 
     run = (
         db.query(RCERun)
@@ -192,181 +230,180 @@ def get_progress(ruc: str, periodo: str, db: Session = Depends(get_db)):
         .first()
     )
 
-    current_row = (
-        db.query(CPEEvidencia, RCEPropuestaItem)
-        .join(RCEPropuestaItem, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
-        .filter(
-            RCEPropuestaItem.ruc_empresa == ruc,
-            RCEPropuestaItem.periodo == periodo,
-            RCEPropuestaItem.vigente == True,
-            CPEEvidencia.tipo == "XML",
-        )
-        .order_by(CPEEvidencia.last_attempt_at.desc().nullslast(), CPEEvidencia.id.desc())
-        .first()
-    )
-
     current_item = None
-    if current_row:
-        ev, item = current_row
-        current_item = schemas.XMLProgressCurrentItem(
-            item_id=item.id,
-            tipo_cp=item.tipo_cp,
-            serie=item.serie,
-            numero=item.numero,
-            ruc_emisor=item.ruc_emisor,
-            status=ev.status,
-            error_message=ev.error_message,
-            attempt_count=ev.attempt_count,
-            last_attempt_at=ev.last_attempt_at,
+    if run and run.current_item_id:
+        current_row = (
+            db.query(CPEEvidencia, RCEPropuestaItem)
+            .join(RCEPropuestaItem, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
+            .filter(CPEEvidencia.propuesta_item_id == run.current_item_id, CPEEvidencia.tipo == "XML")
+            .first()
         )
+        if current_row:
+            ev, item = current_row
+            current_item = schemas.XMLProgressCurrentItem(
+                item_id=item.id,
+                tipo_cp=item.tipo_cp,
+                serie=item.serie,
+                numero=item.numero,
+                ruc_emisor=item.ruc_emisor,
+                status=ev.status,
+                error_message=ev.error_message,
+                attempt_count=ev.attempt_count,
+                last_attempt_at=ev.last_attempt_at,
+            )
 
     return schemas.XMLProgressResponse(
         ruc=ruc,
         periodo=periodo,
-        total_items=total_items or 0,
-        total_evidencias=total_evidencias,
-        ok=ok,
-        error=error,
-        not_found=not_found,
-        auth=auth,
-        pending=pending,
-        remaining=remaining,
         run_status=run.status if run else None,
         current_item=current_item,
+        **counts,
     )
 
 
 @router.get("/progress/global", response_model=schemas.XMLProgressGlobalResponse)
 def get_progress_global(periodo: str, db: Session = Depends(get_db)):
-    total_items = (
-        db.query(func.count(RCEPropuestaItem.id))
-        .filter(RCEPropuestaItem.periodo == periodo, RCEPropuestaItem.vigente == True)
-        .scalar()
+    rows = (
+        db.query(XMLProgressCounter.status, func.sum(XMLProgressCounter.n))
+        .filter(XMLProgressCounter.periodo == periodo)
+        .group_by(XMLProgressCounter.status)
+        .all()
     )
+    counts = {status: int(n or 0) for status, n in rows}
     total_empresas = (
-        db.query(func.count(func.distinct(RCEPropuestaItem.ruc_empresa)))
-        .filter(RCEPropuestaItem.periodo == periodo, RCEPropuestaItem.vigente == True)
+        db.query(func.count(XMLProgressCounter.ruc_empresa))
+        .filter(
+            XMLProgressCounter.periodo == periodo,
+            XMLProgressCounter.status == XML_PROGRESS_ITEMS,
+            XMLProgressCounter.n > 0,
+        )
         .scalar()
     )
 
-    rows = (
-        db.query(CPEEvidencia.status, func.count(CPEEvidencia.id))
-        .join(RCEPropuestaItem, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
-        .filter(RCEPropuestaItem.periodo == periodo, RCEPropuestaItem.vigente == True)
-        .filter(CPEEvidencia.tipo == "XML")
-        .group_by(CPEEvidencia.status)
-        .all()
-    )
-
-    counts = {status: count for status, count in rows}
-    ok = counts.get("OK", 0)
-    error = counts.get("ERROR", 0)
-    not_found = counts.get("NOT_FOUND", 0)
-    auth = counts.get("AUTH", 0)
-    pending = counts.get("PENDING", 0)
-    total_evidencias = sum(counts.values())
-    remaining = max((total_items or 0) - ok - not_found, 0)
-
     return schemas.XMLProgressGlobalResponse(
         periodo=periodo,
         total_empresas=total_empresas or 0,
-        total_items=total_items or 0,
-        total_evidencias=total_evidencias,
-        ok=ok,
-        error=error,
-        not_found=not_found,
-        auth=auth,
-        pending=pending,
-        remaining=remaining,
+        **progress_from_counters(counts),
     )
 
 
-@router.get("/report", response_model=schemas.XMLReportResponse)
-def get_report(ruc: str, periodo: str, db: Session = Depends(get_db)):
-    q = (
-        db.query(RCEPropuestaItem, CPEEvidencia, CPEDetalle)
-        .outerjoin(
-            CPEEvidencia,
-            and_(
-                CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id,
-                CPEEvidencia.tipo == "XML",
-            ),
-        )
-        .outerjoin(
+_REPORT_ITEM_COLS = (
+    RCEPropuestaItem.id, RCEPropuestaItem.ruc_empresa, RCEPropuestaItem.periodo, RCEPropuestaItem.tipo_cp,
+    RCEPropuestaItem.serie, RCEPropuestaItem.numero, RCEPropuestaItem.ruc_emisor, RCEPropuestaItem.razon_emisor,
+    RCEPropuestaItem.fecha_emision, RCEPropuestaItem.total_cp, RCEPropuestaItem.moneda,
+    CPEEvidencia.status, CPEEvidencia.storage_path, CPEEvidencia.error_message,
+)
+
+
+def _report_query(db: Session, ruc: str, periodo: str, detalle_col=None):
+    """
+    Items vigentes + evidencia XML (+ detalle si se pide), por id. Solo columnas
+    (sin entidades ORM) para poder recorrerlo con yield_per sin identity map.
+    """
+    cols = list(_REPORT_ITEM_COLS)
+    if detalle_col is not None:
+        cols.append(detalle_col.label("detalle_json"))
+    q = db.query(*cols).outerjoin(
+        CPEEvidencia,
+        and_(
+            CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id,
+            CPEEvidencia.tipo == "XML",
+        ),
+    )
+    if detalle_col is not None:
+        q = q.outerjoin(
             CPEDetalle,
             and_(
                 CPEDetalle.propuesta_item_id == RCEPropuestaItem.id,
-                CPEDetalle.extractor_version == "v1",
+                latest_detalle_clause(),
             ),
         )
-        .filter(
-            RCEPropuestaItem.ruc_empresa == ruc,
-            RCEPropuestaItem.periodo == periodo,
-            RCEPropuestaItem.vigente == True,
-        )
-        .order_by(RCEPropuestaItem.id.asc())
-    )
+    return q.filter(
+        RCEPropuestaItem.ruc_empresa == ruc,
+        RCEPropuestaItem.periodo == periodo,
+        RCEPropuestaItem.vigente == True,
+    ).order_by(RCEPropuestaItem.id.asc())
+
+
+def _report_row(r) -> dict:
+    return {
+        "item_id": r.id,
+        "ruc_empresa": r.ruc_empresa,
+        "periodo": r.periodo,
+        "tipo_cp": r.tipo_cp,
+        "serie": r.serie,
+        "numero": r.numero,
+        "ruc_emisor": r.ruc_emisor,
+        "razon_emisor": r.razon_emisor,
+        "fecha_emision": r.fecha_emision,
+        "total_cp": float(r.total_cp) if r.total_cp is not None else None,
+        "moneda": r.moneda,
+        "status": r.status or "PENDING",
+        "storage_path": r.storage_path,
+        "xml_filename": f"{r.ruc_emisor}_{r.serie}_{r.numero}.xml",
+        "error_message": r.error_message,
+    }
+
+
+def _report_summary_key(status: str) -> str:
+    return {"OK": "ok", "ERROR": "error", "NOT_FOUND": "not_found", "AUTH": "auth"}.get(status, "pending")
 
-    total_items = 0
-    ok = error = not_found = auth = pending = 0
+
+@router.get("/report", response_model=schemas.XMLReportResponse)
+def get_report(ruc: str, periodo: str, include_detalle: bool = True, db: Session = Depends(get_db)):
+    summary = {"total_items": 0, "ok": 0, "error": 0, "not_found": 0, "auth": 0, "pending": 0}
     items = []
 
-    for item, ev, det in q.all():
-        total_items += 1
-        status = ev.status if ev else "PENDING"
-        if status == "OK":
-            ok += 1
-        elif status == "ERROR":
-            error += 1
-        elif status == "NOT_FOUND":
-            not_found += 1
-        elif status == "AUTH":
-            auth += 1
-        else:
-            pending += 1
+    detalle_col = CPEDetalle.detalle_json if include_detalle else None
+    for row in _report_query(db, ruc, periodo, detalle_col).all():
+        data = _report_row(row)
+        summary["total_items"] += 1
+        summary[_report_summary_key(data["status"])] += 1
+        items.append(schemas.XMLReportItemResponse(**data, detalle_json=row.detalle_json if include_detalle else None))
 
-        items.append(
-            schemas.XMLReportItemResponse(
-                item_id=item.id,
-                ruc_empresa=item.ruc_empresa,
-                periodo=item.periodo,
-                tipo_cp=item.tipo_cp,
-                serie=item.serie,
-                numero=item.numero,
-                ruc_emisor=item.ruc_emisor,
-                razon_emisor=item.razon_emisor,
-                fecha_emision=item.fecha_emision,
-                total_cp=float(item.total_cp) if item.total_cp is not None else None,
-                moneda=item.moneda,
-                status=status,
-                storage_path=ev.storage_path if ev else None,
-                xml_filename=f"{item.ruc_emisor}_{item.serie}_{item.numero}.xml",
-                error_message=ev.error_message if ev else None,
-                detalle_json=det.detalle_json if det else None,
-            )
-        )
+    return schemas.XMLReportResponse(ruc=ruc, periodo=periodo, items=items, **summary)
 
-    return schemas.XMLReportResponse(
-        ruc=ruc,
-        periodo=periodo,
-        total_items=total_items,
-        ok=ok,
-        error=error,
-        not_found=not_found,
-        auth=auth,
-        pending=pending,
-        items=items,
-    )
+
+@router.get("/report/stream")
+def stream_report(ruc: str, periodo: str, include_detalle: bool = True):
+    """
+    Igual que /xml/report pero en NDJSON: una línea {"type": "item", ...} por
+    comprobante (cursor del servidor, de a REPORT_STREAM_BATCH filas) y al final
+    {"type": "summary", ...}. El detalle_json se copia tal cual viene de la BD.
+    """
+
+    def gen():
+        summary = {"total_items": 0, "ok": 0, "error": 0, "not_found": 0, "auth": 0, "pending": 0}
+        # sesión propia: el generador corre después de que el endpoint retornó
+        with db_session() as db:
+            detalle_col = cast(CPEDetalle.detalle_json, Text) if include_detalle else None
+            q = _report_query(db, ruc, periodo, detalle_col).execution_options(yield_per=REPORT_STREAM_BATCH)
+            for row in q:
+                data = _report_row(row)
+                summary["total_items"] += 1
+                summary[_report_summary_key(data["status"])] += 1
+                line = json.dumps({"type": "item", **data}, default=str)
+                if include_detalle:
+                    # json guarda el texto tal cual: un salto de línea solo puede ser espacio entre tokens
+                    raw = (row.detalle_json or "null").replace("\n", " ")
+                    line = f'{line[:-1]}, "detalle_json": {raw}}}'
+                yield line + "\n"
+        yield json.dumps({"type": "summary", "ruc": ruc, "periodo": periodo, **summary}) + "\n"
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
 
 
 @router.get("/report/export", response_model=schemas.XMLReportExportResponse)
 def export_report(ruc: str, periodo: str, db: Session = Depends(get_db)):
-    res = build_reporte_detalle(db, ruc=ruc, periodo=periodo)
-    msg = f"Reporte generado con {res['rows']} filas."
+    res = reporte_xlsx(db, ruc=ruc, periodo=periodo)
+    if res["cached"]:
+        msg = f"Reporte sin cambios ({res['rows']} filas), servido desde cache."
+    else:
+        msg = f"Reporte generado con {res['rows']} filas."
     return schemas.XMLReportExportResponse(
         ruc=ruc,
         periodo=periodo,
-        path=res["path"],
+        path=res["logical_path"],
         rows=res["rows"],
         message=msg,
     )
@@ -380,6 +417,41 @@ def list_runs(periodo: str, ruc: Optional[str] = None, db: Session = Depends(get
     return q.order_by(RCERun.started_at.desc()).limit(500).all()
 
 
+# total por búsqueda: (periodo, ruc, status, search) -> (monotonic, total)
+_repo_totals: Dict[Tuple, Tuple[float, int]] = {}
+_repo_totals_lock = threading.Lock()
+_REPO_TOTALS_MAX = 512
+
+
+def _repository_total(db: Session, q, periodo, ruc_empresa, status, search) -> int:
+    if not search:
+        # sin búsqueda el total exacto sale de xml_progress_counters (mismo criterio: vigentes)
+        cq = db.query(func.coalesce(func.sum(XMLProgressCounter.n), 0)).filter(
+            XMLProgressCounter.status == (status or XML_PROGRESS_ITEMS)
+        )
+        if periodo:
+            cq = cq.filter(XMLProgressCounter.periodo == periodo)
+        if ruc_empresa:
+            cq = cq.filter(XMLProgressCounter.ruc_empresa == ruc_empresa)
+        return int(cq.scalar() or 0)
+
+    key = (periodo, ruc_empresa, status, search.lower())
+    now = time.monotonic()
+    with _repo_totals_lock:
+        hit = _repo_totals.get(key)
+        if hit and now - hit[0] < REPOSITORY_COUNT_TTL_SECONDS:
+            return hit[1]
+    total = q.order_by(None).count()
+    with _repo_totals_lock:
+        if len(_repo_totals) >= _REPO_TOTALS_MAX:
+            for k in [k for k, (ts, _) in _repo_totals.items() if now - ts >= REPOSITORY_COUNT_TTL_SECONDS]:
+                del _repo_totals[k]
+            if len(_repo_totals) >= _REPO_TOTALS_MAX:
+                _repo_totals.clear()
+        _repo_totals[key] = (now, total)
+    return total
+
+
 @router.get("/repository", response_model=schemas.XMLRepositoryResponse)
 def repository(
     periodo: Optional[str] = None,
@@ -388,8 +460,14 @@ def repository(
     search: Optional[str] = None,
     page: int = 1,
     page_size: int = 20,
+    cursor: Optional[int] = None,
     db: Session = Depends(get_db),
 ):
+    """
+    Listado paginado (id DESC). Con `cursor` (next_cursor de la página anterior)
+    pagina por keyset y no recorre las filas previas; `page` queda solo informativo.
+    Con búsqueda el total se cachea REPOSITORY_COUNT_TTL_SECONDS.
+    """
     page = max(page, 1)
     page_size = min(max(page_size, 1), 200)
 
@@ -420,6 +498,7 @@ def repository(
             | (RCEPropuestaItem.razon_emisor.ilike(like))
         )
 
+    normalized = None
     if status:
         # Normalizamos "MISSING" a NOT_FOUND si el frontend lo usa.
         normalized = status.upper()
@@ -427,15 +506,18 @@ def repository(
             normalized = "NOT_FOUND"
         q = q.filter(CPEEvidencia.status == normalized)
 
-    total = q.count()
+    total = _repository_total(db, q, periodo, ruc_empresa, normalized, search)
     pages = (total + page_size - 1) // page_size
 
-    rows = (
-        q.order_by(RCEPropuestaItem.id.desc())
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-        .all()
-    )
+    page_q = q.order_by(RCEPropuestaItem.id.desc())
+    if cursor is not None:
+        page_q = page_q.filter(RCEPropuestaItem.id < cursor)
+    else:
+        page_q = page_q.offset((page - 1) * page_size)
+    # una fila de más para saber si hay página siguiente
+    rows = page_q.limit(page_size + 1).all()
+    next_cursor = rows[page_size - 1][0].id if len(rows) > page_size else None
+    rows = rows[:page_size]
 
     items = []
     for item, ev, emp in rows:
@@ -464,6 +546,7 @@ def repository(
         total=total,
         page=page,
         pages=pages,
+        next_cursor=next_cursor,
         items=items,
     )
 
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Dict
 from datetime import datetime, date
 
 class EmpresaBase(BaseModel):
@@ -104,6 +104,7 @@ class XMLRunRequest(BaseModel):
     headless: bool = True
     mode: Optional[str] = None  # "all" (default) | "pending_error"
     resume: bool = True
+    shards: Optional[int] = None  # sesiones SOL en paralelo por empresa (topado en config)
 
 class XMLRunResponse(BaseModel):
     ok: bool
@@ -118,6 +119,25 @@ class XMLStopResponse(BaseModel):
     ok: bool
     message: str
 
+class XMLReextractRequest(BaseModel):
+    version: Optional[str] = None  # default: extractor actual
+    ruc: Optional[str] = None
+    periodo: Optional[str] = None
+    workers: Optional[int] = None
+    force: bool = False
+    restart: bool = False
+
+class XMLReextractResponse(BaseModel):
+    ok: bool
+    running: bool
+    message: str
+    checkpoint: Dict[str, Any] = {}
+
+class EventStreamTicketResponse(BaseModel):
+    ok: bool
+    ticket: str
+    expires_in: int
+
 class XMLProgressCurrentItem(BaseModel):
     item_id: int
     tipo_cp: Optional[str] = None
@@ -226,6 +246,7 @@ class XMLRepositoryResponse(BaseModel):
     total: int
     page: int
     pages: int
+    next_cursor: Optional[int] = None  # id para pedir la página siguiente por keyset
     items: List[XMLRepositoryItemResponse]
 
 class XMLRetryResponse(BaseModel):
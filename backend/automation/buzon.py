@@ -276,6 +276,39 @@ def descargar_constancia_de_mensaje(page, buzon_frame, emp_ruc, idx, target_dir,
 
 import re
 
+def _metadata_from_text(text_content: str, value) -> dict:
+    """Asunto, fecha e id del mensaje a partir del texto de su fila y el value del checkbox."""
+    clean_text = " ".join(text_content.split())
+
+    # 1. Extraer FECHA (dd/mm/yyyy)
+    # Busca patrones como 19/07/2024 o 19/07/24
+    date_match = re.search(r"(\d{2}/\d{2}/\d{2,4})", clean_text)
+    fecha_str = date_match.group(1) if date_match else "HOY"
+
+    # 2. Extraer Título (Texto sin Fecha y sin 'ASUNTO:')
+    # Quitamos "ASUNTO:", "NOTIFICACIÓN DE", etc para tener keywords fuertes
+    titulo_clean = clean_text.replace("ASUNTO:", "").replace(fecha_str, "")
+    # Quitamos caracteres raros
+    titulo_clean = re.sub(r'[^a-zA-Z0-9\sáéíóúÁÉÍÓÚñÑ]', ' ', titulo_clean)
+    titulo_clean = " ".join(titulo_clean.split())
+
+    # Tomamos un chunk significativo (start)
+    # A veces el título empieza con espacio o basura, tomamos los primeros 30 chars alfanuméricos
+    titulo_corto = titulo_clean[:40].strip()
+
+    # 3. Extraer ID del Mensaje (Checkbox Value)
+    msg_id = "0"
+    if value and len(value) > 2 and value.lower() != "on":
+        msg_id = value
+
+    return {
+        "raw_text": clean_text,
+        "asunto": titulo_corto,
+        "fecha": fecha_str,
+        "msg_id": msg_id
+    }
+
+
 def extract_message_metadata(buzon_frame, i: int):
     """
     Extrae Asunto y Fecha específicos usando Regex.
@@ -302,42 +335,46 @@ def extract_message_metadata(buzon_frame, i: int):
                 else: 
                      return None
 
-            clean_text = " ".join(text_content.split())
-            
-            # 1. Extraer FECHA (dd/mm/yyyy)
-            # Busca patrones como 19/07/2024 o 19/07/24
-            date_match = re.search(r"(\d{2}/\d{2}/\d{2,4})", clean_text)
-            fecha_str = date_match.group(1) if date_match else "HOY"
-            
-            # 2. Extraer Título (Texto sin Fecha y sin 'ASUNTO:')
-            # Quitamos "ASUNTO:", "NOTIFICACIÓN DE", etc para tener keywords fuertes
-            titulo_clean = clean_text.replace("ASUNTO:", "").replace(fecha_str, "")
-            # Quitamos caracteres raros
-            titulo_clean = re.sub(r'[^a-zA-Z0-9\sáéíóúÁÉÍÓÚñÑ]', ' ', titulo_clean)
-            titulo_clean = " ".join(titulo_clean.split())
-            
-            # Tomamos un chunk significativo (start)
-            # A veces el título empieza con espacio o basura, tomamos los primeros 30 chars alfanuméricos
-            titulo_corto = titulo_clean[:40].strip()
-
-            # 3. Extraer ID del Mensaje (Checkbox Value)
-            msg_id = "0"
             try:
                 val = cb.get_attribute("value")
-                if val and len(val) > 2 and val.lower() != "on":
-                    msg_id = val
             except:
-                pass
-
-            return {
-                "raw_text": clean_text,
-                "asunto": titulo_corto,
-                "fecha": fecha_str,
-                "msg_id": msg_id
-            }
+                val = None
+            return _metadata_from_text(text_content, val)
     except Exception as e:
         print(f"   ⚠️ Error extrayendo metadata msg {i}: {e}")
     
     return None
 
 
+# Misma estrategia que extract_message_metadata, pero para todos los checkboxes
+# en un solo viaje al navegador: [{text, value}] (text null si no hay fila útil).
+_JS_LISTA_MENSAJES = """
+() => Array.from(document.querySelectorAll("input[type='checkbox']")).map(cb => {
+    let row = cb.closest('tr');
+    if (!row) {
+        row = cb.parentElement;
+        if (row && (row.innerText || '').length < 5 && row.parentElement) row = row.parentElement;
+    }
+    let text = row ? (row.innerText || '') : null;
+    if (text !== null && text.includes('Buzón Notificaciones') && text.length > 500) {
+        const sib = cb.nextElementSibling;
+        text = sib && sib.innerText ? sib.innerText : null;
+    }
+    return {text: text, value: cb.getAttribute('value')};
+})
+"""
+
+
+def extract_messages_bulk(buzon_frame):
+    """
+    Metadata de todos los mensajes visibles (misma forma que extract_message_metadata,
+    None donde no se pudo leer), en el orden de los checkboxes. Un solo evaluate
+    en el frame del buzón; si falla, se cae a la lectura mensaje por mensaje.
+    """
+    try:
+        rows = buzon_frame.evaluate(_JS_LISTA_MENSAJES)
+        return [_metadata_from_text(r["text"], r.get("value")) if r.get("text") is not None else None for r in rows]
+    except Exception as e:
+        print(f"   ⚠️ Lectura en bloque del buzón falló ({e}). Leyendo mensaje por mensaje...")
+    total = buzon_frame.locator("input[type='checkbox']").count()
+    return [extract_message_metadata(buzon_frame, i) for i in range(total)]
@@ -1,17 +1,40 @@
-import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from datetime import datetime, date
+from typing import Dict
 
 from sqlalchemy import and_
 
+from core.browser_pool import BrowserPool
+from core.config import BUZON_CONCURRENCY
 from core.database import SessionLocal, Empresa, BuzonRun
+from core.events import CHANNEL_BUZON, CHANNEL_BUZON_PROGRESS, IDLE_POLL_SECONDS, EventListener, StopFlags, notify
 import main_auto
 
 
 POLL_SECONDS = 3
 RUN_STATUSES = ("PENDING", "ERROR", "PARTIAL", "RUNNING")
 
+# LISTEN en buzon_jobs: despierta el loop ante /automatizacion/run y recibe los stops.
+_listener = EventListener([CHANNEL_BUZON])
+_stop_flags = StopFlags()
+_listener.subscribe(_stop_flags.handler)
+
+# Chromium de larga vida por modo headless: los runs reutilizan los slots
+_pools: Dict[bool, BrowserPool] = {}
+
+
+def _pool_for(headless: bool) -> BrowserPool:
+    if headless not in _pools:
+        _pools[headless] = BrowserPool(BUZON_CONCURRENCY, headless=headless, name=f"buzon-{'h' if headless else 'v'}")
+    return _pools[headless]
+
 
 def _stop_requested(run_id: int) -> bool:
+    if _listener.connected:
+        if _stop_flags.is_set(run_id):
+            return True
+        if not _stop_flags.needs_db_check(run_id):
+            return False
     db = SessionLocal()
     try:
         run = db.query(BuzonRun).filter(BuzonRun.id == run_id).first()
@@ -20,6 +43,17 @@ def _stop_requested(run_id: int) -> bool:
         db.close()
 
 
+def _notify_run(db, run: BuzonRun) -> None:
+    """Cambio de estado del run para /events/stream; sale con el commit de `db`."""
+    notify(db, CHANNEL_BUZON_PROGRESS, {
+        "event": "run",
+        "run_id": run.id,
+        "ruc": run.ruc_empresa,
+        "status": run.status,
+        "stats": run.stats_json,
+    })
+
+
 def _ensure_daily_runs(db, today: date):
     empresas = db.query(Empresa).filter(Empresa.activo == True).all()
     for emp in empresas:
@@ -44,10 +78,17 @@ def _ensure_daily_runs(db, today: date):
     db.commit()
 
 
-def _pick_next_run(db):
+def _pick_next_run(db, in_flight: Dict[int, str]):
+    # Los runs en curso siguen RUNNING/queued: se excluyen por id y por RUC
+    # (dos contextos del mismo RUC se pisarían la sesión guardada).
+    q = db.query(BuzonRun).filter(BuzonRun.status.in_(RUN_STATUSES), BuzonRun.queued == True)
+    if in_flight:
+        q = q.filter(
+            BuzonRun.id.notin_(list(in_flight)),
+            BuzonRun.ruc_empresa.notin_(set(in_flight.values())),
+        )
     return (
-        db.query(BuzonRun)
-        .filter(BuzonRun.status.in_(RUN_STATUSES), BuzonRun.queued == True)
+        q
         .order_by(BuzonRun.id.asc())
         .with_for_update(skip_locked=True)
         .first()
@@ -81,11 +122,75 @@ def _summarize_stats(items):
     return totals
 
 
+def _execute_run(run_id: int, ruc: str, fecha_desde, fecha_hasta, headless: bool, retry_mode: str) -> None:
+    """Corre un run (hilo del dispatcher) sobre el pool compartido y lo cierra."""
+    try:
+        result = main_auto.run_automation_process(
+            retry_mode=retry_mode in ("solo_fallidos", "pendientes"),
+            days_back=90,
+            headless=headless,
+            rucs=[ruc],
+            date_from=fecha_desde,
+            date_to=fecha_hasta,
+            run_id=run_id,
+            stop_checker=lambda: _stop_requested(run_id),
+            pool=_pool_for(headless),
+        )
+        _stop_flags.discard(run_id)
+        stopped = bool(result.get("stopped"))
+        items = result.get("items", [])
+        totals = _summarize_stats(items)
+
+        db = SessionLocal()
+        try:
+            run = db.query(BuzonRun).filter(BuzonRun.id == run_id).first()
+            if not run:
+                return
+            run.stats_json = totals
+            run.finished_at = datetime.now()
+            run.queued = False
+            if stopped:
+                run.status = "STOPPED"
+            elif totals["errors"] > 0:
+                run.status = "PARTIAL"
+            else:
+                run.status = "OK"
+            _notify_run(db, run)
+            db.commit()
+        finally:
+            db.close()
+    except Exception as e:
+        db = SessionLocal()
+        try:
+            run = db.query(BuzonRun).filter(BuzonRun.id == run_id).first()
+            if run:
+                run.status = "ERROR"
+                run.last_error = str(e)
+                run.finished_at = datetime.now()
+                run.queued = False
+                _notify_run(db, run)
+                db.commit()
+        finally:
+            db.close()
+        print(f"🔥 Error en buzon worker: {e}")
+
+
 def run_worker():
-    print("🔧 Buzon Worker iniciado. Esperando jobs...")
+    _listener.start()
+    print(f"🔧 Buzon Worker iniciado (concurrencia={BUZON_CONCURRENCY}). Esperando jobs...")
     last_daily_reset = None
+    # run_id -> ruc de los runs despachados y aún sin cerrar
+    in_flight: Dict[int, str] = {}
+    futures: Dict[Future, int] = {}
+    dispatcher = ThreadPoolExecutor(max_workers=BUZON_CONCURRENCY, thread_name_prefix="buzon-run")
 
     while True:
+        for fut in [f for f in futures if f.done()]:
+            in_flight.pop(futures.pop(fut), None)
+        if len(in_flight) >= BUZON_CONCURRENCY:
+            wait(list(futures), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+            continue
+
         db = SessionLocal()
         try:
             today = datetime.now().date()
@@ -95,77 +200,41 @@ def run_worker():
 
             _recover_orphan_running(db)
 
-            run = _pick_next_run(db)
+            run = _pick_next_run(db, in_flight)
             if not run:
                 db.commit()
-                time.sleep(POLL_SECONDS)
+                if futures:
+                    # Con runs en curso: despertar también cuando termine alguno
+                    wait(list(futures), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                else:
+                    _listener.wait(IDLE_POLL_SECONDS if _listener.connected else POLL_SECONDS)
                 continue
 
             if run.stop_requested:
                 run.status = "STOPPED"
                 run.finished_at = datetime.now()
+                _notify_run(db, run)
                 db.commit()
                 continue
 
             run.status = "RUNNING"
             run.started_at = datetime.now()
             run.stop_requested = False
+            _notify_run(db, run)
             db.commit()
-            run_id = run.id
-            ruc = run.ruc_empresa
-            fecha_desde = run.fecha_desde
-            fecha_hasta = run.fecha_hasta
-            headless = bool(run.headless)
-            retry_mode = run.retry_mode or "todo"
+            args = (
+                run.id,
+                run.ruc_empresa,
+                run.fecha_desde,
+                run.fecha_hasta,
+                bool(run.headless),
+                run.retry_mode or "todo",
+            )
         finally:
             db.close()
 
-        try:
-            result = main_auto.run_automation_process(
-                retry_mode=retry_mode in ("solo_fallidos", "pendientes"),
-                days_back=90,
-                headless=headless,
-                rucs=[ruc],
-                date_from=fecha_desde,
-                date_to=fecha_hasta,
-                run_id=run_id,
-                stop_checker=lambda: _stop_requested(run_id),
-            )
-            stopped = bool(result.get("stopped"))
-            items = result.get("items", [])
-            totals = _summarize_stats(items)
-
-            db = SessionLocal()
-            try:
-                run = db.query(BuzonRun).filter(BuzonRun.id == run_id).first()
-                if not run:
-                    continue
-                run.stats_json = totals
-                run.finished_at = datetime.now()
-                run.queued = False
-                if stopped:
-                    run.status = "STOPPED"
-                elif totals["errors"] > 0:
-                    run.status = "PARTIAL"
-                else:
-                    run.status = "OK"
-                db.commit()
-            finally:
-                db.close()
-        except Exception as e:
-            db = SessionLocal()
-            try:
-                run = db.query(BuzonRun).filter(BuzonRun.id == run_id).first()
-                if run:
-                    run.status = "ERROR"
-                    run.last_error = str(e)
-                    run.finished_at = datetime.now()
-                    run.queued = False
-                    db.commit()
-            finally:
-                db.close()
-            print(f"🔥 Error en buzon worker: {e}")
-            time.sleep(POLL_SECONDS)
+        in_flight[args[0]] = args[1]
+        futures[dispatcher.submit(_execute_run, *args)] = args[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+"""
+Host residente de Chromium para los workers de Playwright.
+
+Mantiene un Chromium vivo con puerto de depuración remota (CDP). El worker XML
+(SolXMLScraper) y el del buzón (BrowserPool) se conectan con
+`connect_over_cdp(BROWSER_HOST_URL)` y abren sus contextos aislados sobre él,
+en vez de lanzar y cerrar Chromium por cada job/empresa.
+
+El host vigila el navegador cada BROWSER_HOST_HEALTH_SECONDS:
+- health check en /json/version; si no responde, se relanza;
+- reciclado tras BROWSER_HOST_MAX_PAGES páginas abiertas o si el RSS del árbol
+  de procesos supera BROWSER_HOST_MAX_RSS_MB. Nunca bajo sesiones vivas: si hay
+  páginas de clientes abiertas (un job XML tiene la suya durante horas), el
+  reciclado queda pendiente y se reintenta en cada vuelta hasta que no quede ninguna.
+
+El puerto CDP no tiene autenticación y da control total sobre sesiones SOL
+logueadas: escucha solo en 127.0.0.1 salvo BROWSER_HOST_BIND explícito.
+Chromium además escribe las descargas en rutas temporales del cliente, así que
+el host corre en el mismo contenedor/máquina que el worker que lo usa. No está
+cableado en docker-compose (cada worker es un contenedor aparte).
+
+Uso:
+    python -m core.browser_host [--port 9222] [--bind 127.0.0.1] [--headed]
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import urlopen
+
+from core.config import (
+    BROWSER_HOST_BIND,
+    BROWSER_HOST_HEADLESS,
+    BROWSER_HOST_HEALTH_SECONDS,
+    BROWSER_HOST_MAX_PAGES,
+    BROWSER_HOST_MAX_RSS_MB,
+    BROWSER_HOST_PORT,
+)
+
+
+def cdp_endpoint(url: str) -> str:
+    """
+    Chromium rechaza peticiones CDP cuyo Host no sea IP o localhost: si la URL
+    trae un nombre (p.ej. el de un servicio docker), se resuelve a IP.
+    """
+    parts = urlsplit(url)
+    host = parts.hostname or "127.0.0.1"
+    if host != "localhost":
+        try:
+            socket.inet_aton(host)
+        except OSError:
+            host = socket.gethostbyname(host)
+    netloc = f"{host}:{parts.port}" if parts.port else host
+    return urlunsplit((parts.scheme or "http", netloc, parts.path, parts.query, parts.fragment))
+
+
+def _get_json(url: str, timeout: float = 2.0):
+    with urlopen(url, timeout=timeout) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def host_version(url: str, timeout: float = 2.0) -> Optional[dict]:
+    """/json/version del host, o None si no responde."""
+    try:
+        return _get_json(f"{cdp_endpoint(url).rstrip('/')}/json/version", timeout=timeout)
+    except Exception:
+        return None
+
+
+def _page_targets(base: str) -> List[dict]:
+    # la pestaña en blanco del arranque no cuenta (no es de ningún cliente)
+    return [
+        t for t in _get_json(f"{base}/json/list")
+        if t.get("type") == "page" and not (t.get("url") or "").startswith(("about:blank", "chrome://newtab"))
+    ]
+
+
+def _rss_mb(root_pid: int) -> float:
+    """RSS de Chromium y sus hijos (renderers, GPU...) leyendo /proc."""
+    children: Dict[int, List[int]] = {}
+    rss_kb: Dict[int, int] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/status", encoding="utf-8") as f:
+                ppid = rss = 0
+                for line in f:
+                    if line.startswith("PPid:"):
+                        ppid = int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss = int(line.split()[1])
+        except (OSError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+        rss_kb[int(name)] = rss
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        total += rss_kb.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total / 1024
+
+
+def _chromium_executable() -> str:
+    from playwright.sync_api import sync_playwright
+
+    pw = sync_playwright().start()
+    try:
+        return pw.chromium.executable_path
+    finally:
+        pw.stop()
+
+
+class BrowserHost:
+    def __init__(
+        self,
+        port: int = BROWSER_HOST_PORT,
+        bind: str = BROWSER_HOST_BIND,
+        headless: bool = BROWSER_HOST_HEADLESS,
+        max_pages: int = BROWSER_HOST_MAX_PAGES,
+        max_rss_mb: int = BROWSER_HOST_MAX_RSS_MB,
+        health_seconds: float = BROWSER_HOST_HEALTH_SECONDS,
+    ):
+        self.port = port
+        self.bind = bind
+        self.headless = headless
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.health_seconds = health_seconds
+        self.base = f"http://127.0.0.1:{port}"
+        self._exe = _chromium_executable()
+        self._proc: Optional[subprocess.Popen] = None
+        self._profile: Optional[str] = None
+        self._seen_pages: Set[str] = set()
+        # motivo del reciclado pendiente (esperando a que los clientes cierren sus páginas)
+        self._recycle_reason: Optional[str] = None
+        self._running = True
+
+    def launch(self) -> None:
+        from core.browser_pool import launch_args
+
+        self._profile = tempfile.mkdtemp(prefix="browser_host_")
+        args = [
+            self._exe,
+            f"--remote-debugging-port={self.port}",
+            f"--remote-debugging-address={self.bind}",
+            f"--user-data-dir={self._profile}",
+            "--no-first-run",
+            "--no-default-browser-check",
+            *launch_args(self.headless),
+        ]
+        if self.headless:
+            args.append("--headless=new")
+        args.append("about:blank")
+        self._proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._seen_pages = set()
+        self._recycle_reason = None
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"Chromium terminó al arrancar (exitcode={self._proc.returncode})")
+            if host_version(self.base, timeout=1.0):
+                print(f"🌐 Browser host listo en {self.bind}:{self.port} (pid={self._proc.pid}, headless={self.headless})")
+                if self.bind not in ("127.0.0.1", "localhost"):
+                    print(f"⚠️ CDP expuesto en {self.bind}: cualquiera que alcance el puerto controla el navegador.")
+                return
+            time.sleep(0.5)
+        raise RuntimeError("Chromium no abrió el puerto CDP a tiempo")
+
+    def close(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        if self._profile:
+            shutil.rmtree(self._profile, ignore_errors=True)
+            self._profile = None
+
+    def recycle(self, reason: str) -> bool:
+        """
+        Relanza Chromium solo si no quedan páginas de clientes. Si las hay (o no
+        se pudo listar), deja el reciclado pendiente para la próxima vuelta.
+        """
+        try:
+            open_pages = len(_page_targets(self.base))
+        except Exception as e:
+            print(f"⚠️ No se pudo listar páginas CDP ({e}). Reciclado pospuesto.")
+            open_pages = None
+        if open_pages != 0:
+            if self._recycle_reason is None and open_pages:
+                print(f"⏳ Reciclado pendiente ({reason}): {open_pages} páginas de clientes abiertas.")
+            self._recycle_reason = reason
+            return False
+        print(f"♻️ Reciclando Chromium: {reason}")
+        self.close()
+        self.launch()
+        return True
+
+    def check(self) -> None:
+        """Una vuelta del watchdog: salud, páginas acumuladas y memoria."""
+        if self._proc is None or self._proc.poll() is not None or not host_version(self.base):
+            print("⚠️ Browser host sin respuesta. Relanzando Chromium…")
+            self.close()
+            self.launch()
+            return
+
+        try:
+            self._seen_pages.update(t["id"] for t in _page_targets(self.base))
+        except Exception as e:
+            print(f"⚠️ No se pudo listar páginas CDP: {e}")
+        if self.max_pages and len(self._seen_pages) >= self.max_pages:
+            self.recycle(f"{len(self._seen_pages)} páginas abiertas desde el último arranque")
+            return
+
+        rss = _rss_mb(self._proc.pid)
+        if self.max_rss_mb and rss >= self.max_rss_mb:
+            self.recycle(f"RSS {rss:.0f} MB >= {self.max_rss_mb} MB")
+        elif self._recycle_reason:
+            self.recycle(self._recycle_reason)
+
+    def stop(self, *_args) -> None:
+        self._running = False
+
+    def serve_forever(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.launch()
+        try:
+            while self._running:
+                time.sleep(self.health_seconds)
+                if self._running:
+                    self.check()
+        finally:
+            self.close()
+            print("🛑 Browser host detenido.")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=BROWSER_HOST_PORT)
+    ap.add_argument("--bind", default=BROWSER_HOST_BIND, help="Interfaz del puerto CDP (default 127.0.0.1)")
+    ap.add_argument("--headed", action="store_true", help="Chromium visible (por defecto headless)")
+    ap.add_argument("--max-pages", type=int, default=BROWSER_HOST_MAX_PAGES)
+    ap.add_argument("--max-rss-mb", type=int, default=BROWSER_HOST_MAX_RSS_MB)
+    args = ap.parse_args()
+    BrowserHost(
+        port=args.port,
+        bind=args.bind,
+        headless=BROWSER_HOST_HEADLESS and not args.headed,
+        max_pages=args.max_pages,
+        max_rss_mb=args.max_rss_mb,
+    ).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Pool de navegadores Chromium de larga vida para los workers de Playwright.
+Con BROWSER_HOST_URL los slots se conectan al host residente (core.browser_host)
+en vez de lanzar Chromium.
+
+La API sync de Playwright no se comparte entre hilos: cada slot del pool es un
+hilo con su propio Playwright + Chromium, que se lanza una vez y se reutiliza
+entre tareas. Cada tarea recibe el browser y abre su propio contexto aislado
+(cookies/storage del RUC), así N empresas corren en paralelo sin relanzar
+Chromium por cada una.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+from playwright.sync_api import Browser, BrowserContext, Playwright, sync_playwright
+
+from core.browser_host import cdp_endpoint, host_version
+from core.config import BROWSER_HOST_URL
+from core.request_filter import apply_profile
+from core.session_store import cached_state
+
+# UA común de Windows: sin esto el headless se anuncia como 'HeadlessChrome'
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+LAUNCH_ARGS = [
+    "--start-maximized",
+    "--disable-features=TranslateUI",
+    "--disable-translate",
+    "--disable-blink-features=AutomationControlled",  # Esconder flag de automatizacion
+]
+
+
+def launch_args(headless: bool) -> List[str]:
+    # sin ventana, --start-maximized solo agranda la superficie a pintar
+    return [a for a in LAUNCH_ARGS if not (headless and a == "--start-maximized")]
+
+
+def new_context(
+    browser: Browser,
+    ruc: Optional[str] = None,
+    block_profile: Optional[str] = None,
+    **kwargs: Any,
+) -> BrowserContext:
+    """
+    Contexto aislado; con `ruc` carga su sesión guardada (core.session_store) si
+    sigue vigente. Aplica el perfil de bloqueo de requests (SOL_BLOCK_PROFILE).
+    """
+    opts = {"viewport": {"width": 1280, "height": 720}, "user_agent": USER_AGENT}
+    state = cached_state(ruc) if ruc else None
+    if state:
+        opts["storage_state"] = state
+    opts.update(kwargs)
+    context = browser.new_context(**opts)
+    apply_profile(context, block_profile)
+    return context
+
+
+def connect_browser(pw: Playwright, headless: bool = True) -> Browser:
+    """
+    Browser para un worker: el host residente por CDP si está configurado y
+    responde; si no, un Chromium propio (como antes del host).
+    """
+    if BROWSER_HOST_URL:
+        if host_version(BROWSER_HOST_URL):
+            return pw.chromium.connect_over_cdp(cdp_endpoint(BROWSER_HOST_URL))
+        print(f"⚠️ Browser host {BROWSER_HOST_URL} no responde. Lanzando Chromium local…")
+    return pw.chromium.launch(headless=headless, args=launch_args(headless))
+
+
+class BrowserPool:
+    """
+    submit(fn, *args) ejecuta fn(browser, *args) en el primer slot libre y
+    devuelve un Future. Los slots arrancan con la primera tarea y relanzan
+    Chromium si se cayó. shutdown() cierra todo.
+    """
+
+    def __init__(self, size: int, headless: bool = True, name: str = "browser"):
+        self.size = max(1, size)
+        self.headless = headless
+        self.name = name
+        self._tasks: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        fut: Future = Future()
+        with self._lock:
+            if not self._threads:
+                for idx in range(self.size):
+                    t = threading.Thread(target=self._slot, args=(idx,), name=f"{self.name}-{idx}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+        self._tasks.put((fn, args, kwargs, fut))
+        return fut
+
+    def _slot(self, idx: int) -> None:
+        pw = None
+        browser: Optional[Browser] = None
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                fn, args, kwargs, fut = task
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                try:
+                    if browser is None or not browser.is_connected():
+                        if pw is None:
+                            pw = sync_playwright().start()
+                        browser = connect_browser(pw, self.headless)
+                        print(f"🌐 [{self.name}-{idx}] Navegador listo (headless={self.headless}, host={BROWSER_HOST_URL or '-'})")
+                    fut.set_result(fn(browser, *args, **kwargs))
+                except BaseException as e:
+                    fut.set_exception(e)
+        finally:
+            try:
+                if browser is not None:
+                    browser.close()
+                if pw is not None:
+                    pw.stop()
+            except Exception as e:
+                print(f"⚠️ [{self.name}-{idx}] Cierre de navegador falló: {e}")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._tasks.put(None)
+        for t in threads:
+            t.join()
+
+    def __enter__(self) -> "BrowserPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
@@ -5,6 +5,34 @@ _BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 SESSION_DIR = os.getenv("SESSION_DIR", os.path.join(_BASE_DIR, "sessions"))
 DEBUG_DIR = os.getenv("DEBUG_DIR", os.path.join(_BASE_DIR, "debug"))
 URL_MENU = "https://e-menu.sunat.gob.pe/cl-ti-itmenu/MenuInternet.htm"
+# sesiones SOL guardadas (storage_state) más viejas que esto no se reutilizan (0 = sin límite)
+SESSION_MAX_AGE_HOURS = float(os.getenv("SESSION_MAX_AGE_HOURS", "12"))
+
+# Empresas del buzón en paralelo (un Chromium por slot del BrowserPool)
+BUZON_CONCURRENCY = max(1, int(os.getenv("BUZON_CONCURRENCY", str(min(4, os.cpu_count() or 1)))))
+
+# Host residente de Chromium (python -m core.browser_host). Con BROWSER_HOST_URL
+# los workers se conectan por CDP en vez de lanzar su propio navegador.
+BROWSER_HOST_URL = os.getenv("BROWSER_HOST_URL", "").strip()
+BROWSER_HOST_PORT = int(os.getenv("BROWSER_HOST_PORT", "9222"))
+# el puerto CDP no tiene autenticación y controla sesiones SOL logueadas:
+# solo loopback salvo que se pida otra interfaz explícitamente
+BROWSER_HOST_BIND = os.getenv("BROWSER_HOST_BIND", "127.0.0.1").strip() or "127.0.0.1"
+BROWSER_HOST_HEADLESS = os.getenv("BROWSER_HOST_HEADLESS", "1") == "1"
+BROWSER_HOST_HEALTH_SECONDS = float(os.getenv("BROWSER_HOST_HEALTH_SECONDS", "10"))
+# reciclado: páginas abiertas desde el arranque o RSS total (0 = sin límite)
+BROWSER_HOST_MAX_PAGES = int(os.getenv("BROWSER_HOST_MAX_PAGES", "200"))
+BROWSER_HOST_MAX_RSS_MB = int(os.getenv("BROWSER_HOST_MAX_RSS_MB", "2048"))
+
+# Intercepción de requests en los contextos SOL (core.request_filter): off | light | strict
+SOL_BLOCK_PROFILE = os.getenv("SOL_BLOCK_PROFILE", "light").strip().lower()
+# hosts (y subdominios) permitidos en strict; separados por coma
+SOL_ALLOWED_HOSTS = [h.strip().lower() for h in os.getenv("SOL_ALLOWED_HOSTS", "sunat.gob.pe").split(",") if h.strip()]
+# hosts bloqueados en light y strict (analítica, tracking)
+SOL_BLOCKED_HOSTS = [h.strip().lower() for h in os.getenv(
+    "SOL_BLOCKED_HOSTS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,facebook.net,facebook.com,hotjar.com,clarity.ms",
+).split(",") if h.strip()]
 
 def init_dirs():
     """Crea los directorios necesarios si no existen."""
@@ -1,6 +1,6 @@
 from sqlalchemy import (
     Column, String, Integer, Boolean, Date, DateTime, Numeric, Text,
-    ForeignKey, UniqueConstraint, Index, JSON, create_engine
+    ForeignKey, UniqueConstraint, Index, JSON, PrimaryKeyConstraint, create_engine, text
 )
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from contextlib import contextmanager
@@ -143,6 +143,13 @@ class RCERun(Base):
 
     stats_json = Column(JSON, nullable=True)  # {"items":29,"xml_ok":20,...}
 
+    # último item volcado por el job XML (lo lee /xml/progress sin recorrer evidencias)
+    current_item_id = Column(Integer, ForeignKey("rce_propuesta_items.id", ondelete="SET NULL"), nullable=True)
+
+    # slot del worker XML que lo ejecuta y su último latido (recuperación de runs huérfanos)
+    worker_id = Column(String(100), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+
     empresa = relationship("Empresa")  # si tienes Empresa en otro módulo
 
     __table_args__ = (
@@ -246,6 +253,7 @@ class RCEPropuestaItem(Base):
     # Relaciones (para no duplicar datos en evidencias/detalle)
     evidencias = relationship("CPEEvidencia", back_populates="propuesta_item", cascade="all, delete-orphan")
     detalle = relationship("CPEDetalle", back_populates="propuesta_item", cascade="all, delete-orphan")
+    resumen = relationship("CPEResumen", back_populates="propuesta_item", cascade="all, delete-orphan", uselist=False)
 
     __table_args__ = (
         UniqueConstraint(
@@ -254,6 +262,9 @@ class RCEPropuestaItem(Base):
         ),
         Index("ix_rce_items_lookup", "ruc_empresa", "periodo", "ruc_emisor", "tipo_cp", "serie", "numero"),
         Index("ix_rce_items_periodo", "ruc_empresa", "periodo"),
+        # keyset de /xml/repository (ORDER BY id DESC por periodo / empresa+periodo)
+        Index("ix_rce_items_periodo_id", "periodo", "id"),
+        Index("ix_rce_items_ruc_periodo_id", "ruc_empresa", "periodo", "id"),
     )
 
 
@@ -324,6 +335,52 @@ class CPEDetalle(Base):
     )
 
 
+class CPEResumen(Base):
+    """
+    Fila de la hoja "Resumen" del reporte (nbase1/nigv1/...), calculada una vez
+    al extraer el XML. Se recalcula solo si cambia el XML (source_sha256).
+    """
+    __tablename__ = "cpe_resumen"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+
+    propuesta_item_id = Column(Integer, ForeignKey("rce_propuesta_items.id", ondelete="CASCADE"), nullable=False)
+
+    resumen_json = Column(JSON, nullable=False)
+    source_sha256 = Column(String(64), nullable=True)
+
+    extracted_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    propuesta_item = relationship("RCEPropuestaItem", back_populates="resumen")
+
+    __table_args__ = (
+        UniqueConstraint("propuesta_item_id", name="uq_cpe_resumen_item"),
+    )
+
+
+class XMLProgressCounter(Base):
+    """
+    Contadores de avance XML por empresa/periodo, mantenidos por triggers sobre
+    rce_propuesta_items y cpe_evidencias (ver _XML_PROGRESS_DDL).
+    status = estado de la evidencia XML (OK/ERROR/...) de items vigentes,
+    o XML_PROGRESS_ITEMS para el total de items vigentes.
+    """
+    __tablename__ = "xml_progress_counters"
+
+    ruc_empresa = Column(String(11), nullable=False)
+    periodo = Column(String(6), nullable=False)
+    status = Column(String(20), nullable=False)
+    n = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("ruc_empresa", "periodo", "status", name="pk_xml_progress_counters"),
+        Index("ix_xml_progress_periodo", "periodo"),
+    )
+
+
+XML_PROGRESS_ITEMS = "_ITEMS"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -347,6 +404,184 @@ class UserSession(Base):
     user = relationship("User")
 # --- FUNCIÓN DE INICIALIZACIÓN ---
 
+# create_all no altera tablas existentes ni crea triggers: esto va aparte y es idempotente.
+_XML_PROGRESS_DDL = [
+    "ALTER TABLE rce_runs ADD COLUMN IF NOT EXISTS current_item_id INTEGER "
+    "REFERENCES rce_propuesta_items(id) ON DELETE SET NULL",
+    """
+    CREATE OR REPLACE FUNCTION xml_progress_bump(p_ruc VARCHAR, p_periodo VARCHAR, p_status VARCHAR, p_delta INTEGER)
+    RETURNS void AS $$
+    BEGIN
+        IF p_delta = 0 OR p_status IS NULL THEN
+            RETURN;
+        END IF;
+        INSERT INTO xml_progress_counters (ruc_empresa, periodo, status, n)
+        VALUES (p_ruc, p_periodo, p_status, p_delta)
+        ON CONFLICT ON CONSTRAINT pk_xml_progress_counters
+        DO UPDATE SET n = xml_progress_counters.n + EXCLUDED.n;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    # evidencia XML: mueve el conteo entre estados (solo items vigentes)
+    """
+    CREATE OR REPLACE FUNCTION xml_progress_evidencia() RETURNS trigger AS $$
+    DECLARE
+        it RECORD;
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            IF OLD.status IS NOT DISTINCT FROM NEW.status
+               AND OLD.tipo IS NOT DISTINCT FROM NEW.tipo
+               AND OLD.propuesta_item_id = NEW.propuesta_item_id THEN
+                RETURN NULL;
+            END IF;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            IF OLD.tipo = 'XML' THEN
+                SELECT ruc_empresa, periodo INTO it FROM rce_propuesta_items
+                WHERE id = OLD.propuesta_item_id AND vigente IS TRUE;
+                IF FOUND THEN
+                    PERFORM xml_progress_bump(it.ruc_empresa, it.periodo, OLD.status, -1);
+                END IF;
+            END IF;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            IF NEW.tipo = 'XML' THEN
+                SELECT ruc_empresa, periodo INTO it FROM rce_propuesta_items
+                WHERE id = NEW.propuesta_item_id AND vigente IS TRUE;
+                IF FOUND THEN
+                    PERFORM xml_progress_bump(it.ruc_empresa, it.periodo, NEW.status, 1);
+                END IF;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    # item: alta/baja de vigencia arrastra su evidencia XML. El DELETE va en BEFORE
+    # porque el CASCADE borra las evidencias cuando el item ya no es visible.
+    f"""
+    CREATE OR REPLACE FUNCTION xml_progress_item() RETURNS trigger AS $$
+    DECLARE
+        delta INTEGER := 0;
+        row_ RECORD;
+        ev_status VARCHAR;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            row_ := NEW;
+            IF NEW.vigente IS TRUE THEN delta := 1; END IF;
+        ELSIF TG_OP = 'DELETE' THEN
+            row_ := OLD;
+            IF OLD.vigente IS TRUE THEN delta := -1; END IF;
+        ELSE
+            row_ := NEW;
+            IF (OLD.vigente IS TRUE) <> (NEW.vigente IS TRUE) THEN
+                delta := CASE WHEN NEW.vigente IS TRUE THEN 1 ELSE -1 END;
+            END IF;
+        END IF;
+        IF delta <> 0 THEN
+            PERFORM xml_progress_bump(row_.ruc_empresa, row_.periodo, '{XML_PROGRESS_ITEMS}', delta);
+            IF TG_OP <> 'INSERT' THEN
+                SELECT status INTO ev_status FROM cpe_evidencias
+                WHERE propuesta_item_id = row_.id AND tipo = 'XML';
+                IF FOUND THEN
+                    PERFORM xml_progress_bump(row_.ruc_empresa, row_.periodo, ev_status, delta);
+                END IF;
+            END IF;
+        END IF;
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "CREATE OR REPLACE TRIGGER trg_xml_progress_evidencia "
+    "AFTER INSERT OR DELETE OR UPDATE OF status, tipo, propuesta_item_id ON cpe_evidencias "
+    "FOR EACH ROW EXECUTE FUNCTION xml_progress_evidencia()",
+    "CREATE OR REPLACE TRIGGER trg_xml_progress_item "
+    "AFTER INSERT OR UPDATE OF vigente ON rce_propuesta_items "
+    "FOR EACH ROW EXECUTE FUNCTION xml_progress_item()",
+    "CREATE OR REPLACE TRIGGER trg_xml_progress_item_del "
+    "BEFORE DELETE ON rce_propuesta_items "
+    "FOR EACH ROW EXECUTE FUNCTION xml_progress_item()",
+]
+
+
+_RUN_HEARTBEAT_DDL = [
+    "ALTER TABLE rce_runs ADD COLUMN IF NOT EXISTS worker_id VARCHAR(100)",
+    "ALTER TABLE rce_runs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ",
+]
+
+
+_REPOSITORY_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_rce_items_periodo_id ON rce_propuesta_items (periodo, id)",
+    "CREATE INDEX IF NOT EXISTS ix_rce_items_ruc_periodo_id ON rce_propuesta_items (ruc_empresa, periodo, id)",
+]
+
+# búsqueda ILIKE '%x%' de /xml/repository (requiere la extensión pg_trgm)
+REPOSITORY_SEARCH_COLUMNS = ("ruc_emisor", "serie", "numero", "razon_emisor")
+_TRGM_DDL = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f"CREATE INDEX IF NOT EXISTS ix_rce_items_trgm_{col} ON rce_propuesta_items USING gin ({col} gin_trgm_ops)"
+    for col in REPOSITORY_SEARCH_COLUMNS
+]
+
+
+def recompute_xml_progress(conn, ruc: str = None, periodo: str = None) -> None:
+    """
+    Reconstruye xml_progress_counters desde las tablas base (backfill/reparación).
+    El LOCK espera a las transacciones que están moviendo contadores y las
+    bloquea hasta el commit, así el recálculo no pierde ni duplica deltas.
+    """
+    params = {k: v for k, v in (("ruc_empresa", ruc), ("periodo", periodo)) if v}
+    scope = " AND ".join(f"{k} = :{k}" for k in params) or "TRUE"
+    cond = " AND ".join(["p.vigente IS TRUE"] + [f"p.{k} = :{k}" for k in params])
+
+    conn.execute(text("LOCK TABLE xml_progress_counters IN EXCLUSIVE MODE"))
+    conn.execute(text(f"DELETE FROM xml_progress_counters WHERE {scope}"), params)
+    conn.execute(
+        text(
+            "INSERT INTO xml_progress_counters (ruc_empresa, periodo, status, n) "
+            f"SELECT p.ruc_empresa, p.periodo, '{XML_PROGRESS_ITEMS}', count(*) "
+            f"FROM rce_propuesta_items p WHERE {cond} GROUP BY p.ruc_empresa, p.periodo "
+            "UNION ALL "
+            "SELECT p.ruc_empresa, p.periodo, e.status, count(*) "
+            "FROM cpe_evidencias e JOIN rce_propuesta_items p ON p.id = e.propuesta_item_id "
+            f"WHERE e.tipo = 'XML' AND {cond} GROUP BY p.ruc_empresa, p.periodo, e.status"
+        ),
+        params,
+    )
+
+
+def _init_xml_progress() -> None:
+    with engine.begin() as conn:
+        for stmt in _XML_PROGRESS_DDL:
+            conn.execute(text(stmt))
+        # primera vez (tabla recién creada con datos previos): backfill
+        vacia = conn.execute(text("SELECT NOT EXISTS (SELECT 1 FROM xml_progress_counters)")).scalar()
+        if vacia and conn.execute(text("SELECT EXISTS (SELECT 1 FROM rce_propuesta_items)")).scalar():
+            recompute_xml_progress(conn)
+            print("🧮 Contadores de progreso XML reconstruidos.")
+
+
+def _init_run_heartbeat() -> None:
+    with engine.begin() as conn:
+        for stmt in _RUN_HEARTBEAT_DDL:
+            conn.execute(text(stmt))
+
+
+def _init_repository_indexes() -> None:
+    with engine.begin() as conn:
+        for stmt in _REPOSITORY_DDL:
+            conn.execute(text(stmt))
+    try:
+        with engine.begin() as conn:
+            for stmt in _TRGM_DDL:
+                conn.execute(text(stmt))
+    except Exception as e:
+        # sin permiso para CREATE EXTENSION la búsqueda sigue funcionando, solo sin índice
+        print(f"⚠️ Índices trigram no creados (pg_trgm): {e}")
+
+
 def init_db():
     """
     Crea las tablas si no existen.
@@ -355,6 +590,9 @@ def init_db():
     print("🔄 Conectando a PostgreSQL y verificando tablas...")
     try:
         Base.metadata.create_all(bind=engine)
+        _init_xml_progress()
+        _init_run_heartbeat()
+        _init_repository_indexes()
         print("✅ Tablas verificadas/creadas exitosamente.")
     except Exception as e:
         print(f"❌ Error al conectar con la base de datos: {e}")
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text
+
+from core.database import engine
+
+# Canales LISTEN/NOTIFY
+CHANNEL_XML = "xml_jobs"
+CHANNEL_BUZON = "buzon_jobs"
+# Progreso (por item/mensaje) para /events/stream. Canales aparte para que los
+# workers, que escuchan los de arriba, no se despierten con cada evento.
+CHANNEL_XML_PROGRESS = "xml_progress"
+CHANNEL_BUZON_PROGRESS = "buzon_progress"
+
+# Con LISTEN activo, el worker solo consulta la BD por respaldo cada N segundos
+IDLE_POLL_SECONDS = int(os.getenv("EVENTS_IDLE_POLL_SECONDS", "30"))
+# Cada cuánto se re-valida el stop contra la BD (por si se perdió una notificación)
+STOP_DB_REFRESH_SECONDS = int(os.getenv("EVENTS_STOP_REFRESH_SECONDS", "30"))
+# Eventos en cola por suscriptor SSE; si el cliente no consume se descartan los más viejos
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("EVENTS_SUBSCRIBER_QUEUE", "256"))
+
+Handler = Callable[[str, Dict], None]
+
+
+def notify(db, channel: str, payload: Dict) -> None:
+    """
+    Encola un NOTIFY dentro de la transacción de `db`.
+    Postgres lo entrega recién al hacer commit (si hay rollback, no se envía).
+    """
+    db.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": json.dumps(payload, default=str)},
+    )
+
+
+def publish(channel: str, payload: Dict) -> None:
+    """
+    NOTIFY inmediato en su propia transacción, para eventos de progreso que no
+    acompañan un commit. Si falla solo se registra: el job no se corta por esto.
+    """
+    try:
+        with engine.begin() as conn:
+            notify(conn, channel, payload)
+    except Exception as e:
+        print(f"⚠️ No se pudo publicar evento ({channel}): {e}")
+
+
+def _connect():
+    args = engine.url.translate_connect_args(username="user")
+    conn = psycopg2.connect(**args)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+class EventListener:
+    """
+    Hilo daemon con una conexión dedicada en LISTEN.
+    Despacha cada notificación a los handlers y despierta a quien esté en wait().
+    Si la conexión se cae, reintenta; mientras tanto `connected` es False y los
+    workers vuelven al polling normal.
+    """
+
+    def __init__(self, channels: Iterable[str], reconnect_seconds: int = 5):
+        self.channels = list(channels)
+        self.reconnect_seconds = reconnect_seconds
+        self.connected = False
+        self._handlers: List[Handler] = []
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, handler: Handler) -> None:
+        self._handlers.append(handler)
+
+    def start(self) -> "EventListener":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self, timeout: float) -> bool:
+        """Bloquea hasta una notificación o timeout. True si llegó algo."""
+        fired = self._wake.wait(timeout)
+        self._wake.clear()
+        return fired
+
+    def _dispatch(self, channel: str, raw: str) -> None:
+        try:
+            payload = json.loads(raw) if raw else {}
+        except ValueError:
+            payload = {"raw": raw}
+        for handler in self._handlers:
+            try:
+                handler(channel, payload)
+            except Exception as e:
+                print(f"⚠️ Handler de evento falló ({channel}): {e}")
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = _connect()
+                with conn.cursor() as cur:
+                    for ch in self.channels:
+                        cur.execute(f'LISTEN "{ch}"')
+                self.connected = True
+                # al (re)conectar, despertamos por si hubo eventos mientras tanto
+                self._wake.set()
+                while True:
+                    ready, _, _ = select.select([conn], [], [], 5)
+                    if not ready:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        self._dispatch(n.channel, n.payload)
+            except Exception as e:
+                print(f"⚠️ LISTEN desconectado ({e}). Reintentando en {self.reconnect_seconds}s…")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(self.reconnect_seconds)
+
+
+class StopFlags:
+    """
+    Cache en proceso de runs con stop solicitado (por run_id).
+    Se alimenta con notificaciones {"event": "stop", "run_ids": [...]}.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._checked_at: Dict[int, float] = {}
+
+    def handler(self, channel: str, payload: Dict) -> None:
+        if payload.get("event") != "stop":
+            return
+        with self._lock:
+            for run_id in payload.get("run_ids") or []:
+                self._ids.add(int(run_id))
+
+    def is_set(self, run_id: int) -> bool:
+        return run_id in self._ids
+
+    def mark(self, run_id: int) -> None:
+        with self._lock:
+            self._ids.add(run_id)
+
+    def discard(self, run_id: int) -> None:
+        with self._lock:
+            self._ids.discard(run_id)
+            self._checked_at.pop(run_id, None)
+
+    def needs_db_check(self, run_id: int) -> bool:
+        """True cada STOP_DB_REFRESH_SECONDS (respaldo ante notificaciones perdidas)."""
+        now = time.time()
+        with self._lock:
+            last = self._checked_at.get(run_id, 0.0)
+            if now - last < STOP_DB_REFRESH_SECONDS:
+                return False
+            self._checked_at[run_id] = now
+            return True
+
+
+def _offer(queue: "asyncio.Queue", event: Dict) -> None:
+    # corre en el loop del suscriptor; cola llena = cliente lento, se pierde el más viejo
+    if queue.full():
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+    queue.put_nowait(event)
+
+
+class EventBroker:
+    """
+    Fan-out en proceso para la API: un solo LISTEN (EventListener) por proceso
+    y N suscriptores SSE, cada uno con su asyncio.Queue. El listener arranca con
+    el primer suscriptor.
+    """
+
+    def __init__(self, channels: Iterable[str], queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.channels = list(channels)
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subs: Dict["asyncio.Queue", tuple] = {}
+        self._listener: Optional[EventListener] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._listener is not None and self._listener.connected
+
+    def subscribe(self, channels: Optional[Set[str]] = None) -> "asyncio.Queue":
+        """Llamar desde el event loop del endpoint."""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subs[queue] = (loop, set(channels or self.channels))
+            if self._listener is None:
+                self._listener = EventListener(self.channels)
+                self._listener.subscribe(self._handler)
+                self._listener.start()
+        return queue
+
+    def unsubscribe(self, queue: "asyncio.Queue") -> None:
+        with self._lock:
+            self._subs.pop(queue, None)
+
+    def _handler(self, channel: str, payload: Dict) -> None:
+        event = dict(payload, channel=channel)
+        with self._lock:
+            targets = [(q, loop) for q, (loop, chans) in self._subs.items() if channel in chans]
+        for queue, loop in targets:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, event)
+            except RuntimeError:
+                # loop cerrado (cliente ya desconectado)
+                self.unsubscribe(queue)
@@ -0,0 +1,153 @@
+"""
+Perfil de intercepción de requests para los contextos de Playwright sobre SOL.
+
+Las apps Angular de consulta y buzón solo necesitan documento, scripts, estilos
+y XHR de SUNAT: imágenes, fuentes, media y analítica se cortan dentro del propio
+Chromium con Network.setBlockedURLs (CDP, por página), sin pasar por Python ni
+desactivar la cache HTTP. Perfiles (SOL_BLOCK_PROFILE):
+- off:    no se bloquea nada.
+- light:  bloquea imágenes/fuentes/media (por extensión) y hosts de analítica (default).
+- strict: además solo deja pasar hosts de SOL_ALLOWED_HOSTS y los tipos de
+          STRICT_ALLOWED_TYPES. Una lista blanca no se expresa con patrones de
+          bloqueo: strict suma un context.route("**/*"), y con route activo
+          cada request pasa por Python y Playwright desactiva la cache HTTP.
+
+Los contadores de requests/bloqueados (por tipo y host) salen de los eventos
+request/requestfailed del contexto y sirven para afinar el perfil; se imprimen
+al cerrar cada sesión de scraping.
+"""
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+from core.config import SOL_ALLOWED_HOSTS, SOL_BLOCK_PROFILE, SOL_BLOCKED_HOSTS
+
+PROFILES = ("off", "light", "strict")
+
+BLOCKED_TYPES = frozenset({"image", "media", "font"})
+STRICT_ALLOWED_TYPES = frozenset({"document", "script", "stylesheet", "xhr", "fetch", "other"})
+
+# setBlockedURLs solo ve la URL: los tipos de BLOCKED_TYPES se cortan por extensión
+BLOCKED_EXTENSIONS = (
+    "png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "bmp",  # image
+    "woff", "woff2", "ttf", "otf", "eot",                      # font
+    "mp4", "webm", "mp3", "ogg", "wav",                        # media
+)
+
+# error de Chromium para requests cortados por setBlockedURLs o route.abort("blockedbyclient")
+_BLOCKED_ERROR = "ERR_BLOCKED_BY_CLIENT"
+
+_lock = threading.Lock()
+_stats: Dict[str, Counter] = {"requests": Counter(), "blocked": Counter()}
+
+
+def _host_in(host: str, suffixes) -> bool:
+    return any(host == s or host.endswith("." + s) for s in suffixes)
+
+
+def should_block(profile: str, resource_type: str, url: str) -> bool:
+    if profile == "off":
+        return False
+    host = (urlsplit(url).hostname or "").lower()
+    if not host:
+        # data:, blob:, about: no salen a la red
+        return False
+    if resource_type in BLOCKED_TYPES or _host_in(host, SOL_BLOCKED_HOSTS):
+        return True
+    if profile == "strict":
+        return resource_type not in STRICT_ALLOWED_TYPES or not _host_in(host, SOL_ALLOWED_HOSTS)
+    return False
+
+
+def blocked_url_patterns() -> List[str]:
+    """Patrones de Network.setBlockedURLs para hosts y extensiones bloqueados (light y strict)."""
+    patterns = []
+    for host in SOL_BLOCKED_HOSTS:
+        patterns += [f"*://{host}/*", f"*://*.{host}/*"]
+    for ext in BLOCKED_EXTENSIONS:
+        patterns += [f"*.{ext}", f"*.{ext}?*"]
+    return patterns
+
+
+def _record(verdict: str, resource_type: str, url: str) -> None:
+    host = urlsplit(url).hostname or "-"
+    with _lock:
+        c = _stats[verdict]
+        c["total"] += 1
+        c[f"type:{resource_type}"] += 1
+        c[f"host:{host}"] += 1
+
+
+def _on_request(request) -> None:
+    _record("requests", request.resource_type, request.url)
+
+
+def _on_request_failed(request) -> None:
+    if _BLOCKED_ERROR in (request.failure or ""):
+        _record("blocked", request.resource_type, request.url)
+
+
+def _block_urls(context, page, patterns: List[str]) -> None:
+    try:
+        cdp = context.new_cdp_session(page)
+        cdp.send("Network.enable")
+        cdp.send("Network.setBlockedURLs", {"urls": patterns})
+    except Exception as e:
+        # página cerrándose o navegador sin CDP: esa página queda sin bloqueo
+        print(f"⚠️ No se pudo aplicar setBlockedURLs: {e}")
+
+
+def apply_profile(context, profile: Optional[str] = None) -> None:
+    """Aplica el perfil a `context` y a cada página que abra (no hace nada con 'off')."""
+    profile = (profile or SOL_BLOCK_PROFILE).lower()
+    if profile not in PROFILES:
+        print(f"⚠️ SOL_BLOCK_PROFILE desconocido: {profile}. Se usa 'off'.")
+        profile = "off"
+    if profile == "off":
+        return
+
+    context.on("request", _on_request)
+    context.on("requestfailed", _on_request_failed)
+
+    patterns = blocked_url_patterns()
+    for page in context.pages:
+        _block_urls(context, page, patterns)
+    context.on("page", lambda page: _block_urls(context, page, patterns))
+
+    if profile != "strict":
+        return
+
+    def _route(route):
+        req = route.request
+        try:
+            if should_block(profile, req.resource_type, req.url):
+                route.abort("blockedbyclient")
+            else:
+                route.continue_()
+        except Exception:
+            # página/contexto cerrándose: el request ya no importa
+            pass
+
+    context.route("**/*", _route)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Copia de los contadores acumulados en este proceso (allowed = requests - blocked)."""
+    with _lock:
+        out = {k: dict(v) for k, v in _stats.items()}
+        out["allowed"] = dict(_stats["requests"] - _stats["blocked"])
+        return out
+
+
+def summary(top: int = 5) -> str:
+    with _lock:
+        allowed, blocked = _stats["requests"] - _stats["blocked"], _stats["blocked"]
+        top_blocked = [
+            f"{k[5:]}={n}" for k, n in blocked.most_common() if k.startswith("host:")
+        ][:top]
+        by_type = [f"{k[5:]}={n}" for k, n in blocked.most_common() if k.startswith("type:")]
+        return (
+            f"allowed={allowed['total']} blocked={blocked['total']} "
+            f"[tipos: {', '.join(by_type) or '-'}] [hosts: {', '.join(top_blocked) or '-'}]"
+        )
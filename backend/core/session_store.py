@@ -0,0 +1,55 @@
+"""
+Sesiones SOL persistidas por RUC (storage_state de Playwright en SESSION_DIR).
+
+Las comparten el robot del buzón (main_auto) y el scraper XML: quien loguea
+guarda el estado y el otro lo reutiliza sin volver a pasar por el login.
+"""
+import os
+import threading
+import time
+from typing import Optional
+
+from core.config import SESSION_DIR, SESSION_MAX_AGE_HOURS
+
+
+def session_path(ruc: str) -> str:
+    return os.path.join(SESSION_DIR, f"{ruc}.json")
+
+
+def cached_state(ruc: str) -> Optional[str]:
+    """Ruta del storage_state del RUC si existe y no venció (SESSION_MAX_AGE_HOURS)."""
+    path = session_path(ruc)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    if SESSION_MAX_AGE_HOURS and age > SESSION_MAX_AGE_HOURS * 3600:
+        return None
+    return path
+
+
+def save_state(context, ruc: str) -> None:
+    """
+    Guarda el storage_state del contexto de forma atómica: varios workers pueden
+    estar leyendo el mismo archivo mientras otro lo refresca.
+    """
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    path = session_path(ruc)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        context.storage_state(path=tmp)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la sesión de {ruc}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def invalidate(ruc: str) -> None:
+    """Descarta la sesión guardada (p.ej. SUNAT la rechazó)."""
+    try:
+        os.remove(session_path(ruc))
+    except OSError:
+        pass
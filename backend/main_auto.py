@@ -4,12 +4,15 @@ import hashlib
 from datetime import datetime, timedelta, date
 from typing import Optional, List, Callable
 from sqlalchemy import or_
-from playwright.sync_api import sync_playwright
 from core.database import SessionLocal, Empresa, Notificacion
-from core.config import SESSION_DIR, DEBUG_DIR, init_dirs
+from core.browser_pool import BrowserPool, new_context
+from core.session_store import save_state
+from core.config import BUZON_CONCURRENCY, DEBUG_DIR, init_dirs
+from core import request_filter
+from core.events import CHANNEL_BUZON_PROGRESS, publish
 from automation.utils import goto_menu, check_session, buscar_y_clickear, get_buzon_frame, print_frames, get_smart_download_path
 from automation.auth import intentar_login_automatico, handle_post_login_popups
-from automation.buzon import seleccionar_mensaje_por_checkbox, descargar_constancia_de_mensaje, extract_message_metadata
+from automation.buzon import seleccionar_mensaje_por_checkbox, descargar_constancia_de_mensaje, extract_messages_bulk
 
 # Debug Reload
 print("🔄 [DEBUG] Módulo main_auto.py recargado/importado. Verificando actualizaciones...")
@@ -20,7 +23,34 @@ STOP_REQUESTED = False
 def request_stop():
     global STOP_REQUESTED
     STOP_REQUESTED = True
-    print("🛑 Solicitud de detención recibida. El robot se detendrá al terminar la empresa actual.")
+    print("🛑 Solicitud de detención recibida. El robot se detendrá al terminar las empresas en curso.")
+
+def _publish(run_id: Optional[int], ruc: str, event: str, **data):
+    """Evento de avance para /events/stream (empresa o mensaje procesado)."""
+    publish(CHANNEL_BUZON_PROGRESS, {"event": event, "run_id": run_id, "ruc": ruc, **data})
+
+def _parse_fecha_mensaje(fecha_str: str) -> datetime:
+    if fecha_str == "HOY":
+        return datetime.now()
+    try:
+        return datetime.strptime(fecha_str, "%d/%m/%Y")
+    except ValueError:
+        # Intentar formato 2 digitos año
+        try:
+            return datetime.strptime(fecha_str, "%d/%m/%y")
+        except ValueError:
+            print(f"   ⚠️ Fecha no parseable: {fecha_str}. Asumiendo 'viejo' para seguridad.")
+            return datetime(2000, 1, 1) # Muy viejo
+
+def _firma_mensaje(ruc: str, metadata: dict) -> str:
+    """codigo_notificacion: RUC + ID_MENSAJE (si existe) + TEXTO."""
+    raw_text = metadata['raw_text']
+    msg_id = metadata.get('msg_id', '0') # ID único del checkbox
+    if msg_id and msg_id != '0':
+        raw_signature = f"{ruc}|{msg_id}|{raw_text}"
+    else:
+        raw_signature = f"{ruc}|{raw_text}"
+    return hashlib.md5(raw_signature.encode()).hexdigest()
 
 def run_automation_process(
     retry_mode: bool = False,
@@ -31,6 +61,8 @@ def run_automation_process(
     date_to: Optional[date] = None,
     stop_checker: Optional[Callable[[], bool]] = None,
     run_id: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    pool: Optional[BrowserPool] = None,
 ):
     """
     Función principal de automatización invocable desde API o CLI.
@@ -41,6 +73,8 @@ def run_automation_process(
         - SOLO SALTA lo que ya se completó HOY EXITOSAMENTE.
     days_back: Días para el filtro de fecha.
     headless: True para ocultar navegador, False para verlo.
+    concurrency: empresas en paralelo (un Chromium por slot; default BUZON_CONCURRENCY).
+    pool: BrowserPool ya levantado (p.ej. el del worker); si viene, se ignoran headless/concurrency.
     """
     # Inicializar directorios
     init_dirs()
@@ -83,350 +117,376 @@ def run_automation_process(
         return {"stopped": False, "items": []}
 
     print(f"🚀 Iniciando procesamiento de {len(empresas)} empresas...\n")
+    rucs_sel = [emp.ruc for emp in empresas]
+    db.close()
 
     run_stats = []
     stop_requested = False
 
-    with sync_playwright() as p:
-        # Lanzar navegador con argumentos anti-bot
-        browser = p.chromium.launch(
-            headless=headless,
-            args=[
-                "--start-maximized", 
-                "--disable-features=TranslateUI", 
-                "--disable-translate",
-                "--disable-blink-features=AutomationControlled" # Esconder flag de automatizacion
-            ]
-        )
-        
-        # UA común de Windows
-        USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-
-        for emp in empresas:
-            # Check Stop
-            if STOP_REQUESTED or (stop_checker and stop_checker()):
+    # Pool propio si no viene uno de afuera (el worker mantiene el suyo vivo entre runs)
+    own_pool = pool is None
+    if own_pool:
+        pool = BrowserPool(min(concurrency or BUZON_CONCURRENCY, len(rucs_sel)), headless=headless, name="buzon")
+    try:
+        futures = [
+            pool.submit(
+                _tarea_empresa, ruc,
+                days_back=days_back,
+                date_from=date_from,
+                date_to=date_to,
+                stop_checker=stop_checker,
+                run_id=run_id,
+            )
+            for ruc in rucs_sel
+        ]
+        for ruc, fut in zip(rucs_sel, futures):
+            try:
+                res = fut.result()
+            except Exception as e:
+                print(f"🔥 Error Crítico en empresa {ruc}: {e}")
+                continue
+            if res["stopped"] and not stop_requested:
                 stop_requested = True
                 print("\n🛑 DETENIENDO AUTOMATIZACIÓN POR SOLICITUD DE USUARIO.")
-                break
+            if res["stats"]:
+                run_stats.append(res["stats"])
+    finally:
+        if own_pool:
+            pool.shutdown()
+    print(f"🚧 Requests SOL: {request_filter.summary()}")
 
-            print(f"\n🤖 PROCESANDO: {emp.razon_social} ({emp.ruc}) [Estado anterior: {emp.last_run_status}]")
-            session_path = os.path.join(SESSION_DIR, f"{emp.ruc}.json")
-            
-            # Inicializar estado de esta corrida
-            emp.last_run_at = datetime.now()
-            emp.last_run_status = 'PROCESANDO' # Temporal
-            db.commit()
+    return {"stopped": stop_requested, "items": run_stats}
 
-            # Crear Contexto (con o sin sesión guardada)
-            # Pasamos user_agent explicitamente para que no diga 'HeadlessChrome'
-            if os.path.exists(session_path):
-                context = browser.new_context(
-                    storage_state=session_path, 
-                    viewport={"width": 1280, "height": 720},
-                    user_agent=USER_AGENT
-                )
-            else:
-                context = browser.new_context(
-                    viewport={"width": 1280, "height": 720},
-                    user_agent=USER_AGENT
-                )
+def procesar_empresa(
+    browser,
+    ruc: str,
+    days_back: int = 90,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    stop_checker: Optional[Callable[[], bool]] = None,
+    run_id: Optional[int] = None,
+) -> dict:
+    """
+    Procesa el buzón de una empresa en un contexto propio dentro de `browser`.
+    Corre como tarea del BrowserPool, así que abre su propia sesión de BD.
+    Devuelve {"stats": {...} | None, "stopped": bool}.
+    """
+    result = {"stats": None, "stopped": False}
+    stop_requested = False
+    db = SessionLocal()
+    try:
+        emp = db.query(Empresa).filter(Empresa.ruc == ruc).first()
+        if not emp:
+            print(f"⚠️ Empresa {ruc} no encontrada.")
+            return result
 
-            page = context.new_page()
+        print(f"\n🤖 PROCESANDO: {emp.razon_social} ({emp.ruc}) [Estado anterior: {emp.last_run_status}]")
+        
+        # Inicializar estado de esta corrida
+        emp.last_run_at = datetime.now()
+        emp.last_run_status = 'PROCESANDO' # Temporal
+        db.commit()
+        _publish(run_id, emp.ruc, "empresa", status=emp.last_run_status)
 
-            try:
-                # 1. Login / Verificación de Sesión
-                if not goto_menu(page):
-                    print("❌ No se pudo cargar el menú inicial.")
-                    emp.last_run_status = 'ERROR'
-                    db.commit()
-                    continue
-                
-                if not check_session(page):
-                    if intentar_login_automatico(page, emp):
-                        # Guardar sesión si el login fue exitoso
-                        context.storage_state(path=session_path)
-                        emp.estado_sesion = 'OK'
-                        db.commit()
-                    else:
-                        print(f"❌ Saltando empresa {emp.ruc} por fallo de login.")
-                        emp.last_run_status = 'ERROR'
-                        db.commit()
-                        continue
+        # Contexto aislado en el browser del slot (con o sin sesión guardada)
+        context = new_context(browser, emp.ruc)
 
-                # 1.5 Asegurar que no hay modales molestando (incluso si ya estabamos logueados)
-                handle_post_login_popups(page)
+        page = context.new_page()
 
-                # 2. Navegar al Buzón
-                print("🔎 Buscando botón de Buzón...")
-                found = False
-                if buscar_y_clickear(page, "Buzón Electrónico"): found = True
-                elif buscar_y_clickear(page, "Buzón de Mensajes"): found = True
-                
-                if not found:
-                    print("❌ No se encontró el botón del buzón.")
-                    emp.last_run_status = 'ERROR'
+        try:
+            # 1. Login / Verificación de Sesión
+            if not goto_menu(page):
+                print("❌ No se pudo cargar el menú inicial.")
+                emp.last_run_status = 'ERROR'
+                db.commit()
+                return result
+            
+            if not check_session(page):
+                if intentar_login_automatico(page, emp):
+                    # Guardar sesión si el login fue exitoso
+                    save_state(context, emp.ruc)
+                    emp.estado_sesion = 'OK'
                     db.commit()
-                    continue
-
-                # 3. Obtener Frame del Buzón
-                print("⏳ Esperando UI del buzón (Buscando iframeApplication)...")
-                buzon = get_buzon_frame(page)
-                
-                if not buzon:
-                    print("❌ No apareció el iframeApplication.")
-                    # page.screenshot(...)
+                else:
+                    print(f"❌ Saltando empresa {emp.ruc} por fallo de login.")
                     emp.last_run_status = 'ERROR'
                     db.commit()
-                    continue
-                
-                print("✅ iframeApplication cargado. Buzón listo.")
+                    return result
+
+            # 1.5 Asegurar que no hay modales molestando (incluso si ya estabamos logueados)
+            handle_post_login_popups(page)
+
+            # 2. Navegar al Buzón
+            print("🔎 Buscando botón de Buzón...")
+            found = False
+            if buscar_y_clickear(page, "Buzón Electrónico"): found = True
+            elif buscar_y_clickear(page, "Buzón de Mensajes"): found = True
+            
+            if not found:
+                print("❌ No se encontró el botón del buzón.")
+                emp.last_run_status = 'ERROR'
+                db.commit()
+                return result
 
+            # 3. Obtener Frame del Buzón
+            print("⏳ Esperando UI del buzón (Buscando iframeApplication)...")
+            buzon = get_buzon_frame(page)
+            
+            if not buzon:
+                print("❌ No apareció el iframeApplication.")
+                # page.screenshot(...)
+                emp.last_run_status = 'ERROR'
+                db.commit()
+                return result
+            
+            print("✅ iframeApplication cargado. Buzón listo.")
+
+            try:
                 try:
-                    try:
-                        buzon.locator("input[type='checkbox']").first.wait_for(state="visible", timeout=10000)
-                    except Exception:
-                        buzon.locator("body").wait_for(state="visible", timeout=5000)
-                    page.wait_for_timeout(1000)
-
-                    period_tag = "sin_periodo"
-                    if date_from and date_to:
-                        period_tag = f"{date_from.strftime('%Y%m%d')}_{date_to.strftime('%Y%m%d')}"
-                    elif date_from:
-                        period_tag = f"{date_from.strftime('%Y%m%d')}_{datetime.now().strftime('%Y%m%d')}"
-                    evidence_dir = os.path.join(os.getcwd(), "downloads", "buzon_evidencias", emp.ruc)
-                    os.makedirs(evidence_dir, exist_ok=True)
-                    evidence_path = os.path.join(evidence_dir, f"buzon_{period_tag}.png")
-                    saved = False
-                    try:
-                        iframe_el = page.locator("iframe[name='iframeApplication']")
-                        if iframe_el.count() > 0:
-                            iframe_el.first.screenshot(path=evidence_path)
-                            saved = True
-                        else:
-                            page.screenshot(path=evidence_path)
-                            saved = True
-                    except Exception:
+                    buzon.locator("input[type='checkbox']").first.wait_for(state="visible", timeout=10000)
+                except Exception:
+                    buzon.locator("body").wait_for(state="visible", timeout=5000)
+                page.wait_for_timeout(1000)
+
+                period_tag = "sin_periodo"
+                if date_from and date_to:
+                    period_tag = f"{date_from.strftime('%Y%m%d')}_{date_to.strftime('%Y%m%d')}"
+                elif date_from:
+                    period_tag = f"{date_from.strftime('%Y%m%d')}_{datetime.now().strftime('%Y%m%d')}"
+                evidence_dir = os.path.join(os.getcwd(), "downloads", "buzon_evidencias", emp.ruc)
+                os.makedirs(evidence_dir, exist_ok=True)
+                evidence_path = os.path.join(evidence_dir, f"buzon_{period_tag}.png")
+                saved = False
+                try:
+                    iframe_el = page.locator("iframe[name='iframeApplication']")
+                    if iframe_el.count() > 0:
+                        iframe_el.first.screenshot(path=evidence_path)
+                        saved = True
+                    else:
                         page.screenshot(path=evidence_path)
                         saved = True
+                except Exception:
+                    page.screenshot(path=evidence_path)
+                    saved = True
 
-                    if saved and run_id and os.path.exists(evidence_path):
-                        from core.database import BuzonRun
-                        db_run = SessionLocal()
-                        try:
-                            run = db_run.query(BuzonRun).filter(BuzonRun.id == run_id).first()
-                            if run:
-                                run.evidencia_path = evidence_path
-                                db_run.commit()
-                        finally:
-                            db_run.close()
-                    if saved:
-                        print(f"📸 Evidencia guardada: {evidence_path}")
-                except Exception as e:
-                    print(f"⚠️ No se pudo guardar evidencia: {e}")
-
-                # 4. Procesar Mensajes (Lógica de bucle)
-                print("⏳ Estabilizando vista del buzón...")
-                page.wait_for_timeout(3000)
-
-                # Detección de mensajes (Checkboxes)
-                mensajes = buzon.locator("input[type='checkbox']").all()
-                print(f"📨 Mensajes visibles (checkboxes): {len(mensajes)}")
-
-                if len(mensajes) == 0:
-                    print("⚠️ No encontré mensajes en la lista.")
-                    emp.last_run_status = 'SIN_NOVEDADES'
-                    db.commit()
-                    run_stats.append({
-                        "ruc": emp.ruc,
-                        "descargas_ok": 0,
-                        "skipped": 0,
-                        "errors": 0,
-                        "analizados": 0,
-                        "sin_novedades": True,
-                    })
+                if saved and run_id and os.path.exists(evidence_path):
+                    from core.database import BuzonRun
+                    db_run = SessionLocal()
+                    try:
+                        run = db_run.query(BuzonRun).filter(BuzonRun.id == run_id).first()
+                        if run:
+                            run.evidencia_path = evidence_path
+                            db_run.commit()
+                    finally:
+                        db_run.close()
+                if saved:
+                    print(f"📸 Evidencia guardada: {evidence_path}")
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar evidencia: {e}")
+
+            # 4. Procesar Mensajes (Lógica de bucle)
+            print("⏳ Estabilizando vista del buzón...")
+            page.wait_for_timeout(3000)
+
+            # Detección de mensajes: metadata de toda la lista en un solo evaluate
+            mensajes = extract_messages_bulk(buzon)
+            print(f"📨 Mensajes visibles (checkboxes): {len(mensajes)}")
+
+            if len(mensajes) == 0:
+                print("⚠️ No encontré mensajes en la lista.")
+                emp.last_run_status = 'SIN_NOVEDADES'
+                db.commit()
+                result["stats"] = {
+                    "ruc": emp.ruc,
+                    "descargas_ok": 0,
+                    "skipped": 0,
+                    "errors": 0,
+                    "analizados": 0,
+                    "sin_novedades": True,
+                }
+            else:
+                # Parametros de Filtro usando el argumento days_back
+                if date_from:
+                    fecha_limite = datetime.combine(date_from, datetime.min.time())
                 else:
-                    # Parametros de Filtro usando el argumento days_back
-                    if date_from:
-                        fecha_limite = datetime.combine(date_from, datetime.min.time())
-                    else:
-                        DIAS_ATRAS = days_back
-                        fecha_limite = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=DIAS_ATRAS)
-                    print(f"📅 Filtro activo: Mensajes posteriores a {fecha_limite.strftime('%d/%m/%Y')}")
-
-                    download_dir = get_smart_download_path(emp.razon_social)
-                    print(f"📂 Guardando PDFs en: {download_dir}")
-
-                    # Aumentamos el rango de escaneo para buscar por fecha
-                    # Escaneamos hasta 50 ultimos mensajes para encontrar los de la fecha
-                    max_scan = min(50, len(mensajes))
-                    
-                    descargas_ok = 0
-                    skipped = 0
-                    errors = 0
-                    last_link_fingerprint = None
-                    mensajes_nuevos_encontrados = False
-                    
-                    print(f"⬇️ Analizando hasta {max_scan} mensajes recientes...")
-
-                    for i in range(max_scan):
-                        if STOP_REQUESTED or (stop_checker and stop_checker()):
-                            stop_requested = True
-                            print("🛑 Detención solicitada. Cortando procesamiento de mensajes.")
-                            break
-                        try:
-                            # 1. Extraer Metadata
-                            metadata = extract_message_metadata(buzon, i)
-                            if not metadata:
-                                print(f"   ⚠️ No pude leer metadata de msg {i+1}. Saltando...")
+                    DIAS_ATRAS = days_back
+                    fecha_limite = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=DIAS_ATRAS)
+                print(f"📅 Filtro activo: Mensajes posteriores a {fecha_limite.strftime('%d/%m/%Y')}")
+
+                download_dir = get_smart_download_path(emp.razon_social)
+                print(f"📂 Guardando PDFs en: {download_dir}")
+
+                # Aumentamos el rango de escaneo para buscar por fecha
+                # Escaneamos hasta 50 ultimos mensajes para encontrar los de la fecha
+                max_scan = min(50, len(mensajes))
+                
+                descargas_ok = 0
+                skipped = 0
+                errors = 0
+                last_link_fingerprint = None
+                mensajes_nuevos_encontrados = False
+                
+                print(f"⬇️ Analizando hasta {max_scan} mensajes recientes...")
+
+                # 1-2. Fecha y firma de todos los mensajes antes de clickear nada
+                candidatos = []
+                for i in range(max_scan):
+                    metadata = mensajes[i]
+                    if not metadata:
+                        print(f"   ⚠️ No pude leer metadata de msg {i+1}. Saltando...")
+                        continue
+
+                    fecha_str = metadata.get('fecha', 'HOY')
+                    fecha_msg = _parse_fecha_mensaje(fecha_str)
+                    if date_to and fecha_msg.date() > date_to:
+                        continue
+
+                    # Comparación
+                    if fecha_msg < fecha_limite:
+                        print(f"   🛑 Mensaje {i+1} es de {fecha_str} (Limit: {fecha_limite.strftime('%d/%m/%Y')}). Deteniendo búsqueda.")
+                        break
+
+                    mensajes_nuevos_encontrados = True
+                    candidatos.append((i, metadata, fecha_str, fecha_msg, _firma_mensaje(emp.ruc, metadata)))
+
+                # 3. Dedupe contra BD en una sola consulta
+                hashes = [c[4] for c in candidatos]
+                existentes = set()
+                if hashes:
+                    existentes = {
+                        h for (h,) in db.query(Notificacion.codigo_notificacion)
+                        .filter(Notificacion.codigo_notificacion.in_(hashes))
+                        .all()
+                    }
+                print(f"🧮 {len(candidatos)} mensajes en rango, {len(existentes)} ya registrados en BD.")
+
+                for i, metadata, fecha_str, fecha_msg, hash_id in candidatos:
+                    if STOP_REQUESTED or (stop_checker and stop_checker()):
+                        stop_requested = result["stopped"] = True
+                        print("🛑 Detención solicitada. Cortando procesamiento de mensajes.")
+                        break
+                    try:
+                        if hash_id in existentes:
+                            print(f"   ⏭️  Saltando mensaje {i+1} (Ya existe en BD: {hash_id[:8]}...)")
+                            skipped += 1
+                            _publish(run_id, emp.ruc, "message", index=i + 1, status="SKIPPED", fecha=fecha_str)
+                            continue
+
+                        # Intentos de click y descarga (Retry Loop)
+                        max_retries = 3
+                        for attempt in range(max_retries):
+                            print(f"   👆 Seleccionando mensaje {i+1} (Intento {attempt+1}/{max_retries})...")
+                            ok_click = seleccionar_mensaje_por_checkbox(buzon, i)
+                            if not ok_click:
+                                print("      ⚠️ Click reportó falso. Reintentando...")
+                                buzon.wait_for_timeout(1000)
                                 continue
-                                
-                            # 2. Verificar Fecha vs Filtro
-                            fecha_str = metadata.get('fecha', 'HOY')
-                            fecha_msg = None
                             
-                            if fecha_str == "HOY":
-                                fecha_msg = datetime.now()
-                            else:
+                            # Descargar
+                            saved_path, current_fingerprint = descargar_constancia_de_mensaje(
+                                page, buzon, emp.ruc, i, download_dir, 
+                                expected_metadata=metadata,
+                                prev_fingerprint=last_link_fingerprint
+                            )
+                            
+                            if saved_path:
+                                # Éxito
+                                descargas_ok += 1
+                                if current_fingerprint:
+                                    last_link_fingerprint = current_fingerprint
+                                    
+                                # Guardar en BD
                                 try:
-                                    fecha_msg = datetime.strptime(fecha_str, "%d/%m/%Y")
-                                except:
-                                    # Intentar formato 2 digitos año
-                                    try:
-                                        fecha_msg = datetime.strptime(fecha_str, "%d/%m/%y")
-                                    except:
-                                        print(f"   ⚠️ Fecha no parseable: {fecha_str}. Asumiendo 'viejo' para seguridad.")
-                                        fecha_msg = datetime(2000, 1, 1) # Muy viejo
-
-                            fecha_msg_date = fecha_msg.date()
-                            if date_to and fecha_msg_date > date_to:
-                                continue
-
-                            # Comparación
-                            if fecha_msg < fecha_limite:
-                                print(f"   🛑 Mensaje {i+1} es de {fecha_str} (Limit: {fecha_limite.strftime('%d/%m/%Y')}). Deteniendo búsqueda.")
-                                break
+                                    notif = Notificacion(
+                                        ruc_empresa=emp.ruc,
+                                        codigo_notificacion=hash_id, 
+                                        asunto=metadata.get('asunto', 'Desconocido') if metadata else "Desconocido",
+                                        fecha_emision=datetime.now(), # Fecha de creación del registro
+                                        fecha_recibido_sunat=fecha_msg, # Fecha real del documento
+                                        fecha_leido=datetime.now(),
+                                        estado_sunat="LEIDO",
+                                        ruta_pdf_local=saved_path,
+                                        procesado=False
+                                    )
+                                    db.add(notif)
+                                    db.commit()
+                                    existentes.add(hash_id)  # mismo mensaje repetido en la lista
+                                    print("   💾 Guardado registro en BD.")
+                                except Exception as e:
+                                    db.rollback()
+                                    print(f"   ⚠️ Error guardando en DB: {e}")
                                 
-                            mensajes_nuevos_encontrados = True
-                            
-                            raw_text = metadata['raw_text']
-                            msg_id = metadata.get('msg_id', '0') # ID único del checkbox
-                            
-                            # Firma robusta: RUC + ID_MENSAJE (Si existe) + TEXTO
-                            if msg_id and msg_id != '0':
-                                raw_signature = f"{emp.ruc}|{msg_id}|{raw_text}"
+                                # Salimos del retry loop
+                                break
                             else:
-                                raw_signature = f"{emp.ruc}|{raw_text}"
-                                
-                            hash_id = hashlib.md5(raw_signature.encode()).hexdigest()
-                            
-                            existe = db.query(Notificacion).filter(Notificacion.codigo_notificacion == hash_id).first()
-                            if existe:
-                                print(f"   ⏭️  Saltando mensaje {i+1} (Ya existe en BD: {hash_id[:8]}...)")
-                                skipped += 1
-                                continue
+                                print(f"   ⚠️ Falló validación/descarga. Reintentando click en 2s...")
+                                page.wait_for_timeout(2000)
 
-                            # Intentos de click y descarga (Retry Loop)
-                            max_retries = 3
-                            for attempt in range(max_retries):
-                                print(f"   👆 Seleccionando mensaje {i+1} (Intento {attempt+1}/{max_retries})...")
-                                ok_click = seleccionar_mensaje_por_checkbox(buzon, i)
-                                if not ok_click:
-                                    print("      ⚠️ Click reportó falso. Reintentando...")
-                                    buzon.wait_for_timeout(1000)
-                                    continue
-                                
-                                # Descargar
-                                saved_path, current_fingerprint = descargar_constancia_de_mensaje(
-                                    page, buzon, emp.ruc, i, download_dir, 
-                                    expected_metadata=metadata,
-                                    prev_fingerprint=last_link_fingerprint
-                                )
-                                
-                                if saved_path:
-                                    # Éxito
-                                    descargas_ok += 1
-                                    if current_fingerprint:
-                                        last_link_fingerprint = current_fingerprint
-                                        
-                                    # Guardar en BD
-                                    try:
-                                        notif = Notificacion(
-                                            ruc_empresa=emp.ruc,
-                                            codigo_notificacion=hash_id, 
-                                            asunto=metadata.get('asunto', 'Desconocido') if metadata else "Desconocido",
-                                            fecha_emision=datetime.now(), # Fecha de creación del registro
-                                            fecha_recibido_sunat=fecha_msg, # Fecha real del documento
-                                            fecha_leido=datetime.now(),
-                                            estado_sunat="LEIDO",
-                                            ruta_pdf_local=saved_path,
-                                            procesado=False
-                                        )
-                                        db.add(notif)
-                                        db.commit()
-                                        print("   💾 Guardado registro en BD.")
-                                    except Exception as e:
-                                        db.rollback()
-                                        print(f"   ⚠️ Error guardando en DB: {e}")
-                                    
-                                    # Salimos del retry loop
-                                    break
-                                else:
-                                    print(f"   ⚠️ Falló validación/descarga. Reintentando click en 2s...")
-                                    page.wait_for_timeout(2000)
-
-                            if not saved_path:
-                                print(f"   ❌ No se pudo descargar mensaje {i+1} tras {max_retries} intentos.")
-                                errors += 1
-
-                            page.wait_for_timeout(800)
-                        except Exception as e:
-                            print(f"   ⚠️ Error procesando mensaje {i+1}: {e}")
+                        if not saved_path:
+                            print(f"   ❌ No se pudo descargar mensaje {i+1} tras {max_retries} intentos.")
                             errors += 1
-
-                    print(f"🏁 Resultado: {descargas_ok}/{max_scan} items analizados.")
-                    
-                    # Actualizar Estado Final
-                    if stop_requested:
-                        emp.last_run_status = 'INCOMPLETO'
-                    elif descargas_ok > 0:
-                        emp.last_run_status = 'COMPLETADO'
-                    else:
-                        # Si no descargamos nada, pudo ser porque todos ya existían (skip) o porque falló todo.
-                        # Si max_descargas > 0 y descargas_ok == 0, verificar si hubo skips?
-                        # Simplificación: Si no hubo errores fatales y llegamos aquí, marcamos SIN_NOVEDADES
-                        # si es que realmente no había nada nuevo.
-                        # Para ser más precisos: Si hubieron skips, técnicamente "ya está al día" -> COMPLETADO?
-                        # O 'SIN_NOVEDADES' (no baje nada nuevo).
-                        emp.last_run_status = 'SIN_NOVEDADES'
-                    
-                    db.commit()
-                    run_stats.append({
-                        "ruc": emp.ruc,
-                        "descargas_ok": descargas_ok,
-                        "skipped": skipped,
-                        "errors": errors,
-                        "analizados": max_scan,
-                        "sin_novedades": descargas_ok == 0 and not stop_requested,
-                    })
-
-            except Exception as e:
-                print(f"🔥 Error Crítico en empresa {emp.ruc}: {e}")
-                emp.last_run_status = 'ERROR'
-                emp.last_run_error = str(e) # Guardar log de error
+                        _publish(
+                            run_id, emp.ruc, "message",
+                            index=i + 1,
+                            status="OK" if saved_path else "ERROR",
+                            fecha=fecha_str,
+                            asunto=(metadata.get('asunto') or "")[:200],
+                        )
+
+                        page.wait_for_timeout(800)
+                    except Exception as e:
+                        print(f"   ⚠️ Error procesando mensaje {i+1}: {e}")
+                        errors += 1
+
+                print(f"🏁 Resultado: {descargas_ok}/{max_scan} items analizados.")
+                
+                # Actualizar Estado Final
+                if stop_requested:
+                    emp.last_run_status = 'INCOMPLETO'
+                elif descargas_ok > 0:
+                    emp.last_run_status = 'COMPLETADO'
+                else:
+                    # Si no descargamos nada, pudo ser porque todos ya existían (skip) o porque falló todo.
+                    # Si max_descargas > 0 y descargas_ok == 0, verificar si hubo skips?
+                    # Simplificación: Si no hubo errores fatales y llegamos aquí, marcamos SIN_NOVEDADES
+                    # si es que realmente no había nada nuevo.
+                    # Para ser más precisos: Si hubieron skips, técnicamente "ya está al día" -> COMPLETADO?
+                    # O 'SIN_NOVEDADES' (no baje nada nuevo).
+                    emp.last_run_status = 'SIN_NOVEDADES'
+                
                 db.commit()
-                try:
-                    page.screenshot(path=os.path.join(DEBUG_DIR, f"error_{emp.ruc}.png"))
-                except:
-                    pass
-
-            finally:
-                context.close()
-                time.sleep(1)
+                result["stats"] = {
+                    "ruc": emp.ruc,
+                    "descargas_ok": descargas_ok,
+                    "skipped": skipped,
+                    "errors": errors,
+                    "analizados": max_scan,
+                    "sin_novedades": descargas_ok == 0 and not stop_requested,
+                }
+
+        except Exception as e:
+            print(f"🔥 Error Crítico en empresa {emp.ruc}: {e}")
+            emp.last_run_status = 'ERROR'
+            emp.last_run_error = str(e) # Guardar log de error
+            db.commit()
+            try:
+                page.screenshot(path=os.path.join(DEBUG_DIR, f"error_{emp.ruc}.png"))
+            except:
+                pass
+
+        finally:
+            _publish(run_id, emp.ruc, "empresa", status=emp.last_run_status)
+            context.close()
+            time.sleep(1)
+    finally:
+        db.close()
+    return result
 
-        browser.close()
-    
-    db.close()
-    return {"stopped": stop_requested, "items": run_stats}
+def _tarea_empresa(browser, ruc: str, stop_checker: Optional[Callable[[], bool]] = None, **kwargs) -> dict:
+    # Las empresas que siguen en cola del pool no arrancan si ya se pidió detener
+    if STOP_REQUESTED or (stop_checker and stop_checker()):
+        return {"stats": None, "stopped": True}
+    return procesar_empresa(browser, ruc, stop_checker=stop_checker, **kwargs)
 
 if __name__ == "__main__":
     run_automation_process(retry_mode=False, days_back=3000)
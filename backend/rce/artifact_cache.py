@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+from rce.propuesta.config import REGISTROS_DIR
+
+CACHE_DIR = os.getenv("SIRE_ARTIFACT_CACHE_DIR", os.path.join(REGISTROS_DIR, ".cache"))
+CACHE_MAX_BYTES = int(os.getenv("SIRE_ARTIFACT_CACHE_MB", "2048")) * 1024 * 1024
+
+
+def content_key(kind: str, *parts: Any) -> str:
+    """Clave estable a partir del tipo de artefacto y de los hashes/valores de sus entradas."""
+    h = hashlib.sha256(kind.encode())
+    for p in parts:
+        h.update(b"\0")
+        h.update(str(p).encode())
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Cache de archivos derivados (XLSX) direccionada por contenido.
+
+    La clave sale del hash de las entradas (p.ej. RCEPropuestaFile.sha256), así que
+    si las entradas no cambian se sirve el archivo ya construido. Cada artefacto
+    tiene un sidecar .json con metadatos. Al superar `max_bytes` se borran los
+    menos usados (LRU por mtime, que se refresca en cada hit).
+    """
+
+    def __init__(self, root: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path_for(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}{ext}")
+
+    def meta(self, key: str, ext: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path_for(key, ext) + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, key: str, ext: str) -> Optional[str]:
+        path = self.path_for(key, ext)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)  # LRU
+        except OSError:
+            pass
+        return path
+
+    def get_or_build(
+        self,
+        key: str,
+        ext: str,
+        builder: Callable[[str], Optional[Dict[str, Any]]],
+        meta: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        Devuelve el artefacto cacheado o lo construye con builder(tmp_path).
+        El builder puede devolver metadatos extra (p.ej. filas) que van al sidecar.
+        Escritura atómica: dos builds concurrentes de la misma clave no se pisan.
+        """
+        hit = self.get(key, ext)
+        if hit:
+            return hit
+
+        path = self.path_for(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # temporal oculto con la misma extensión (pandas/openpyxl validan la extensión)
+        tmp = os.path.join(os.path.dirname(path), f".{key}.{os.getpid()}.{threading.get_ident()}{ext}")
+        t0 = time.time()
+        try:
+            extra = builder(tmp) or {}
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        info = dict(meta or {})
+        info.update(extra)
+        info.update({
+            "key": key,
+            "bytes": os.path.getsize(path),
+            "build_seconds": round(time.time() - t0, 3),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        })
+        with open(path + ".json", "w", encoding="utf-8") as f:
+            json.dump(info, f, ensure_ascii=False, default=str)
+
+        self.evict()
+        return path
+
+    def evict(self) -> int:
+        """Borra artefactos LRU hasta quedar bajo max_bytes. Devuelve cuántos borró."""
+        with self._lock:
+            entries = []
+            total = 0
+            for dirpath, _, files in os.walk(self.root):
+                for name in files:
+                    if name.endswith(".json") or name.startswith("."):
+                        continue
+                    p = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, p))
+                    total += st.st_size
+            if total <= self.max_bytes:
+                return 0
+
+            removed = 0
+            for _, size, p in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for victim in (p, p + ".json"):
+                    try:
+                        os.remove(victim)
+                    except OSError:
+                        pass
+                total -= size
+                removed += 1
+            return removed
+
+
+CACHE = ArtifactCache()
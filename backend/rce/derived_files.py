@@ -0,0 +1,118 @@
+import os
+import re
+from typing import Any, Dict, Optional
+
+from sqlalchemy import and_
+from sqlalchemy.orm import Session
+
+from core.database import Empresa, RCEPropuestaFile, RCEPropuestaItem, CPEDetalle, CPEEvidencia
+from rce.artifact_cache import CACHE, content_key
+from rce.propuesta.config import REGISTROS_DIR, XLSX_MODE
+from rce.propuesta.file_ops import csv_to_xlsx
+from rce.xml_detail.extractor import latest_detalle_clause
+from rce.xml_detail.report import build_reporte_detalle, report_path
+
+# Subir al cambiar columnas/formato de los XLSX: invalida lo cacheado
+PROPUESTA_XLSX_VERSION = "2"  # 2: campos multilínea entre comillas
+REPORTE_XLSX_VERSION = "1"
+
+# Rutas lógicas (las que devuelve la API) -> artefacto derivado en la cache
+_PROPUESTA_RE = re.compile(r"^periodos/(\d{6})/(\d{11})/propuesta_\1\.xlsx$")
+_REPORTE_RE = re.compile(r"^periodos/(\d{6})/(\d{11})/reporte_\1/reporte_\1\.xlsx$")
+
+
+def propuesta_xlsx(db: Session, ruc: str, periodo: str) -> Optional[str]:
+    """
+    XLSX de la propuesta desde la cache; la clave es el sha256 del ZIP SUNAT
+    (RCEPropuestaFile.sha256), así que solo se reconstruye si llegó otra propuesta.
+    """
+    if XLSX_MODE == "off":
+        return None
+    row = (
+        db.query(RCEPropuestaFile)
+        .filter(RCEPropuestaFile.ruc_empresa == ruc, RCEPropuestaFile.periodo == periodo)
+        .first()
+    )
+    if not row or not row.sha256:
+        return None
+    csv_path = os.path.join(row.storage_path, f"propuesta_{periodo}.csv")
+    if not os.path.exists(csv_path):
+        return None
+
+    key = content_key("propuesta_xlsx", PROPUESTA_XLSX_VERSION, row.sha256)
+    return CACHE.get_or_build(
+        key,
+        ".xlsx",
+        lambda tmp: {"rows": csv_to_xlsx(csv_path, tmp)},
+        meta={"kind": "propuesta_xlsx", "ruc": ruc, "periodo": periodo, "source_sha256": row.sha256},
+    )
+
+
+def reporte_key(db: Session, ruc: str, periodo: str) -> str:
+    """
+    Clave del reporte: el conjunto de (item, source_sha256, extracción) que entra
+    al Excel, más el hash de la propuesta (datos del item) y la razón social.
+    """
+    q = (
+        db.query(
+            RCEPropuestaItem.id,
+            CPEDetalle.source_sha256,
+            CPEDetalle.extractor_version,
+            CPEDetalle.extracted_at,
+            CPEEvidencia.sha256,
+        )
+        .join(CPEDetalle, and_(CPEDetalle.propuesta_item_id == RCEPropuestaItem.id, latest_detalle_clause()))
+        .outerjoin(CPEEvidencia, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
+        .filter(RCEPropuestaItem.ruc_empresa == ruc, RCEPropuestaItem.periodo == periodo)
+        .filter(CPEEvidencia.tipo == "XML")
+        .order_by(RCEPropuestaItem.id.asc())
+    )
+    parts = [f"{i}:{src}:{ver}:{ts.isoformat() if ts else ''}:{ev}" for i, src, ver, ts, ev in q.all()]
+
+    prop_sha = (
+        db.query(RCEPropuestaFile.sha256)
+        .filter(RCEPropuestaFile.ruc_empresa == ruc, RCEPropuestaFile.periodo == periodo)
+        .scalar()
+    )
+    razon = db.query(Empresa.razon_social).filter(Empresa.ruc == ruc).scalar()
+    return content_key("reporte_xlsx", REPORTE_XLSX_VERSION, ruc, periodo, prop_sha, razon, *parts)
+
+
+def reporte_xlsx(db: Session, ruc: str, periodo: str) -> Dict[str, Any]:
+    """
+    Reporte consolidado (Detalle/Resumen) desde la cache. Si los XML/detalles no
+    cambiaron desde el último build se devuelve el mismo archivo sin regenerarlo.
+    """
+    key = reporte_key(db, ruc, periodo)
+    cached = CACHE.get(key, ".xlsx") is not None
+    path = CACHE.get_or_build(
+        key,
+        ".xlsx",
+        lambda tmp: {"rows": build_reporte_detalle(db, ruc, periodo, path=tmp)["rows"]},
+        meta={"kind": "reporte_xlsx", "ruc": ruc, "periodo": periodo},
+    )
+    meta = CACHE.meta(key, ".xlsx") or {}
+    return {"path": path, "logical_path": report_path(ruc, periodo), "rows": int(meta.get("rows") or 0), "cached": cached}
+
+
+def resolve_download(db: Session, target: str) -> Optional[str]:
+    """
+    Si `target` es la ruta lógica de un XLSX derivado (propuesta o reporte),
+    devuelve el archivo en cache (construyéndolo si hace falta). None si no aplica.
+    """
+    base = os.path.abspath(REGISTROS_DIR)
+    if not target.startswith(base + os.sep):
+        return None
+    rel = os.path.relpath(target, base).replace(os.sep, "/")
+
+    m = _PROPUESTA_RE.match(rel)
+    if m:
+        periodo, ruc = m.groups()
+        return propuesta_xlsx(db, ruc, periodo)
+
+    m = _REPORTE_RE.match(rel)
+    if m:
+        periodo, ruc = m.groups()
+        return reporte_xlsx(db, ruc, periodo)["path"]
+
+    return None
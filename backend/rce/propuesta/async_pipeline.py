@@ -0,0 +1,122 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.database import db_session
+from .config import PIPELINE_CONCURRENCY, POLL_SECONDS, POLL_TIMEOUT_SECONDS
+from .http_session import METRICS
+from .run import obtener_token, solicitar_ticket, descargar_y_registrar
+from .sire_client import SireApiError, consultar_ticket_terminado, siguiente_espera
+
+
+def _empresa_data(emp, cred) -> Dict[str, Any]:
+    """Copia plana de Empresa/EmpresaSire: los objetos ORM no deben cruzar hilos."""
+    return {
+        "ruc": emp.ruc,
+        "razon_social": emp.razon_social,
+        "usuario_sol": emp.usuario_sol,
+        "clave_sol": emp.clave_sol,
+        "client_id": cred.client_id,
+        "client_secret": cred.client_secret,
+    }
+
+
+def _descargar_en_sesion(emp: Dict[str, Any], token: str, periodo: str, fec_ini: str, fec_fin: str, ticket: str, reg: dict):
+    # sesión DB propia por empresa (corre en un hilo del executor)
+    with db_session() as db:
+        return descargar_y_registrar(db, emp["ruc"], token, periodo, fec_ini, fec_fin, ticket, reg)
+
+
+class PropuestaEngine:
+    """
+    Motor asyncio de la propuesta SIRE para varias empresas a la vez.
+
+    Cada empresa es una corrutina: token → ticket → polling → descarga.
+    Los tickets se piden de entrada para todas, el polling de todos los
+    tickets pendientes avanza en paralelo (await asyncio.sleep, sin ocupar
+    hilos) y cada empresa descarga/extrae apenas su ticket termina.
+    Las llamadas del cliente SIRE (bloqueantes) corren en un executor de
+    `concurrency` hilos, que acota las llamadas HTTP/DB simultáneas.
+    """
+
+    def __init__(self, periodo: str, fec_ini: str, fec_fin: str, concurrency: int = PIPELINE_CONCURRENCY):
+        self.periodo = periodo
+        self.fec_ini = fec_ini
+        self.fec_fin = fec_fin
+        self.concurrency = max(1, concurrency)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _esperar_ticket(self, token: str, ticket: str) -> dict:
+        t0 = time.time()
+        delay = POLL_SECONDS
+        while True:
+            reg = await self._call(consultar_ticket_terminado, token, self.periodo, ticket)
+            if reg:
+                return reg
+            if time.time() - t0 > POLL_TIMEOUT_SECONDS:
+                raise SireApiError(f"Timeout esperando ticket {ticket} periodo {self.periodo}")
+            await asyncio.sleep(delay)
+            delay = siguiente_espera(delay)
+
+    async def _procesar(self, emp: Dict[str, Any]) -> Dict[str, Any]:
+        ruc = emp["ruc"]
+        token = await self._call(
+            obtener_token, ruc, emp["usuario_sol"], emp["clave_sol"], emp["client_id"], emp["client_secret"]
+        )
+        ticket = await self._call(solicitar_ticket, ruc, token, self.periodo, self.fec_ini, self.fec_fin)
+        print(f"🎫 {ruc} ticket={ticket}")
+        reg = await self._esperar_ticket(token, ticket)
+        res = await self._call(
+            _descargar_en_sesion, emp, token, self.periodo, self.fec_ini, self.fec_fin, ticket, reg
+        )
+        print(f"✅ OK {ruc}: {res['xlsx']}")
+        return res
+
+    async def run(self, empresas: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="sire")
+        try:
+            outcomes = await asyncio.gather(
+                *(self._procesar(emp) for emp in empresas),
+                return_exceptions=True,
+            )
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        results: List[Dict[str, Any]] = []
+        errors: List[str] = []
+        for emp, out in zip(empresas, outcomes):
+            if isinstance(out, BaseException):
+                print(f"❌ ERROR {emp['ruc']}: {out}")
+                errors.append(f"{emp['ruc']}: {out}")
+            else:
+                results.append(out)
+        return results, errors
+
+
+def run_propuesta_concurrente(
+    pairs,
+    periodo: str,
+    fec_ini: str,
+    fec_fin: str,
+    concurrency: int = PIPELINE_CONCURRENCY,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Punto de entrada síncrono. `pairs` = [(Empresa, EmpresaSire)].
+    Devuelve (resultados, errores "ruc: mensaje").
+    """
+    empresas = [_empresa_data(emp, cred) for emp, cred in pairs]
+    if not empresas:
+        return [], []
+    engine = PropuestaEngine(periodo, fec_ini, fec_fin, concurrency=concurrency)
+    METRICS.reset()
+    t0 = time.time()
+    results, errors = asyncio.run(engine.run(empresas))
+    print(f"⏱️ Propuesta {periodo}: {len(empresas)} empresas en {time.time() - t0:.1f}s (concurrencia={engine.concurrency})")
+    print(f"📡 HTTP SIRE: {METRICS.summary()}")
+    return results, errors
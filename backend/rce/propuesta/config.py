@@ -1,6 +1,8 @@
 import os
 
 API_BASE = os.getenv("SIRE_API_BASE", "https://api-sire.sunat.gob.pe")
+# servidor de tokens OAuth (api-seguridad); se puede apuntar a un mock local
+AUTH_BASE = os.getenv("SIRE_AUTH_BASE", "https://api-seguridad.sunat.gob.pe")
 
 # dónde guardas cache de tokens/tickets
 _BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
@@ -15,8 +17,22 @@ REGISTROS_DIR = os.getenv("SIRE_REGISTROS_DIR", _DEFAULT_REGISTROS)
 POLL_SECONDS = int(os.getenv("SIRE_POLL_SECONDS", "3"))
 POLL_TIMEOUT_SECONDS = int(os.getenv("SIRE_POLL_TIMEOUT_SECONDS", "180"))
 
+# pipeline concurrente: empresas en vuelo a la vez (llamadas HTTP/DB simultáneas)
+PIPELINE_CONCURRENCY = int(os.getenv("SIRE_PIPELINE_CONCURRENCY", "8"))
+
 # timeouts HTTP
 HTTP_TIMEOUT = int(os.getenv("SIRE_HTTP_TIMEOUT", "30"))
 
+# sesión HTTP compartida: pool keep-alive y reintentos (429/5xx/timeouts)
+HTTP_POOL_CONNECTIONS = int(os.getenv("SIRE_HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("SIRE_HTTP_POOL_MAXSIZE", "16"))  # conexiones por host
+HTTP_RETRIES = int(os.getenv("SIRE_HTTP_RETRIES", "3"))
+HTTP_RETRY_BACKOFF = float(os.getenv("SIRE_HTTP_RETRY_BACKOFF", "0.5"))  # 0.5s, 1s, 2s...
+HTTP_RETRY_JITTER = float(os.getenv("SIRE_HTTP_RETRY_JITTER", "0.3"))
+
 # endpoint de token (ajústalo a tu realidad)
 TOKEN_URL = os.getenv("SIRE_TOKEN_URL", "")  # <- tú lo defines
+
+# XLSX de la propuesta (solo para humanos):
+#   eager = se genera en cada corrida, lazy = al primer download, off = nunca
+XLSX_MODE = os.getenv("SIRE_XLSX_MODE", "lazy").strip().lower()
@@ -1,8 +1,11 @@
-import os, zipfile, hashlib, csv
-import pandas as pd
+import os, zipfile, hashlib, csv, shutil
+
+from openpyxl import Workbook
 
 from .config import REGISTROS_DIR
 
+COPY_CHUNK_BYTES = 1024 * 1024
+
 def ensure_dirs(periodo: str, ruc: str) -> str:
     base = os.path.join(REGISTROS_DIR, "periodos", periodo, ruc)
     os.makedirs(base, exist_ok=True)
@@ -14,6 +17,18 @@ def sha256_bytes(data: bytes) -> str:
     return h.hexdigest()
 
 def save_zip_and_extract_csv(zip_bytes: bytes, out_dir: str, periodo: str) -> str:
+    tmp_path = os.path.join(out_dir, f"propuesta_{periodo}.zip.part")
+    with open(tmp_path, "wb") as f:
+        f.write(zip_bytes)
+    return install_zip_and_extract_csv(tmp_path, out_dir, periodo=periodo)
+
+def install_zip_and_extract_csv(downloaded_zip: str, out_dir: str, periodo: str) -> str:
+    """
+    Mueve el ZIP descargado a su nombre estable y extrae el CSV en streaming
+    (copyfileobj por bloques; el CSV nunca se carga completo en memoria).
+    El ZIP se lee desde disco: su directorio central está al final del archivo,
+    así que la extracción solo puede empezar cuando la descarga terminó.
+    """
     # Sobrescribir siempre por periodo (no acumular archivos)
     for name in os.listdir(out_dir):
         if name.endswith("-propuesta.csv") or name.endswith("-propuesta.zip"):
@@ -23,44 +38,76 @@ def save_zip_and_extract_csv(zip_bytes: bytes, out_dir: str, periodo: str) -> st
                 pass
 
     zip_path = os.path.join(out_dir, f"propuesta_{periodo}.zip")
-    with open(zip_path, "wb") as f:
-        f.write(zip_bytes)
+    os.replace(downloaded_zip, zip_path)
 
+    stable_csv = os.path.join(out_dir, f"propuesta_{periodo}.csv")
+    tmp_csv = f"{stable_csv}.part"
     with zipfile.ZipFile(zip_path, "r") as z:
         names = z.namelist()
         if not names:
             raise RuntimeError("ZIP vacío")
-        csv_name = names[0]
-        z.extract(csv_name, out_dir)
+        with z.open(names[0]) as src, open(tmp_csv, "wb") as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_BYTES)
 
     # Renombrar a un nombre estable
-    extracted_path = os.path.join(out_dir, csv_name)
-    stable_csv = os.path.join(out_dir, f"propuesta_{periodo}.csv")
-    if os.path.exists(stable_csv):
-        os.remove(stable_csv)
-    os.replace(extracted_path, stable_csv)
-
+    os.replace(tmp_csv, stable_csv)
     return stable_csv
 
-def csv_to_xlsx(csv_path: str, xlsx_path: str) -> None:
+def _csv_rows(f, delimiter: str, strict: bool):
+    """
+    Filas del CSV ajustadas al número de columnas del header (header primero).
+    strict: csv estándar (soporta campos entre comillas con saltos de línea) y
+    csv.Error si una fila trae más columnas que el header. Si no, QUOTE_NONE:
+    tolera comillas internas mal escapadas (caso SUNAT).
+    """
+    opts = {"strict": True} if strict else {"quoting": csv.QUOTE_NONE}
+    ncols = None
+    reader = csv.reader(f, delimiter=delimiter, **opts)
+    for cols in reader:
+        if not cols:
+            continue
+        if ncols is None:
+            ncols = len(cols)
+            yield [h.strip() for h in cols]
+            continue
+        if len(cols) > ncols:
+            if strict:
+                raise csv.Error(f"línea {reader.line_num}: {len(cols)} columnas, header {ncols}")
+            cols = cols[:ncols]
+        elif len(cols) < ncols:
+            cols = cols + [""] * (ncols - len(cols))
+        yield cols
+
+def _write_xlsx(csv_path: str, tmp_path: str, delimiter: str, strict: bool) -> int:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    rows = -1
+    try:
+        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+            for cols in _csv_rows(f, delimiter, strict):
+                ws.append(cols if rows < 0 else [c if c != "" else None for c in cols])
+                rows += 1
+    except csv.Error:
+        # cierra el stream temporal de la hoja antes de descartar el workbook
+        ws.close()
+        raise
+    wb.save(tmp_path)
+    return max(rows, 0)
+
+def csv_to_xlsx(csv_path: str, xlsx_path: str, delimiter: str = ",") -> int:
+    """
+    Conversión en streaming: csv.reader sobre el archivo (campos multilínea
+    entre comillas incluidos) y un workbook write_only de openpyxl (memoria
+    constante). Las celdas van como texto, igual que antes (dtype=str). Si el
+    parseo estricto falla, se rehace todo con QUOTE_NONE como el fallback
+    anterior. Devuelve las filas de datos escritas.
+    """
+    tmp_path = f"{xlsx_path}.part"
     try:
-        df = pd.read_csv(csv_path, sep=",", dtype=str, engine="python")
-    except Exception as e:
+        rows = _write_xlsx(csv_path, tmp_path, delimiter, strict=True)
+    except csv.Error as e:
         # Fallback tolerante para CSV SUNAT con comillas internas no escapadas.
         print(f"⚠️ CSV malformado para XLSX ({e}). Aplicando parser tolerante...")
-        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-            raw = csv.reader(f, delimiter=",", quoting=csv.QUOTE_NONE)
-            rows = list(raw)
-        if not rows:
-            df = pd.DataFrame()
-        else:
-            headers = [h.strip() for h in rows[0]]
-            records = []
-            for cols in rows[1:]:
-                if len(cols) < len(headers):
-                    cols = cols + [""] * (len(headers) - len(cols))
-                elif len(cols) > len(headers):
-                    cols = cols[:len(headers)]
-                records.append(cols)
-            df = pd.DataFrame(records, columns=headers)
-    df.to_excel(xlsx_path, index=False)
+        rows = _write_xlsx(csv_path, tmp_path, delimiter, strict=False)
+    os.replace(tmp_path, xlsx_path)
+    return rows
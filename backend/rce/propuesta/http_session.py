@@ -0,0 +1,138 @@
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import (
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    HTTP_RETRIES,
+    HTTP_RETRY_BACKOFF,
+    HTTP_RETRY_JITTER,
+    HTTP_TIMEOUT,
+)
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class HttpMetrics:
+    """Latencia por operación (generar_ticket, estado_ticket, descarga, token...)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops: Dict[str, Dict[str, float]] = {}
+
+    def record(self, op: str, elapsed_ms: float, ok: bool) -> None:
+        with self._lock:
+            m = self._ops.setdefault(op, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            m["calls"] += 1
+            if not ok:
+                m["errors"] += 1
+            m["total_ms"] += elapsed_ms
+            m["max_ms"] = max(m["max_ms"], elapsed_ms)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            out = {}
+            for op, m in self._ops.items():
+                out[op] = {
+                    "calls": int(m["calls"]),
+                    "errors": int(m["errors"]),
+                    "avg_ms": round(m["total_ms"] / m["calls"], 1) if m["calls"] else 0.0,
+                    "max_ms": round(m["max_ms"], 1),
+                }
+            return out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._ops.clear()
+
+    def summary(self) -> str:
+        parts = [
+            f"{op}: n={m['calls']} err={m['errors']} avg={m['avg_ms']}ms max={m['max_ms']}ms"
+            for op, m in sorted(self.snapshot().items())
+        ]
+        return " | ".join(parts) or "sin llamadas"
+
+
+METRICS = HttpMetrics()
+
+_session: Optional[requests.Session] = None
+# Sesión aparte para operaciones no idempotentes (generar_ticket): sin reintento
+# por read-timeout, porque SUNAT pudo haber creado el ticket antes de cortarse.
+_session_no_read_retry: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def _build_session(read_retries: int = HTTP_RETRIES) -> requests.Session:
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=read_retries,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        backoff_jitter=HTTP_RETRY_JITTER,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=None,  # también POST (token): SUNAT responde 5xx/429 sin efectos
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=True,  # tope duro de conexiones por host
+        max_retries=retry,
+    )
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_session(idempotent: bool = True) -> requests.Session:
+    """
+    Sesión compartida (keep-alive) para los clientes SIRE.
+    idempotent=False devuelve la variante sin reintento por read-timeout.
+    """
+    global _session, _session_no_read_retry
+    if idempotent:
+        if _session is None:
+            with _session_lock:
+                if _session is None:
+                    _session = _build_session()
+        return _session
+    if _session_no_read_retry is None:
+        with _session_lock:
+            if _session_no_read_retry is None:
+                _session_no_read_retry = _build_session(read_retries=0)
+    return _session_no_read_retry
+
+
+def reset_session() -> None:
+    global _session, _session_no_read_retry
+    with _session_lock:
+        for s in (_session, _session_no_read_retry):
+            if s is not None:
+                s.close()
+        _session = None
+        _session_no_read_retry = None
+
+
+def request(method: str, url: str, op: str, idempotent: bool = True, **kwargs: Any) -> requests.Response:
+    """
+    requests.request sobre la sesión compartida, con reintentos y métricas por `op`.
+    Con idempotent=False no se reintenta un read-timeout (la petición ya llegó a
+    SUNAT); sí los fallos de conexión y los 429/5xx.
+    """
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        r = get_session(idempotent).request(method, url, **kwargs)
+        ok = r.status_code < 400
+        return r
+    finally:
+        METRICS.record(op, (time.perf_counter() - t0) * 1000, ok)
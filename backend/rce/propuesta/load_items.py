@@ -1,10 +1,11 @@
 import csv
+import io
+import json
 from datetime import datetime, date
 from decimal import Decimal, InvalidOperation
-from typing import Dict, Any, Tuple, Optional
+from typing import Dict, Any, Iterator, List, Tuple, Optional
 
 from sqlalchemy.orm import Session
-from core.database import RCEPropuestaItem
 
 # RUCs con CSV SUNAT "especial": la razón social del comprador puede venir con
 # comas sin comillas, desplazando columnas.
@@ -54,6 +55,134 @@ def _item_key(row: Dict[str, Any]) -> Tuple[str, str, str, str, str, str, date]:
     )
 
 
+# Columnas que se cargan vía COPY (todas menos id/created_at)
+_COPY_COLUMNS = [
+    "ruc_empresa", "periodo", "vigente", "car_sunat", "fecha_emision", "fecha_vcto_pago",
+    "tipo_cp", "serie", "numero", "tipo_doc_identidad", "ruc_emisor", "razon_emisor",
+    "bi_gravado_dg", "igv_dg", "bi_gravado_dgng", "igv_dgng", "bi_gravado_dng", "igv_dng",
+    "valor_adq_ng", "isc", "icbper", "otros_trib", "total_cp", "moneda", "tipo_cambio",
+    "detraccion", "est_comp", "incal", "raw_json",
+]
+_KEY_COLUMNS = ["ruc_empresa", "periodo", "ruc_emisor", "tipo_cp", "serie", "numero", "fecha_emision"]
+_TMP_TABLE = "tmp_rce_items_load"
+
+
+def _iter_csv_rows(ruc_empresa: str, csv_path: str, delimiter: str) -> Iterator[Tuple[int, Dict[str, str]]]:
+    # Caso normal
+    if ruc_empresa not in SPECIAL_FULL_ROW_RUCS:
+        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+            reader = csv.DictReader(f, delimiter=delimiter)
+            if not reader.fieldnames:
+                raise ValueError("CSV vacío o sin encabezados (sin compras en el periodo).")
+            reader.fieldnames = [name.strip() for name in reader.fieldnames]
+            for i, r in enumerate(reader, start=2):
+                yield i, r
+        return
+
+    # Caso especial: parseo por filas completo y recomposición de columnas.
+    with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
+        raw = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+        try:
+            headers = [h.strip() for h in next(raw)]
+        except StopIteration:
+            raise ValueError("CSV vacío o sin encabezados (sin compras en el periodo).")
+
+        hlen = len(headers)
+        for i, cols in enumerate(raw, start=2):
+            if not cols:
+                continue
+            if len(cols) > hlen:
+                # Junta el exceso dentro de la columna 2 (razón social comprador).
+                extra = len(cols) - hlen
+                merged = ", ".join([c.strip() for c in cols[1 : 2 + extra] if c is not None and c.strip() != ""])
+                cols = [cols[0], merged] + cols[2 + extra :]
+            if len(cols) < hlen:
+                cols = cols + [""] * (hlen - len(cols))
+            elif len(cols) > hlen:
+                cols = cols[:hlen]
+            yield i, dict(zip(headers, cols))
+
+
+def _row_to_item(r: Dict[str, str], ruc_empresa: str, periodo: str) -> Dict[str, Any]:
+    # Mapeo usando los nombres EXACTOS de tu CSV de muestra
+    fecha_emision = _parse_date(r.get("Fecha de emisión"))
+
+    # Validación crítica antes de procesar
+    if not fecha_emision:
+        # Si no hay fecha, es una fila corrupta o vacía
+        raise ValueError("Fecha de emisión vacía o inválida")
+
+    # NOTA: En r.get usa el string exacto. Si limpiamos fieldnames arriba,
+    # asegúrate que aquí no tengan espacios extra al inicio/final.
+    return dict(
+        ruc_empresa=ruc_empresa,
+        periodo=periodo,
+        vigente=True,
+        car_sunat=_norm_str(r.get("CAR SUNAT")),
+        fecha_emision=fecha_emision,
+        fecha_vcto_pago=_parse_date(r.get("Fecha Vcto/Pago")),
+
+        # Cuidado con los nombres exactos:
+        tipo_cp=_norm_str(r.get("Tipo CP/Doc.")) or "",
+        serie=_norm_str(r.get("Serie del CDP")) or "",
+        numero=_norm_str(r.get("Nro CP o Doc. Nro Inicial (Rango)")) or "",
+
+        tipo_doc_identidad=_norm_str(r.get("Tipo Doc Identidad")),
+        ruc_emisor=_norm_str(r.get("Nro Doc Identidad")) or "",
+
+        # Aquí el CSV original tenía un doble espacio posible.
+        # Al usar reader.fieldnames = [x.strip()...] se arreglan los bordes,
+        # pero el doble espacio interno se mantiene. Copia exacta:
+        razon_emisor=_norm_str(r.get("Apellidos Nombres/ Razón  Social") or r.get("Apellidos Nombres/ Razón Social")),
+
+        bi_gravado_dg=_parse_decimal(r.get("BI Gravado DG")),
+        igv_dg=_parse_decimal(r.get("IGV / IPM DG")),
+        bi_gravado_dgng=_parse_decimal(r.get("BI Gravado DGNG")),
+        igv_dgng=_parse_decimal(r.get("IGV / IPM DGNG")),
+        bi_gravado_dng=_parse_decimal(r.get("BI Gravado DNG")),
+        igv_dng=_parse_decimal(r.get("IGV / IPM DNG")),
+        valor_adq_ng=_parse_decimal(r.get("Valor Adq. NG")),
+        isc=_parse_decimal(r.get("ISC")),
+        icbper=_parse_decimal(r.get("ICBPER")),
+        otros_trib=_parse_decimal(r.get("Otros Trib/ Cargos")),
+        total_cp=_parse_decimal(r.get("Total CP")),
+
+        moneda=_norm_str(r.get("Moneda")) or "PEN",
+        tipo_cambio=_parse_decimal(r.get("Tipo de Cambio")),
+
+        detraccion=_norm_str(r.get("Detracción")),
+        est_comp=_norm_str(r.get("Est. Comp.")),
+        incal=_norm_str(r.get("Incal")),
+        # clasif_bss_sss=_norm_str(r.get("Clasif de Bss y Sss")), # A veces no viene
+
+        raw_json=dict(r),
+    )
+
+
+def _copy_value(v: Any) -> str:
+    """Valor para COPY ... (FORMAT csv, NULL '\\N'): todo va entre comillas salvo el NULL."""
+    if v is None:
+        return "\\N"
+    if isinstance(v, bool):
+        v = "t" if v else "f"
+    elif isinstance(v, date):
+        v = v.isoformat()
+    elif isinstance(v, dict):
+        v = json.dumps(v, ensure_ascii=False)
+    else:
+        v = str(v)
+    return '"' + v.replace('"', '""') + '"'
+
+
+def _copy_buffer(items: List[Dict[str, Any]]) -> io.StringIO:
+    buf = io.StringIO()
+    for item in items:
+        buf.write(",".join(_copy_value(item[c]) for c in _COPY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
 def load_rce_items_from_csv(
     db: Session,
     ruc_empresa: str,
@@ -62,172 +191,84 @@ def load_rce_items_from_csv(
     delimiter: str = ",", # CORRECCIÓN: Default a coma según tu data
     update_on_conflict: bool = True,
 ) -> dict:
+    """
+    Carga la propuesta en bloque: COPY a una tabla temporal, un solo
+    INSERT ... ON CONFLICT ON CONSTRAINT uq_rce_item_key y un solo UPDATE
+    que marca como no vigentes los items que ya no vienen en el CSV.
+    """
     inserted = 0
     updated = 0
     skipped = 0
     errors = 0
-    seen_keys = set()
-
-    def _iter_rows():
-        # Caso normal
-        if ruc_empresa not in SPECIAL_FULL_ROW_RUCS:
-            with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-                reader = csv.DictReader(f, delimiter=delimiter)
-                if not reader.fieldnames:
-                    raise ValueError("CSV vacío o sin encabezados (sin compras en el periodo).")
-                reader.fieldnames = [name.strip() for name in reader.fieldnames]
-                for i, r in enumerate(reader, start=2):
-                    yield i, r
-            return
-
-        # Caso especial: parseo por filas completo y recomposición de columnas.
-        with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
-            raw = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_NONE)
-            try:
-                headers = [h.strip() for h in next(raw)]
-            except StopIteration:
-                raise ValueError("CSV vacío o sin encabezados (sin compras en el periodo).")
+    duplicates = 0
+    by_key: Dict[Tuple, Dict[str, Any]] = {}
+
+    for i, r in _iter_csv_rows(ruc_empresa, csv_path, delimiter):
+        try:
+            item_data = _row_to_item(r, ruc_empresa, periodo)
+
+            # Validaciones mínimas de integridad
+            if not item_data["ruc_emisor"] or not item_data["serie"]:
+                # A veces SUNAT manda filas de resumen o vacías al final
+                continue
+
+            # ON CONFLICT DO UPDATE no puede tocar la misma fila dos veces en un INSERT:
+            # si la clave se repite en el CSV gana la última fila (como el upsert fila a fila).
+            key = _item_key(item_data)
+            if key in by_key:
+                duplicates += 1
+            by_key[key] = item_data
+        except Exception as e:
+            errors += 1
+            print(f"⚠️ Error en fila CSV {i}: {e}")
+
+    if not by_key:
+        db.commit()
+        return {"inserted": inserted, "updated": updated, "skipped": skipped, "errors": errors}
+
+    cols = ", ".join(_COPY_COLUMNS)
+    cur = db.connection().connection.cursor()
+    try:
+        cur.execute(
+            f"CREATE TEMP TABLE {_TMP_TABLE} ON COMMIT DROP AS "
+            f"SELECT {cols} FROM rce_propuesta_items WITH NO DATA"
+        )
+        cur.copy_expert(
+            f"COPY {_TMP_TABLE} ({cols}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            _copy_buffer(list(by_key.values())),
+        )
+
+        if update_on_conflict:
+            set_cols = ", ".join(f"{c} = EXCLUDED.{c}" for c in _COPY_COLUMNS if c not in _KEY_COLUMNS)
+            on_conflict = f"DO UPDATE SET {set_cols}"
+        else:
+            on_conflict = "DO NOTHING"
+        # xmax = 0 solo en filas recién insertadas: distingue insert de update
+        cur.execute(
+            f"INSERT INTO rce_propuesta_items ({cols}) SELECT {cols} FROM {_TMP_TABLE} "
+            f"ON CONFLICT ON CONSTRAINT uq_rce_item_key {on_conflict} "
+            f"RETURNING (xmax = 0) AS inserted"
+        )
+        for (was_inserted,) in cur.fetchall():
+            if was_inserted:
+                inserted += 1
+            else:
+                updated += 1
+        if update_on_conflict:
+            updated += duplicates
+        else:
+            skipped = len(by_key) - inserted + duplicates
 
-            hlen = len(headers)
-            for i, cols in enumerate(raw, start=2):
-                if not cols:
-                    continue
-                if len(cols) > hlen:
-                    # Junta el exceso dentro de la columna 2 (razón social comprador).
-                    extra = len(cols) - hlen
-                    merged = ", ".join([c.strip() for c in cols[1 : 2 + extra] if c is not None and c.strip() != ""])
-                    cols = [cols[0], merged] + cols[2 + extra :]
-                if len(cols) < hlen:
-                    cols = cols + [""] * (hlen - len(cols))
-                elif len(cols) > hlen:
-                    cols = cols[:hlen]
-                yield i, dict(zip(headers, cols))
-
-    for i, r in _iter_rows():
-            try:
-                # Mapeo usando los nombres EXACTOS de tu CSV de muestra
-                fecha_emision = _parse_date(r.get("Fecha de emisión"))
-                
-                # Validación crítica antes de procesar
-                if not fecha_emision:
-                    # Si no hay fecha, es una fila corrupta o vacía
-                    raise ValueError("Fecha de emisión vacía o inválida")
-
-                # NOTA: En r.get usa el string exacto. Si limpiamos fieldnames arriba, 
-                # asegúrate que aquí no tengan espacios extra al inicio/final.
-                item_data = dict(
-                    ruc_empresa=ruc_empresa,
-                    periodo=periodo,
-                    vigente=True,
-                    car_sunat=_norm_str(r.get("CAR SUNAT")),
-                    fecha_emision=fecha_emision,
-                    fecha_vcto_pago=_parse_date(r.get("Fecha Vcto/Pago")),
-                    
-                    # Cuidado con los nombres exactos:
-                    tipo_cp=_norm_str(r.get("Tipo CP/Doc.")) or "",
-                    serie=_norm_str(r.get("Serie del CDP")) or "",
-                    numero=_norm_str(r.get("Nro CP o Doc. Nro Inicial (Rango)")) or "",
-                    
-                    tipo_doc_identidad=_norm_str(r.get("Tipo Doc Identidad")),
-                    ruc_emisor=_norm_str(r.get("Nro Doc Identidad")) or "",
-                    
-                    # Aquí el CSV original tenía un doble espacio posible. 
-                    # Al usar reader.fieldnames = [x.strip()...] se arreglan los bordes, 
-                    # pero el doble espacio interno se mantiene. Copia exacta:
-                    razon_emisor=_norm_str(r.get("Apellidos Nombres/ Razón  Social") or r.get("Apellidos Nombres/ Razón Social")), 
-
-                    bi_gravado_dg=_parse_decimal(r.get("BI Gravado DG")),
-                    igv_dg=_parse_decimal(r.get("IGV / IPM DG")),
-                    bi_gravado_dgng=_parse_decimal(r.get("BI Gravado DGNG")),
-                    igv_dgng=_parse_decimal(r.get("IGV / IPM DGNG")),
-                    bi_gravado_dng=_parse_decimal(r.get("BI Gravado DNG")),
-                    igv_dng=_parse_decimal(r.get("IGV / IPM DNG")),
-                    valor_adq_ng=_parse_decimal(r.get("Valor Adq. NG")),
-                    isc=_parse_decimal(r.get("ISC")),
-                    icbper=_parse_decimal(r.get("ICBPER")),
-                    otros_trib=_parse_decimal(r.get("Otros Trib/ Cargos")),
-                    total_cp=_parse_decimal(r.get("Total CP")),
-
-                    moneda=_norm_str(r.get("Moneda")) or "PEN",
-                    tipo_cambio=_parse_decimal(r.get("Tipo de Cambio")),
-
-                    detraccion=_norm_str(r.get("Detracción")),
-                    est_comp=_norm_str(r.get("Est. Comp.")),
-                    incal=_norm_str(r.get("Incal")),
-                    # clasif_bss_sss=_norm_str(r.get("Clasif de Bss y Sss")), # A veces no viene
-
-                    raw_json=dict(r), 
-                )
-
-                # Validaciones mínimas de integridad
-                if not item_data["ruc_emisor"] or not item_data["serie"]:
-                     # A veces SUNAT manda filas de resumen o vacías al final
-                     continue 
-
-                # --- Lógica de Base de Datos (Idéntica a la tuya) ---
-                # NOTA DE RENDIMIENTO: Si cargas 10,000 filas, hacer query().first() por cada una es LENTO.
-                # Para archivos grandes se recomienda "Bulk Upsert". Para < 2000 filas, esto está bien.
-                existing = (
-                    db.query(RCEPropuestaItem)
-                    .filter(
-                        RCEPropuestaItem.ruc_empresa == item_data["ruc_empresa"],
-                        RCEPropuestaItem.periodo == item_data["periodo"],
-                        RCEPropuestaItem.ruc_emisor == item_data["ruc_emisor"],
-                        RCEPropuestaItem.tipo_cp == item_data["tipo_cp"],
-                        RCEPropuestaItem.serie == item_data["serie"],
-                        RCEPropuestaItem.numero == item_data["numero"],
-                    )
-                    .first()
-                )
-
-                if existing is None:
-                    db.add(RCEPropuestaItem(**item_data))
-                    inserted += 1
-                    seen_keys.add(_item_key(item_data))
-                else:
-                    if update_on_conflict:
-                        for k, v in item_data.items():
-                            setattr(existing, k, v)
-                        existing.vigente = True
-                        updated += 1
-                        seen_keys.add(_item_key(item_data))
-                    else:
-                        skipped += 1
-
-            except Exception as e:
-                errors += 1
-                print(f"⚠️ Error en fila CSV {i}: {e}")
-
-    # Marcar como no vigentes los items que ya no están en el CSV
-    if seen_keys:
-        rows = (
-            db.query(
-                RCEPropuestaItem.id,
-                RCEPropuestaItem.ruc_empresa,
-                RCEPropuestaItem.periodo,
-                RCEPropuestaItem.ruc_emisor,
-                RCEPropuestaItem.tipo_cp,
-                RCEPropuestaItem.serie,
-                RCEPropuestaItem.numero,
-                RCEPropuestaItem.fecha_emision,
-            )
-            .filter(RCEPropuestaItem.ruc_empresa == ruc_empresa, RCEPropuestaItem.periodo == periodo)
-            .all()
+        # Marcar como no vigentes los items que ya no están en el CSV
+        match = " AND ".join(f"t.{c} = p.{c}" for c in _KEY_COLUMNS)
+        cur.execute(
+            f"UPDATE rce_propuesta_items p SET vigente = false "
+            f"WHERE p.ruc_empresa = %s AND p.periodo = %s AND p.vigente IS DISTINCT FROM false "
+            f"AND NOT EXISTS (SELECT 1 FROM {_TMP_TABLE} t WHERE {match})",
+            (ruc_empresa, periodo),
         )
-        for row in rows:
-            key = (
-                row.ruc_empresa,
-                row.periodo,
-                row.ruc_emisor,
-                row.tipo_cp,
-                row.serie,
-                row.numero,
-                row.fecha_emision,
-            )
-            if key not in seen_keys:
-                db.query(RCEPropuestaItem).filter(RCEPropuestaItem.id == row.id).update(
-                    {"vigente": False}, synchronize_session=False
-                )
+    finally:
+        cur.close()
 
     db.commit()
     return {"inserted": inserted, "updated": updated, "skipped": skipped, "errors": errors}
@@ -1,5 +1,6 @@
 import os
 from datetime import datetime
+from typing import Optional
 
 from sqlalchemy.orm import Session
 from core.database import db_session, RCEPropuestaFile
@@ -12,7 +13,7 @@ from .sire_client import (
     extraer_params_descarga,
     descargar_archivo_reporte,
 )
-from .file_ops import ensure_dirs, save_zip_and_extract_csv, csv_to_xlsx, sha256_bytes
+from .file_ops import ensure_dirs, save_zip_and_extract_csv, sha256_bytes
 
 def procesar_empresa_periodo(db: Session, empresa, cred_sire, periodo: str, fec_ini: str, fec_fin: str):
     ruc = empresa.ruc
@@ -74,13 +75,13 @@ def procesar_empresa_periodo(db: Session, empresa, cred_sire, periodo: str, fec_
         .first()
     )
     same_hash = row and row.sha256 == digest
-    files_exist = all(map(lambda p: p and os.path.exists(p), [zip_path, csv_path, xlsx_path]))
+    files_exist = all(map(lambda p: p and os.path.exists(p), [zip_path, csv_path]))
 
     if same_hash and files_exist:
         print("🔁 ZIP sin cambios: se mantiene archivo existente.")
     else:
+        # el XLSX se genera a pedido desde la cache (rce.derived_files)
         csv_path = save_zip_and_extract_csv(zip_bytes, out_dir=out_dir, periodo=periodo)
-        csv_to_xlsx(csv_path, xlsx_path)
 
     # 7) Persistir file record (si ya existe por periodo, actualiza)
     if not row:
@@ -108,18 +109,13 @@ def procesar_empresa_periodo(db: Session, empresa, cred_sire, periodo: str, fec_
     db.commit()
     return {"ruc": ruc, "periodo": periodo, "csv": csv_path, "xlsx": xlsx_path, "ticket": ticket}
 
-def run_pipeline(periodo: str, fec_ini: str, fec_fin: str):
+def run_pipeline(periodo: str, fec_ini: str, fec_fin: str, concurrency: Optional[int] = None):
+    from .async_pipeline import run_propuesta_concurrente
+
     with db_session() as db:
         pairs = get_empresas_sire_activas(db)
-        print(f"Empresas a procesar: {len(pairs)}")
-
-        results = []
-        for empresa, cred_sire in pairs:
-            print(f"\n==> {empresa.ruc} {empresa.razon_social} periodo {periodo}")
-            try:
-                res = procesar_empresa_periodo(db, empresa, cred_sire, periodo, fec_ini, fec_fin)
-                print(f"✅ OK {empresa.ruc}: {res['xlsx']}")
-                results.append(res)
-            except Exception as e:
-                print(f"❌ ERROR {empresa.ruc}: {e}")
-        return results
+    print(f"Empresas a procesar: {len(pairs)}")
+
+    kwargs = {"concurrency": concurrency} if concurrency else {}
+    results, _errors = run_propuesta_concurrente(pairs, periodo, fec_ini, fec_fin, **kwargs)
+    return results
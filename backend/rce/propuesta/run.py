@@ -1,7 +1,9 @@
 import argparse
+import calendar
 import csv
 import os
 from datetime import datetime
+from typing import List, Tuple
 from rce.propuesta.load_items import load_rce_items_from_csv
 from core.database import db_session, Empresa, EmpresaSire, RCEPropuestaFile
 
@@ -10,30 +12,39 @@ from rce.propuesta.state_store import load_state, save_state, token_is_valid
 from rce.propuesta.sire_client import (
     generar_ticket_exportacion_propuesta,
     esperar_hasta_terminado,
+    esperar_tickets_terminados,
     extraer_params_descarga,
-    descargar_archivo_reporte,
+    descargar_archivo_reporte_a_disco,
 )
-from rce.propuesta.file_ops import ensure_dirs, save_zip_and_extract_csv, csv_to_xlsx, sha256_bytes
+from rce.propuesta.file_ops import ensure_dirs, install_zip_and_extract_csv
+from rce.propuesta.config import XLSX_MODE
+from rce.derived_files import propuesta_xlsx
 
 
-def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini: str, fec_fin: str):
-    ruc = emp.ruc
+def rango_periodo(periodo: str) -> Tuple[str, str]:
+    """Primer y último día del periodo YYYYMM, en el formato YYYY-MM-DD de SIRE."""
+    anio, mes = int(periodo[:4]), int(periodo[4:6])
+    ultimo = calendar.monthrange(anio, mes)[1]
+    return f"{anio:04d}-{mes:02d}-01", f"{anio:04d}-{mes:02d}-{ultimo:02d}"
 
-    # 1) token (cache json)
+
+def obtener_token(ruc: str, usuario_sol: str, clave_sol: str, client_id: str, client_secret: str) -> str:
+    """Token SIRE desde el cache json; si venció, pide uno nuevo."""
     st = load_state(ruc)
     if not token_is_valid(st):
         token, exp = get_token_sire(
-            client_id=cred.client_id,
-            client_secret=cred.client_secret,
-            ruc=emp.ruc,
-            usuario_sol=emp.usuario_sol,
-            clave_sol=emp.clave_sol,
+            client_id=client_id,
+            client_secret=client_secret,
+            ruc=ruc,
+            usuario_sol=usuario_sol,
+            clave_sol=clave_sol,
         )
         save_state(ruc, {"token": token, "token_expires_at": exp})
         st = load_state(ruc)
-    token = st["token"]
+    return st["token"]
 
-    # 2) generar ticket
+
+def solicitar_ticket(ruc: str, token: str, periodo: str, fec_ini: str, fec_fin: str) -> str:
     ticket = generar_ticket_exportacion_propuesta(
         token=token,
         per=periodo,
@@ -41,30 +52,66 @@ def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini:
         fec_fin=fec_fin,
     )
     save_state(ruc, {"last_ticket": ticket, "last_ticket_periodo": periodo})
+    return ticket
+
+
+def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini: str, fec_fin: str):
+    ruc = emp.ruc
+
+    # 1) token (cache json)
+    token = obtener_token(ruc, emp.usuario_sol, emp.clave_sol, cred.client_id, cred.client_secret)
+
+    # 2) generar ticket
+    ticket = solicitar_ticket(ruc, token, periodo, fec_ini, fec_fin)
 
     # 3) esperar proceso terminado
     reg = esperar_hasta_terminado(token, periodo, ticket)
 
+    return descargar_y_registrar(db, ruc, token, periodo, fec_ini, fec_fin, ticket, reg)
+
+
+def procesar_empresa_periodos(db, emp: Empresa, cred: EmpresaSire, periodos: List[str]):
+    """
+    Varios periodos de una misma empresa: pide todos los tickets con el mismo
+    token y los espera juntos (una consulta de estado por ciclo, no una por ticket).
+    Cada periodo usa su propio rango de emisión (primer a último día del mes).
+    """
+    ruc = emp.ruc
+    token = obtener_token(ruc, emp.usuario_sol, emp.clave_sol, cred.client_id, cred.client_secret)
+    rangos = {periodo: rango_periodo(periodo) for periodo in periodos}
+    tickets = {solicitar_ticket(ruc, token, periodo, *rangos[periodo]): periodo for periodo in periodos}
+    terminados = esperar_tickets_terminados(token, tickets)
+
+    results = []
+    for ticket, periodo in tickets.items():
+        fec_ini, fec_fin = rangos[periodo]
+        results.append(descargar_y_registrar(db, ruc, token, periodo, fec_ini, fec_fin, ticket, terminados[ticket]))
+    return results
+
+
+def descargar_y_registrar(db, ruc: str, token: str, periodo: str, fec_ini: str, fec_fin: str, ticket: str, reg: dict):
+    """Pasos 4-7: descarga del ZIP de un ticket terminado, extracción, carga de items y registro."""
     # 4) extraer params descarga
     nom_zip, cod_tipo, cod_proc = extraer_params_descarga(reg)
     save_state(ruc, {"last_cod_proceso": cod_proc, "last_nom_archivo": f"propuesta_{periodo}.zip"})
 
-    # 5) descargar zip bytes
-    zip_bytes = descargar_archivo_reporte(
+    # 5) descargar zip en streaming a disco (hash incremental)
+    out_dir = ensure_dirs(periodo, ruc)
+    zip_path = f"{out_dir}/propuesta_{periodo}.zip"
+    csv_path = f"{out_dir}/propuesta_{periodo}.csv"
+    xlsx_path = f"{out_dir}/propuesta_{periodo}.xlsx"
+    part_path = f"{zip_path}.part"
+    digest = descargar_archivo_reporte_a_disco(
         token=token,
         per=periodo,
         numTicket=ticket,
         codProceso=cod_proc,
         nomArchivoReporte=nom_zip,
         codTipoArchivoReporte=cod_tipo,
+        dest_path=part_path,
     )
-    digest = sha256_bytes(zip_bytes)
 
     # 6) guardar/extraer/convertir (solo si el hash cambió)
-    out_dir = ensure_dirs(periodo, ruc)
-    zip_path = f"{out_dir}/propuesta_{periodo}.zip"
-    csv_path = f"{out_dir}/propuesta_{periodo}.csv"
-    xlsx_path = f"{out_dir}/propuesta_{periodo}.xlsx"
 
     row = (
         db.query(RCEPropuestaFile)
@@ -73,12 +120,13 @@ def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini:
     )
 
     same_hash = row and row.sha256 == digest
-    files_exist = all(map(lambda p: p and os.path.exists(p), [zip_path, csv_path, xlsx_path]))
+    files_exist = all(map(lambda p: p and os.path.exists(p), [zip_path, csv_path]))
 
     if same_hash and files_exist:
+        os.remove(part_path)
         print("🔁 ZIP sin cambios: se mantiene archivo existente.")
     else:
-        csv_path = save_zip_and_extract_csv(zip_bytes, out_dir, periodo=periodo)
+        csv_path = install_zip_and_extract_csv(part_path, out_dir, periodo=periodo)
         try:
             with open(csv_path, "r", encoding="utf-8-sig", newline="") as f:
                 reader = csv.reader(f)
@@ -96,7 +144,9 @@ def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini:
                 total_lines = sum(1 for _ in f)
             total_rows = max(total_lines - 1, 0)
         print(f"📊 Filas CSV (sin header): {total_rows}")
-        csv_to_xlsx(csv_path, xlsx_path)
+        if os.path.exists(xlsx_path):
+            # XLSX suelto de versiones anteriores: ahora vive en la cache de artefactos
+            os.remove(xlsx_path)
         load_rce_items_from_csv(db, ruc, periodo, csv_path, delimiter=",")
 
     # 7) registrar en BD (upsert simple)
@@ -124,6 +174,10 @@ def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini:
 
     db.commit()
 
+    if XLSX_MODE == "eager":
+        # pre-calienta la cache (clave = sha256 del ZIP; si no cambió es un hit)
+        propuesta_xlsx(db, ruc, periodo)
+
     return {
         "ruc": ruc,
         "ticket": ticket,
@@ -134,16 +188,28 @@ def procesar_empresa(db, emp: Empresa, cred: EmpresaSire, periodo: str, fec_ini:
 
 
 def main():
+    from rce.propuesta.async_pipeline import run_propuesta_concurrente
+    from rce.propuesta.config import PIPELINE_CONCURRENCY
+
     ap = argparse.ArgumentParser()
-    ap.add_argument("--periodo", required=True, help="YYYYMM")
-    ap.add_argument("--fec-ini", required=True, help="YYYY-MM-DD")
-    ap.add_argument("--fec-fin", required=True, help="YYYY-MM-DD")
+    ap.add_argument("--periodo", required=True, help="YYYYMM (o lista separada por comas)")
+    ap.add_argument("--fec-ini", default=None, help="YYYY-MM-DD (default: primer día del periodo)")
+    ap.add_argument("--fec-fin", default=None, help="YYYY-MM-DD (default: último día del periodo)")
     ap.add_argument("--ruc", default=None, help="Opcional: solo una empresa")
+    ap.add_argument("--concurrency", type=int, default=PIPELINE_CONCURRENCY, help="Empresas en paralelo")
     args = ap.parse_args()
 
     periodo = args.periodo
-    fec_ini = args.fec_ini
-    fec_fin = args.fec_fin
+    periodos = [p.strip() for p in periodo.split(",") if p.strip()]
+    if len(periodos) > 1:
+        # un rango explícito solo puede pertenecer a un periodo
+        if args.fec_ini or args.fec_fin:
+            ap.error("--fec-ini/--fec-fin no se aceptan con varios periodos (cada uno usa su mes completo)")
+        fec_ini, fec_fin = rango_periodo(periodos[0])[0], rango_periodo(periodos[-1])[1]
+    else:
+        default_ini, default_fin = rango_periodo(periodo)
+        fec_ini = args.fec_ini or default_ini
+        fec_fin = args.fec_fin or default_fin
 
     with db_session() as db:
         q = (
@@ -159,22 +225,26 @@ def main():
         pairs = q.all()
         print(f"📌 Empresas a procesar: {len(pairs)} | periodo={periodo} rango={fec_ini}..{fec_fin}")
 
-        ok = 0
-        fail = 0
-
-        for emp, cred in pairs:
-            print(f"\n==> {emp.ruc} | {emp.razon_social}")
-            try:
-                res = procesar_empresa(db, emp, cred, periodo, fec_ini, fec_fin)
-                ok += 1
-                print("✅ OK")
-                print(f"   ticket: {res['ticket']}")
-                print(f"   xlsx:   {res['xlsx']}")
-            except Exception as e:
-                fail += 1
-                print(f"❌ ERROR {emp.ruc}: {e}")
-
-        print(f"\n🏁 Terminado: OK={ok} ERROR={fail}")
+        if len(periodos) > 1:
+            # varios periodos: tickets por empresa esperados en lote
+            ok = fail = 0
+            for emp, cred in pairs:
+                print(f"\n==> {emp.ruc} | {emp.razon_social}")
+                try:
+                    for res in procesar_empresa_periodos(db, emp, cred, periodos):
+                        print(f"   ticket: {res['ticket']} xlsx: {res['xlsx']}")
+                    ok += 1
+                except Exception as e:
+                    fail += 1
+                    print(f"❌ ERROR {emp.ruc}: {e}")
+            print(f"\n🏁 Terminado: OK={ok} ERROR={fail}")
+            return
+
+    results, errors = run_propuesta_concurrente(pairs, periodo, fec_ini, fec_fin, concurrency=args.concurrency)
+    for res in results:
+        print(f"   {res['ruc']} ticket: {res['ticket']} xlsx: {res['xlsx']}")
+
+    print(f"\n🏁 Terminado: OK={len(results)} ERROR={len(errors)}")
 
 
 if __name__ == "__main__":
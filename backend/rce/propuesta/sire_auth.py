@@ -2,6 +2,9 @@ import requests
 from datetime import datetime, timedelta, timezone
 from typing import Tuple
 
+from .config import AUTH_BASE
+from .http_session import request
+
 class SireAuthError(RuntimeError):
     pass
 
@@ -34,7 +37,7 @@ def get_token_sire(
     if not ruc or not usuario_sol or not clave_sol:
         raise SireAuthError("Falta ruc/usuario_sol/clave_sol")
 
-    token_url = f"https://api-seguridad.sunat.gob.pe/v1/clientessol/{client_id}/oauth2/token/"
+    token_url = f"{AUTH_BASE}/v1/clientessol/{client_id}/oauth2/token/"
 
     data = {
         "grant_type": grant_type,
@@ -50,7 +53,7 @@ def get_token_sire(
         "Accept": "application/json",
     }
 
-    r = requests.post(token_url, data=data, headers=headers, timeout=timeout)
+    r = request("POST", token_url, "token", data=data, headers=headers, timeout=timeout)
     if r.status_code >= 400:
         try:
             j_err = r.json()
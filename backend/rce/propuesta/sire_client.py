@@ -1,11 +1,20 @@
+import hashlib
+import os
+import random
 import time
 import requests
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Optional, Tuple
+
+from .config import API_BASE, HTTP_TIMEOUT
+from .http_session import request
 
-API_BASE = "https://api-sire.sunat.gob.pe"
-HTTP_TIMEOUT = 30
 POLL_SECONDS = 3
 POLL_TIMEOUT_SECONDS = 180
+# backoff del polling: 3s, 6s, 12s... hasta POLL_MAX_SECONDS
+POLL_BACKOFF = 2
+POLL_MAX_SECONDS = 20
+# páginas máximas por ciclo al consultar estados sin filtro de ticket
+POLL_MAX_PAGES = 10
 
 class SireApiError(RuntimeError):
     pass
@@ -60,7 +69,11 @@ def generar_ticket_exportacion_propuesta(
         "fecEmisionFin": fec_fin,
         
     }
-    r = requests.get(url, headers=auth_headers(token), params=params, timeout=HTTP_TIMEOUT)
+    # Cada GET crea un ticket nuevo en SIRE: sin reintento por read-timeout.
+    r = request(
+        "GET", url, "generar_ticket", idempotent=False,
+        headers=auth_headers(token), params=params, timeout=HTTP_TIMEOUT,
+    )
     if r.status_code >= 400:
         raise SireApiError(_normalize_http_error(r, "generar_ticket"))
     j = _safe_json(r, "generar_ticket")
@@ -69,33 +82,108 @@ def generar_ticket_exportacion_propuesta(
         raise SireApiError(f"Respuesta sin numTicket: {j}")
     return t
 
-def consultar_estado_ticket(token: str, per: str, numTicket: str) -> Dict[str, Any]:
+def consultar_estado_tickets(
+    token: str,
+    per_ini: str,
+    per_fin: str,
+    page: int = 1,
+    per_page: int = 40,
+    numTicket: Optional[str] = None,
+) -> Dict[str, Any]:
     url = f"{API_BASE}/v1/contribuyente/migeigv/libros/rvierce/gestionprocesosmasivos/web/masivo/consultaestadotickets"
     params = {
-        "perIni": per,
-        "perFin": per,
-        "page": 1,
-        "perPage": 40,
-        "numTicket": numTicket,
+        "perIni": per_ini,
+        "perFin": per_fin,
+        "page": page,
+        "perPage": per_page,
     }
-    r = requests.get(url, headers=auth_headers(token), params=params, timeout=HTTP_TIMEOUT)
+    if numTicket:
+        params["numTicket"] = numTicket
+    r = request("GET", url, "estado_ticket", headers=auth_headers(token), params=params, timeout=HTTP_TIMEOUT)
     if r.status_code >= 400:
         raise SireApiError(_normalize_http_error(r, "estado_ticket"))
     return _safe_json(r, "estado_ticket")
 
-def esperar_hasta_terminado(token: str, per: str, numTicket: str) -> Dict[str, Any]:
+def consultar_estado_ticket(token: str, per: str, numTicket: str) -> Dict[str, Any]:
+    return consultar_estado_tickets(token, per, per, numTicket=numTicket)
+
+def _es_terminado(reg: Dict[str, Any]) -> bool:
+    return reg.get("codEstadoProceso") == "06" or (reg.get("desEstadoProceso") or "").lower() == "terminado"
+
+def registro_terminado(estado: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Primer registro del estado si el proceso ya terminó; None si sigue en curso."""
+    regs = estado.get("registros") or []
+    if regs and _es_terminado(regs[0]):
+        return regs[0]
+    return None
+
+def consultar_ticket_terminado(token: str, per: str, numTicket: str) -> Optional[Dict[str, Any]]:
+    """Una sola consulta de estado (sin esperar). Útil para pollear varios tickets a la vez."""
+    return registro_terminado(consultar_estado_ticket(token, per, numTicket))
+
+def siguiente_espera(delay: float) -> float:
+    """Backoff exponencial con algo de jitter, topado en POLL_MAX_SECONDS."""
+    return min(delay * POLL_BACKOFF, POLL_MAX_SECONDS) + random.uniform(0, 0.5)
+
+def consultar_tickets_terminados(token: str, tickets: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Un ciclo de polling para varios tickets del mismo token ({numTicket: periodo}).
+    Con un solo ticket filtra por numTicket; con varios consulta el rango de
+    periodos sin filtro y pagina hasta ubicar todos los pendientes.
+    Devuelve {numTicket: registro} de los que ya terminaron.
+    """
+    if not tickets:
+        return {}
+    if len(tickets) == 1:
+        (num, per), = tickets.items()
+        reg = consultar_ticket_terminado(token, per, num)
+        return {num: reg} if reg else {}
+
+    per_ini, per_fin = min(tickets.values()), max(tickets.values())
+    pendientes = set(tickets)
+    terminados: Dict[str, Dict[str, Any]] = {}
+    per_page = 40
+    for page in range(1, POLL_MAX_PAGES + 1):
+        st = consultar_estado_tickets(token, per_ini, per_fin, page=page, per_page=per_page)
+        regs = st.get("registros") or []
+        for reg in regs:
+            num = str(reg.get("numTicket") or "")
+            if num in pendientes:
+                pendientes.discard(num)
+                if _es_terminado(reg):
+                    terminados[num] = reg
+        if not pendientes or len(regs) < per_page:
+            break
+        total = (st.get("paginacion") or {}).get("totalRegistros")
+        if total is not None and page * per_page >= int(total):
+            break
+    return terminados
+
+def esperar_tickets_terminados(
+    token: str,
+    tickets: Dict[str, str],
+    timeout: int = POLL_TIMEOUT_SECONDS,
+) -> Dict[str, Dict[str, Any]]:
+    """Espera a que terminen todos los tickets ({numTicket: periodo}) con una consulta por ciclo."""
     t0 = time.time()
+    delay = POLL_SECONDS
+    pendientes = dict(tickets)
+    terminados: Dict[str, Dict[str, Any]] = {}
     while True:
-        st = consultar_estado_ticket(token, per, numTicket)
-        regs = st.get("registros") or []
-        if regs:
-            reg0 = regs[0]
-            if reg0.get("codEstadoProceso") == "06" or (reg0.get("desEstadoProceso") or "").lower() == "terminado":
-                return reg0
+        nuevos = consultar_tickets_terminados(token, pendientes)
+        terminados.update(nuevos)
+        for num in nuevos:
+            pendientes.pop(num, None)
+        if not pendientes:
+            return terminados
+
+        if time.time() - t0 > timeout:
+            raise SireApiError(f"Timeout esperando tickets {', '.join(sorted(pendientes))}")
+        time.sleep(delay)
+        delay = siguiente_espera(delay)
 
-        if time.time() - t0 > POLL_TIMEOUT_SECONDS:
-            raise SireApiError(f"Timeout esperando ticket {numTicket} periodo {per}")
-        time.sleep(POLL_SECONDS)
+def esperar_hasta_terminado(token: str, per: str, numTicket: str) -> Dict[str, Any]:
+    return esperar_tickets_terminados(token, {numTicket: per})[numTicket]
 
 def extraer_params_descarga(registro_ticket: Dict[str, Any]) -> Tuple[str, str, str]:
     cod_proceso = str(registro_ticket.get("codProceso") or "")
@@ -109,17 +197,15 @@ def extraer_params_descarga(registro_ticket: Dict[str, Any]) -> Tuple[str, str,
         raise SireApiError(f"archivoReporte incompleto: {a0}")
     return nom, str(cod_tipo), cod_proceso
 
-def descargar_archivo_reporte(
-    token: str,
+def _params_descarga(
     per: str,
     numTicket: str,
     codProceso: str,
     nomArchivoReporte: str,
     codTipoArchivoReporte: str,
-    codLibro: str = "080000",
-) -> bytes:
-    url = f"{API_BASE}/v1/contribuyente/migeigv/libros/rvierce/gestionprocesosmasivos/web/masivo/archivoreporte"
-    params = {
+    codLibro: str,
+) -> Dict[str, str]:
+    return {
         "nomArchivoReporte": nomArchivoReporte,
         "codTipoArchivoReporte": codTipoArchivoReporte,
         "perTributario": per,
@@ -127,7 +213,60 @@ def descargar_archivo_reporte(
         "numTicket": numTicket,
         "codLibro": codLibro,
     }
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"}, params=params, timeout=HTTP_TIMEOUT)
+
+URL_ARCHIVO_REPORTE = "/v1/contribuyente/migeigv/libros/rvierce/gestionprocesosmasivos/web/masivo/archivoreporte"
+DOWNLOAD_CHUNK_BYTES = 256 * 1024
+
+def descargar_archivo_reporte(
+    token: str,
+    per: str,
+    numTicket: str,
+    codProceso: str,
+    nomArchivoReporte: str,
+    codTipoArchivoReporte: str,
+    codLibro: str = "080000",
+) -> bytes:
+    url = f"{API_BASE}{URL_ARCHIVO_REPORTE}"
+    params = _params_descarga(per, numTicket, codProceso, nomArchivoReporte, codTipoArchivoReporte, codLibro)
+    r = request("GET", url, "descarga", headers={"Authorization": f"Bearer {token}"}, params=params, timeout=HTTP_TIMEOUT)
     if r.status_code >= 400:
         raise SireApiError(_normalize_http_error(r, "descarga"))
     return r.content
+
+def descargar_archivo_reporte_a_disco(
+    token: str,
+    per: str,
+    numTicket: str,
+    codProceso: str,
+    nomArchivoReporte: str,
+    codTipoArchivoReporte: str,
+    dest_path: str,
+    codLibro: str = "080000",
+) -> str:
+    """
+    Descarga en streaming a `dest_path` calculando el SHA-256 por chunks
+    (memoria constante sin importar el tamaño del ZIP). Devuelve el hash hex.
+    Si la descarga falla, no deja archivo a medias.
+    """
+    url = f"{API_BASE}{URL_ARCHIVO_REPORTE}"
+    params = _params_descarga(per, numTicket, codProceso, nomArchivoReporte, codTipoArchivoReporte, codLibro)
+    h = hashlib.sha256()
+    r = request(
+        "GET", url, "descarga",
+        headers={"Authorization": f"Bearer {token}"}, params=params, timeout=HTTP_TIMEOUT, stream=True,
+    )
+    try:
+        if r.status_code >= 400:
+            raise SireApiError(_normalize_http_error(r, "descarga"))
+        with open(dest_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                if chunk:
+                    f.write(chunk)
+                    h.update(chunk)
+    except BaseException:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    finally:
+        r.close()
+    return h.hexdigest()
@@ -0,0 +1,136 @@
+# backend/rce/scripts/bench_ubl.py
+"""
+Micro-benchmark del parseo UBL sobre el XML de ejemplo de la raíz del repo.
+
+Compara:
+  - v1 ET: parse_detalle + parse_resumen + score del selector (3 parseos con `.//{*}`)
+  - ubl etree: un recorrido iterparse (extract_ubl backend ElementTree)
+  - ubl lxml: árbol lxml + XPath compilado (si lxml está instalado)
+También mide una factura "grande" replicando sus líneas (--lines).
+
+Antes de medir verifica, sobre el XML de ejemplo y los fixtures de
+rce/scripts/fixtures (nota de crédito, factura con detracción), que v1 ET, el
+walker etree y lxml den el mismo detalle, resumen y score del selector.
+
+Uso:
+    python -m rce.scripts.bench_ubl
+    python -m rce.scripts.bench_ubl --check       # solo la verificación
+    python -m rce.scripts.bench_ubl --xml /ruta/factura.xml --lines 500 --repeat 200
+"""
+import argparse
+import glob
+import os
+import re
+import tempfile
+import timeit
+import xml.etree.ElementTree as ET
+
+from rce.xml_detail.extractor import parse_detalle
+from rce.xml_detail.resumen import parse_resumen
+from rce.xml_detail.ubl import LET, extract_ubl
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+SAMPLE_XML = os.path.join(_ROOT, "20526422300_F001_100286.xml")
+FIXTURES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "fixtures", "*.xml")))
+
+_LINE_TAGS = ("InvoiceLine", "CreditNoteLine", "DebitNoteLine")
+
+
+def _score_v1(path: str) -> int:
+    # selector._score_xml antes de ubl.py
+    with open(path, "rb") as f:
+        root = ET.fromstring(f.read())
+    lines = []
+    for tag in _LINE_TAGS:
+        lines.extend(root.findall(f".//{{*}}{tag}"))
+    if not lines:
+        return 0
+    for ln in lines:
+        if ln.findall(".//{*}Item") and ln.findall(".//{*}Description"):
+            return 3
+    return 2
+
+
+def check(path: str) -> None:
+    """v1 ET, ubl etree y ubl lxml deben coincidir en detalle (campos v1), resumen y score."""
+    v1_detalle, v1_resumen, v1_score = parse_detalle(path), parse_resumen(path), _score_v1(path)
+    backends = ["etree"] + (["lxml"] if LET is not None else [])
+    outs = {b: extract_ubl(path, b) for b in backends}
+    name = os.path.basename(path)
+    for b, out in outs.items():
+        detalle = {k: v for k, v in out["detalle"].items() if k not in ("document", "tax_subtotals")}
+        assert detalle == v1_detalle, f"{name}: detalle {b} difiere de parse_detalle"
+        assert out["resumen"] == v1_resumen, f"{name}: resumen {b} difiere de parse_resumen"
+        assert out["score"] == v1_score, f"{name}: score {b}={out['score']} vs v1={v1_score}"
+    if "lxml" in outs:
+        assert outs["etree"] == outs["lxml"], f"{name}: etree y lxml difieren"
+    print(f"   ✅ {name}: {', '.join(['v1 ET'] + backends)} coinciden ({len(v1_detalle['lines'])} líneas)")
+
+
+def _v1(path: str) -> None:
+    # lo que se hacía antes por XML: score del selector, detalle y resumen
+    with open(path, "rb") as f:
+        root = ET.fromstring(f.read())
+    for ln in root.findall(".//{*}InvoiceLine"):
+        if ln.findall(".//{*}Item") and ln.findall(".//{*}Description"):
+            break
+    parse_detalle(path)
+    parse_resumen(path)
+
+
+def _big_copy(path: str, lines: int) -> str:
+    """Replica las líneas del XML hasta `lines` (mismo documento, más detalle)."""
+    # en bytes: los XML SUNAT suelen venir en ISO-8859-1
+    with open(path, "rb") as f:
+        xml = f.read()
+    m = re.search(rb"(<(\w+:)?(InvoiceLine|CreditNoteLine|DebitNoteLine)\b.*?</\2\3>)", xml, re.S)
+    if not m:
+        raise SystemExit("El XML no tiene líneas para replicar")
+    block = m.group(1)
+    n = len(re.findall(b"<" + re.escape((m.group(2) or b"") + m.group(3)) + rb"\b", xml))
+    extra = block * max(0, lines - n)
+    idx = xml.rindex(block) + len(block)
+    fd, out = tempfile.mkstemp(suffix=".xml")
+    with os.fdopen(fd, "wb") as f:
+        f.write(xml[:idx] + extra + xml[idx:])
+    return out
+
+
+def _bench(label: str, path: str, repeat: int) -> None:
+    cases = [("v1 ET (3 parseos)", lambda: _v1(path)), ("ubl etree", lambda: extract_ubl(path, "etree"))]
+    if LET is not None:
+        cases.append(("ubl lxml", lambda: extract_ubl(path, "lxml")))
+
+    print(f"\n📄 {label}: {os.path.getsize(path) / 1024:.1f} KB, {repeat} repeticiones")
+    base = None
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=repeat, repeat=3)) / repeat * 1000
+        base = base or best
+        print(f"   {name:<20} {best:8.3f} ms/doc   x{base / best:.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--xml", default=SAMPLE_XML)
+    ap.add_argument("--lines", type=int, default=300, help="Líneas de la factura grande sintética")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--check", action="store_true", help="Solo verificar que los backends coincidan")
+    args = ap.parse_args()
+
+    if LET is None:
+        print("⚠️ lxml no instalado: solo se compara/mide ElementTree")
+    big = _big_copy(args.xml, args.lines)
+    try:
+        print("🔎 Verificando backends")
+        for path in [args.xml, *FIXTURES, big]:
+            check(path)
+        if args.check:
+            return
+        _bench("XML de ejemplo", args.xml, args.repeat)
+        _bench(f"Factura grande ({args.lines} líneas)", big, max(1, args.repeat // 20))
+    finally:
+        os.remove(big)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# backend/rce/scripts/stub_sire.py
+"""
+Mock local del API SIRE (token, ticket de propuesta, estado de tickets y descarga del ZIP)
+para ejercitar la sesión HTTP compartida (pool, reintentos, métricas) sin tocar SUNAT.
+Cada endpoint puede fallar con 503 las primeras N veces (--fail-first) para probar reintentos.
+
+Uso:
+    python -m rce.scripts.stub_sire --port 8766
+    SIRE_API_BASE=http://127.0.0.1:8766 SIRE_AUTH_BASE=http://127.0.0.1:8766 python -m rce.propuesta.run ...
+
+    python -m rce.scripts.stub_sire --selftest   # levanta el stub y recorre el flujo completo
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CSV_SAMPLE = (
+    "CAR SUNAT,Fecha de emisión,Tipo CP/Doc.,Serie del CDP,Nro CP o Doc. Nro Inicial (Rango),"
+    "Nro Doc Identidad,Total CP,Moneda\n"
+    "X1,1/12/2025,01,F001,100286,20526422300,118.00,PEN\n"
+)
+# polls que un ticket queda "en proceso" antes de terminar
+POLLS_UNTIL_DONE = 2
+
+
+class _State:
+    def __init__(self, fail_first: int):
+        self.lock = threading.Lock()
+        self.fail_first = fail_first
+        self.hits = defaultdict(int)
+        self.tickets = {}  # numTicket -> {"per": ..., "polls": n}
+        self.seq = 0
+
+    def should_fail(self, endpoint: str) -> bool:
+        with self.lock:
+            self.hits[endpoint] += 1
+            return self.hits[endpoint] <= self.fail_first
+
+
+def _zip_bytes() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("20000000001-20251200-propuesta.csv", CSV_SAMPLE)
+    return buf.getvalue()
+
+
+def _make_handler(state: _State):
+    class _Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive: el pool reutiliza la conexión
+
+        def _send(self, code: int, body: bytes, content_type: str = "application/json") -> None:
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, code: int, obj) -> None:
+            self._send(code, json.dumps(obj).encode())
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            if "/oauth2/token" not in self.path:
+                return self._json(404, {"msg": "no existe"})
+            if state.should_fail("token"):
+                return self._json(503, {"msg": "stub: servicio no disponible"})
+            return self._json(200, {"access_token": "stub-token", "expires_in": 3600})
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+            path = parts.path
+
+            if path.endswith("/exportacioncomprobantepropuesta"):
+                if state.should_fail("ticket"):
+                    return self._json(503, {"msg": "stub: servicio no disponible"})
+                per = path.split("/propuesta/")[-1].split("/")[0]
+                with state.lock:
+                    state.seq += 1
+                    num = f"2025{state.seq:010d}"
+                    state.tickets[num] = {"per": per, "polls": 0}
+                return self._json(200, {"numTicket": num})
+
+            if path.endswith("/consultaestadotickets"):
+                if state.should_fail("estado"):
+                    return self._json(429, {"msg": "stub: demasiadas solicitudes"})
+                regs = []
+                with state.lock:
+                    for num, t in state.tickets.items():
+                        if q.get("numTicket") and q["numTicket"] != num:
+                            continue
+                        if not (q.get("perIni", "") <= t["per"] <= q.get("perFin", "999999")):
+                            continue
+                        t["polls"] += 1
+                        done = t["polls"] > POLLS_UNTIL_DONE
+                        regs.append({
+                            "numTicket": num,
+                            "perTributario": t["per"],
+                            "codProceso": "10",
+                            "codEstadoProceso": "06" if done else "02",
+                            "desEstadoProceso": "Terminado" if done else "En proceso",
+                            "archivoReporte": [{
+                                "nomArchivoReporte": f"{num}.zip",
+                                "codTipoAchivoReporte": "01",
+                            }] if done else [],
+                        })
+                page, per_page = int(q.get("page", 1)), int(q.get("perPage", 40))
+                chunk = regs[(page - 1) * per_page: page * per_page]
+                return self._json(200, {
+                    "paginacion": {"page": page, "perPage": per_page, "totalRegistros": len(regs)},
+                    "registros": chunk,
+                })
+
+            if path.endswith("/archivoreporte"):
+                if state.should_fail("descarga"):
+                    return self._json(502, {"msg": "stub: bad gateway"})
+                return self._send(200, _zip_bytes(), "application/zip")
+
+            return self._json(404, {"msg": "no existe"})
+
+        def log_message(self, fmt, *args):
+            print(f"  [stub-sire] {self.command} {self.path.split('?')[0]} -> {args[1] if len(args) > 1 else ''}")
+
+    return _Handler
+
+
+def serve(port: int, fail_first: int = 0) -> ThreadingHTTPServer:
+    return ThreadingHTTPServer(("127.0.0.1", port), _make_handler(_State(fail_first)))
+
+
+def _selftest() -> None:
+    server = serve(0, fail_first=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    # la config se lee al importar: apuntamos al stub antes de importar los clientes
+    os.environ["SIRE_API_BASE"] = base
+    os.environ["SIRE_AUTH_BASE"] = base
+    os.environ["SIRE_HTTP_RETRY_BACKOFF"] = "0.05"
+
+    from rce.propuesta import sire_client
+    from rce.propuesta.file_ops import install_zip_and_extract_csv
+    from rce.propuesta.http_session import METRICS
+    from rce.propuesta.sire_auth import get_token_sire
+
+    sire_client.POLL_SECONDS = 0.1
+    try:
+        token, _ = get_token_sire("cid", "secret", "20000000001", "USUARIO", "clave")
+        tickets = {
+            sire_client.generar_ticket_exportacion_propuesta(token, per, "2025-01-01", "2025-12-31"): per
+            for per in ("202511", "202512")
+        }
+        done = sire_client.esperar_tickets_terminados(token, tickets, timeout=30)
+        with tempfile.TemporaryDirectory() as tmp:
+            for num, reg in done.items():
+                nom, cod_tipo, cod_proc = sire_client.extraer_params_descarga(reg)
+                per = tickets[num]
+                part = os.path.join(tmp, f"propuesta_{per}.zip.part")
+                digest = sire_client.descargar_archivo_reporte_a_disco(token, per, num, cod_proc, nom, cod_tipo, part)
+                csv_path = install_zip_and_extract_csv(part, tmp, periodo=per)
+                with open(csv_path, encoding="utf-8") as f:
+                    assert f.read() == CSV_SAMPLE, "CSV extraído distinto"
+                with open(os.path.join(tmp, f"propuesta_{per}.zip"), "rb") as f:
+                    assert digest == hashlib.sha256(f.read()).hexdigest(), "hash incremental distinto"
+        print(f"✅ {len(done)} tickets terminados y descargados (con 1 fallo inicial por endpoint)")
+        print(f"📡 {METRICS.summary()}")
+        assert len(done) == len(tickets)
+    finally:
+        server.shutdown()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8766)
+    ap.add_argument("--fail-first", type=int, default=0, help="Responder error las primeras N llamadas por endpoint")
+    ap.add_argument("--selftest", action="store_true")
+    args = ap.parse_args()
+    if args.selftest:
+        _selftest()
+        return
+    server = serve(args.port, args.fail_first)
+    print(f"🧪 Stub SIRE en http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
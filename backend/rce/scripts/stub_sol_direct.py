@@ -0,0 +1,119 @@
+# backend/rce/scripts/stub_sol_direct.py
+"""
+Servidor stub que imita los endpoints de consulta/descarga usados por el modo directo
+de SolXMLScraper. Sirve el XML de muestra del repo (zipeado) para cualquier comprobante
+cuya serie/número coincida; el resto responde 404.
+
+Uso:
+    python -m rce.scripts.stub_sol_direct --port 8765
+    SOL_XML_DIRECT_MODE=1 SOL_XML_DIRECT_BASE=http://localhost:8765 python -m rce.xml_service.run ...
+
+    python -m rce.scripts.stub_sol_direct --selftest   # levanta el stub y prueba SolDirectClient
+"""
+import argparse
+import io
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from rce.xml_service.config import DIRECT_CONSULTA_PATH, DIRECT_DESCARGA_XML_PATH, DIRECT_DESCARGA_PDF_PATH
+
+_REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+SAMPLE_XML = os.path.join(_REPO_ROOT, "20526422300_F001_100286.xml")
+SAMPLE = {"rucEmisor": "20526422300", "numeroSerie": "F001", "numero": "100286"}
+
+
+def _known(params) -> bool:
+    return all(str(params.get(k, "")) == v for k, v in SAMPLE.items())
+
+
+def _zip_bytes() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.write(SAMPLE_XML, arcname=os.path.basename(SAMPLE_XML))
+    return buf.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _send(self, code: int, body: bytes, content_type: str) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlsplit(self.path).path != DIRECT_CONSULTA_PATH:
+            return self._send(404, b"{}", "application/json")
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send(400, b'{"msg":"json invalido"}', "application/json")
+        if not _known(params):
+            return self._send(200, b'{"encontrado": false}', "application/json")
+        return self._send(200, json.dumps({"encontrado": True, **params}).encode(), "application/json")
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if not _known(params):
+            return self._send(404, b"{}", "application/json")
+        if parts.path == DIRECT_DESCARGA_XML_PATH:
+            return self._send(200, _zip_bytes(), "application/zip")
+        if parts.path == DIRECT_DESCARGA_PDF_PATH:
+            return self._send(200, b"%PDF-1.4\n%stub\n", "application/pdf")
+        return self._send(404, b"{}", "application/json")
+
+    def log_message(self, fmt, *args):
+        print(f"  [stub] {self.command} {self.path}")
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    return ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+
+
+def _selftest() -> None:
+    from rce.sol.consulta_directa import SolDirectClient
+    from rce.sol.consulta_individual import BusquedaComprobante
+
+    server = serve(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    client = SolDirectClient(base, DIRECT_CONSULTA_PATH, DIRECT_DESCARGA_XML_PATH, DIRECT_DESCARGA_PDF_PATH)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            out_dir = os.path.join(tmp, "xml")
+            ok = client.consultar_y_descargar_xml(
+                BusquedaComprobante(ruc_emisor="20526422300", serie="F001", numero="100286"), out_dir
+            )
+            print(f"✅ conocido: ok={ok.ok} xml={ok.xml_path} pdf={ok.pdf_path}")
+            missing = client.consultar_y_descargar_xml(
+                BusquedaComprobante(ruc_emisor="20526422300", serie="F001", numero="999"), out_dir
+            )
+            print(f"✅ inexistente: ok={missing.ok} error={missing.error}")
+            assert ok.ok and os.path.exists(ok.xml_path) and not missing.ok
+    finally:
+        client.close()
+        server.shutdown()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--selftest", action="store_true")
+    args = ap.parse_args()
+    if args.selftest:
+        _selftest()
+        return
+    server = serve(args.port)
+    print(f"🧪 Stub SOL directo en http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
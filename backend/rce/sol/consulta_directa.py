@@ -0,0 +1,146 @@
+# backend/rce/sol/consulta_directa.py
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rce.xml_detail import select_xml_from_zip
+from .consulta_individual import BusquedaComprobante, DescargaResult
+
+
+class DirectNotFound(RuntimeError):
+    """El endpoint respondió pero el comprobante no existe."""
+
+
+class SolDirectClient:
+    """
+    Consulta y descarga de comprobantes llamando directo a los endpoints que usa
+    la app Angular de 'Nueva Consulta de comprobantes de pago'.
+    Reutiliza las cookies (y el Authorization capturado) del contexto del navegador
+    ya logueado; la conexión HTTP se mantiene viva entre comprobantes.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        consulta_path: str,
+        descarga_xml_path: str,
+        descarga_pdf_path: Optional[str] = None,
+        timeout: int = 20,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.consulta_path = consulta_path
+        self.descarga_xml_path = descarga_xml_path
+        self.descarga_pdf_path = descarga_pdf_path
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept": "application/json, text/plain, */*"})
+
+    def close(self) -> None:
+        self.session.close()
+
+    def sync_from_context(self, context, authorization: Optional[str] = None, user_agent: Optional[str] = None) -> None:
+        """Copia cookies/cabeceras de la sesión Playwright al cliente HTTP."""
+        self.session.cookies.clear()
+        for c in context.cookies():
+            self.session.cookies.set(
+                c["name"],
+                c["value"],
+                domain=c.get("domain") or None,
+                path=c.get("path") or "/",
+            )
+        if authorization:
+            self.session.headers["Authorization"] = authorization
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+
+    def _params(self, busqueda: BusquedaComprobante) -> Dict[str, Any]:
+        return {
+            "rucEmisor": busqueda.ruc_emisor,
+            "codComp": busqueda.tipo_cp,
+            "numeroSerie": busqueda.serie,
+            "numero": busqueda.numero,
+            "tipoConsulta": "RECIBIDO",
+        }
+
+    def consultar(self, busqueda: BusquedaComprobante) -> Dict[str, Any]:
+        url = f"{self.base_url}{self.consulta_path}"
+        r = self.session.post(url, json=self._params(busqueda), timeout=self.timeout)
+        if r.status_code == 404:
+            raise DirectNotFound("Comprobante no encontrado (consulta directa)")
+        if r.status_code in (401, 403):
+            raise RuntimeError(f"consulta directa {r.status_code}: sesión no autenticada (login)")
+        if r.status_code >= 400:
+            raise RuntimeError(f"consulta directa {r.status_code}: {(r.text or '')[:200]}")
+        try:
+            j = r.json()
+        except ValueError:
+            raise RuntimeError(f"consulta directa: respuesta no JSON ({(r.text or '')[:200]})")
+        if isinstance(j, dict) and j.get("encontrado") is False:
+            raise DirectNotFound("Comprobante no encontrado (consulta directa)")
+        return j
+
+    def _descargar(self, path: str, busqueda: BusquedaComprobante, dest_path: str) -> None:
+        url = f"{self.base_url}{path}"
+        with self.session.get(url, params=self._params(busqueda), timeout=self.timeout, stream=True) as r:
+            if r.status_code in (401, 403):
+                raise RuntimeError(f"descarga directa {r.status_code}: sesión no autenticada (login)")
+            if r.status_code >= 400:
+                raise RuntimeError(f"descarga directa {r.status_code}: {(r.text or '')[:200]}")
+            with open(dest_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    if chunk:
+                        f.write(chunk)
+
+    def consultar_y_descargar_xml(self, busqueda: BusquedaComprobante, out_dir: str) -> DescargaResult:
+        """
+        Mismo contrato que consultar_y_descargar_xml_individual (flujo UI).
+        El ZIP se procesa con select_xml_from_zip; si el endpoint devuelve XML plano se guarda tal cual.
+        Si SUNAT responde que el comprobante no existe: ok=False, not_found=True.
+        """
+        try:
+            os.makedirs(out_dir, exist_ok=True)
+            self.consultar(busqueda)
+
+            final_name = f"{busqueda.ruc_emisor}_{busqueda.serie}_{busqueda.numero}.xml"
+            fd, tmp_path = tempfile.mkstemp(suffix=".download", dir=out_dir)
+            os.close(fd)
+            try:
+                self._descargar(self.descarga_xml_path, busqueda, tmp_path)
+                with open(tmp_path, "rb") as f:
+                    magic = f.read(4)
+                if magic.startswith(b"PK"):
+                    xml_path = select_xml_from_zip(tmp_path, out_dir=out_dir, final_xml_name=final_name)
+                elif magic.lstrip().startswith(b"<") or magic.startswith(b"\xef\xbb\xbf"):
+                    xml_path = os.path.join(out_dir, final_name)
+                    os.replace(tmp_path, xml_path)
+                else:
+                    raise RuntimeError("descarga directa: contenido no es ZIP ni XML")
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            # PDF opcional (no bloquea el XML)
+            pdf_path = None
+            if self.descarga_pdf_path:
+                try:
+                    pdf_dir = os.path.join(os.path.dirname(out_dir), "pdf")
+                    os.makedirs(pdf_dir, exist_ok=True)
+                    pdf_path = os.path.join(pdf_dir, f"{busqueda.ruc_emisor}_{busqueda.serie}_{busqueda.numero}.pdf")
+                    self._descargar(self.descarga_pdf_path, busqueda, pdf_path)
+                except Exception:
+                    if pdf_path and os.path.exists(pdf_path):
+                        os.remove(pdf_path)
+                    pdf_path = None
+
+            return DescargaResult(ok=True, xml_path=xml_path, pdf_path=pdf_path)
+        except DirectNotFound as e:
+            return DescargaResult(ok=False, error=str(e), not_found=True)
+        except Exception as e:
+            return DescargaResult(ok=False, error=str(e))
@@ -19,6 +19,7 @@ class BusquedaComprobante:
     serie: str
     numero: str
     tipo_label: str = "Factura"  # lo que aparece en el dropdown (PrimeNG)
+    tipo_cp: str = "01"  # código SUNAT (lo usa el modo directo)
 
 @dataclass(frozen=True)
 class DescargaResult:
@@ -26,6 +27,7 @@ class DescargaResult:
     xml_path: Optional[str] = None
     pdf_path: Optional[str] = None
     error: Optional[str] = None
+    not_found: bool = False  # SUNAT respondió que el comprobante no existe (modo directo)
 
 
 def _wait_overlay_gone(frame, timeout_ms: int = 20000) -> bool:
@@ -1,4 +1,19 @@
 from .selector import select_xml_from_zip
-from .extractor import parse_detalle, save_detalle
+from .extractor import parse_detalle, save_detalle, save_detalles_bulk, latest_detalle_clause
+from .resumen import parse_resumen, resumen_to_json, save_resumenes_bulk
+from .ubl import EXTRACTOR_VERSION, EXTRACTOR_VERSIONS, extract_ubl, extract_ubl_file
 
-__all__ = ["select_xml_from_zip", "parse_detalle", "save_detalle"]
+__all__ = [
+    "select_xml_from_zip",
+    "parse_detalle",
+    "save_detalle",
+    "save_detalles_bulk",
+    "latest_detalle_clause",
+    "parse_resumen",
+    "resumen_to_json",
+    "save_resumenes_bulk",
+    "EXTRACTOR_VERSION",
+    "EXTRACTOR_VERSIONS",
+    "extract_ubl",
+    "extract_ubl_file",
+]
@@ -2,9 +2,12 @@ import xml.etree.ElementTree as ET
 from decimal import Decimal, InvalidOperation
 from typing import Dict, Any, List, Optional
 
-from sqlalchemy.orm import Session
+from sqlalchemy import case, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased
 
 from core.database import CPEDetalle
+from .ubl import EXTRACTOR_VERSIONS
 
 
 _LINE_TAGS = ("InvoiceLine", "CreditNoteLine", "DebitNoteLine")
@@ -127,3 +130,51 @@ def save_detalle(
     )
     db.add(row)
     return row
+
+
+def save_detalles_bulk(db: Session, rows: List[Dict[str, Any]], extractor_version: str = "v1") -> None:
+    """
+    Versión en bloque de save_detalle: un solo INSERT ... ON CONFLICT DO UPDATE.
+    rows: [{"propuesta_item_id", "detalle_json", "source_sha256"}] sin items repetidos.
+    """
+    if not rows:
+        return
+    stmt = pg_insert(CPEDetalle).values([
+        {
+            "propuesta_item_id": r["propuesta_item_id"],
+            "extractor_version": extractor_version,
+            "detalle_json": r["detalle_json"],
+            "source_sha256": r.get("source_sha256"),
+        }
+        for r in rows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_cpe_detalle_item_version",
+        set_={
+            "detalle_json": stmt.excluded.detalle_json,
+            "source_sha256": stmt.excluded.source_sha256,
+            "extracted_at": stmt.excluded.extracted_at,
+        },
+    )
+    db.execute(stmt)
+
+
+def latest_detalle_clause():
+    """
+    Condición para quedarse con la extracción más reciente de cada item
+    (p.ej. v2 sobre v1) al hacer join con CPEDetalle.
+    """
+    newer = aliased(CPEDetalle)
+    # orden de EXTRACTOR_VERSIONS; una versión fuera de la lista nunca gana a una conocida
+    rank = case(
+        {v: i for i, v in enumerate(EXTRACTOR_VERSIONS, start=1)},
+        value=newer.extractor_version,
+        else_=0,
+    )
+    return CPEDetalle.extractor_version == (
+        select(newer.extractor_version)
+        .where(newer.propuesta_item_id == CPEDetalle.propuesta_item_id)
+        .order_by(rank.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
@@ -0,0 +1,274 @@
+"""
+Re-extracción masiva de cpe_detalle desde los XML ya descargados.
+
+Recorre cpe_evidencias (tipo XML, status OK) por item_id ascendente, extrae
+en un pool de procesos y hace upsert en bloque bajo `extractor_version`.
+Se saltan los XML cuyo sha256 ya tiene fila para esa versión (salvo --force).
+El avance queda en un checkpoint JSON: si se corta, la siguiente corrida
+continúa desde el último lote confirmado.
+
+Uso:
+    python -m rce.xml_detail.reextract --version v2 [--ruc 20...] [--periodo 202512] [--workers 4]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, exists, func, select
+
+from core.database import db_session, CPEDetalle, CPEEvidencia, RCEPropuestaItem
+from rce.xml_service.config import JOURNAL_DIR, REEXTRACT_BATCH, REEXTRACT_WORKERS
+from .extractor import parse_detalle, save_detalles_bulk
+from .resumen import resumen_to_json, save_resumenes_bulk
+from .ubl import EXTRACTOR_VERSION, extract_ubl
+
+
+def _extract_v1(xml_path: str) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    return parse_detalle(xml_path), None
+
+
+def _extract_v2(xml_path: str) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    doc = extract_ubl(xml_path)
+    return doc["detalle"], resumen_to_json(doc["resumen"])
+
+
+# versión -> extractor (detalle, resumen|None). Agregar aquí las nuevas reglas.
+EXTRACTORS: Dict[str, Callable[[str], Tuple[Dict[str, Any], Optional[Dict[str, Any]]]]] = {
+    "v1": _extract_v1,
+    EXTRACTOR_VERSION: _extract_v2,
+}
+
+
+def _work(args: Tuple[int, str, Optional[str], str]) -> Tuple[int, Optional[str], Any, Any, Optional[str]]:
+    """Corre en el proceso hijo: nada de sesiones DB aquí."""
+    item_id, xml_path, sha256, version = args
+    if not xml_path or not os.path.exists(xml_path):
+        return item_id, sha256, None, None, "archivo no existe"
+    try:
+        detalle, resumen = EXTRACTORS[version](xml_path)
+        return item_id, sha256, detalle, resumen, None
+    except Exception as e:
+        return item_id, sha256, None, None, f"{type(e).__name__}: {e}"
+
+
+def checkpoint_path(version: str, ruc: Optional[str] = None, periodo: Optional[str] = None) -> str:
+    return os.path.join(JOURNAL_DIR, f"reextract_{version}_{ruc or 'all'}_{periodo or 'all'}.json")
+
+
+def load_checkpoint(version: str, ruc: Optional[str] = None, periodo: Optional[str] = None) -> Dict[str, Any]:
+    try:
+        with open(checkpoint_path(version, ruc, periodo), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_checkpoint(path: str, state: Dict[str, Any]) -> None:
+    state["updated_at"] = datetime.now(timezone.utc).isoformat()
+    tmp = f"{path}.part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _candidates_query(db, version: str, ruc: Optional[str], periodo: Optional[str], force: bool):
+    q = db.query(CPEEvidencia.propuesta_item_id, CPEEvidencia.storage_path, CPEEvidencia.sha256).filter(
+        CPEEvidencia.tipo == "XML",
+        CPEEvidencia.status == "OK",
+        CPEEvidencia.storage_path.isnot(None),
+    )
+    if ruc or periodo:
+        q = q.join(RCEPropuestaItem, RCEPropuestaItem.id == CPEEvidencia.propuesta_item_id)
+        if ruc:
+            q = q.filter(RCEPropuestaItem.ruc_empresa == ruc)
+        if periodo:
+            q = q.filter(RCEPropuestaItem.periodo == periodo)
+    if not force:
+        ya_extraido = exists(
+            select(CPEDetalle.id).where(
+                and_(
+                    CPEDetalle.propuesta_item_id == CPEEvidencia.propuesta_item_id,
+                    CPEDetalle.extractor_version == version,
+                    CPEDetalle.source_sha256 == CPEEvidencia.sha256,
+                )
+            )
+        )
+        q = q.filter(~ya_extraido)
+    return q
+
+
+def reextract(
+    version: str = EXTRACTOR_VERSION,
+    ruc: Optional[str] = None,
+    periodo: Optional[str] = None,
+    workers: int = REEXTRACT_WORKERS,
+    batch: int = REEXTRACT_BATCH,
+    force: bool = False,
+    restart: bool = False,
+    stop_event: Optional[threading.Event] = None,
+) -> Dict[str, Any]:
+    """
+    Re-extrae los XML OK en lotes de `batch` items. Devuelve el estado final
+    (el mismo que queda en el checkpoint).
+    """
+    if version not in EXTRACTORS:
+        raise ValueError(f"extractor_version desconocida: {version} (disponibles: {', '.join(EXTRACTORS)})")
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    ckpt = checkpoint_path(version, ruc, periodo)
+
+    prev = {} if restart else load_checkpoint(version, ruc, periodo)
+    resume = prev.get("status") in ("RUNNING", "STOPPED", "ERROR")
+    state: Dict[str, Any] = {
+        "version": version,
+        "ruc": ruc,
+        "periodo": periodo,
+        "force": force,
+        "status": "RUNNING",
+        "last_item_id": prev.get("last_item_id", 0) if resume else 0,
+        "done": prev.get("done", 0) if resume else 0,
+        "ok": prev.get("ok", 0) if resume else 0,
+        "errors": prev.get("errors", 0) if resume else 0,
+        "started_at": prev.get("started_at") if resume else datetime.now(timezone.utc).isoformat(),
+    }
+
+    with db_session() as db:
+        base = _candidates_query(db, version, ruc, periodo, force)
+        pending = base.filter(CPEEvidencia.propuesta_item_id > state["last_item_id"]).with_entities(
+            func.count(CPEEvidencia.id)
+        ).scalar() or 0
+    state["total"] = state["done"] + pending
+    _save_checkpoint(ckpt, state)
+    if resume:
+        print(f"↩️ Re-extracción {version}: retomando desde item_id>{state['last_item_id']} ({state['done']} hechos)")
+    print(f"🔁 Re-extracción {version}: {pending} XML pendientes (workers={workers}, lote={batch})")
+
+    t0 = time.time()
+    done_run = 0
+    ctx = multiprocessing.get_context("spawn")  # seguro aunque el padre tenga hilos (API)
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=ctx) as pool:
+            while True:
+                if stop_event is not None and stop_event.is_set():
+                    state["status"] = "STOPPED"
+                    break
+                with db_session() as db:
+                    rows = (
+                        _candidates_query(db, version, ruc, periodo, force)
+                        .filter(CPEEvidencia.propuesta_item_id > state["last_item_id"])
+                        .order_by(CPEEvidencia.propuesta_item_id.asc())
+                        .limit(batch)
+                        .all()
+                    )
+                if not rows:
+                    state["status"] = "DONE"
+                    break
+
+                args = [(item_id, path, sha, version) for item_id, path, sha in rows]
+                chunksize = max(1, len(args) // (max(1, workers) * 4))
+                detalles: List[Dict[str, Any]] = []
+                resumenes: List[Dict[str, Any]] = []
+                errores = 0
+                for item_id, sha, detalle, resumen, err in pool.map(_work, args, chunksize=chunksize):
+                    if err:
+                        errores += 1
+                        print(f"⚠️ item_id={item_id}: {err}")
+                        continue
+                    detalles.append({"propuesta_item_id": item_id, "detalle_json": detalle, "source_sha256": sha})
+                    if resumen is not None:
+                        resumenes.append({"propuesta_item_id": item_id, "resumen_json": resumen, "source_sha256": sha})
+
+                with db_session() as db:
+                    save_detalles_bulk(db, detalles, extractor_version=version)
+                    save_resumenes_bulk(db, resumenes)
+                    db.commit()
+
+                # checkpoint solo después del commit del lote
+                state["last_item_id"] = rows[-1][0]
+                state["done"] += len(rows)
+                state["ok"] += len(detalles)
+                state["errors"] += errores
+                done_run += len(rows)
+                elapsed = time.time() - t0
+                state["rate_per_s"] = round(done_run / elapsed, 1) if elapsed else None
+                _save_checkpoint(ckpt, state)
+                print(
+                    f"📈 {state['done']}/{state['total']} XML "
+                    f"(ok={state['ok']} err={state['errors']}, {state['rate_per_s']}/s)"
+                )
+    except Exception as e:
+        state["status"] = "ERROR"
+        state["error_message"] = str(e)
+        _save_checkpoint(ckpt, state)
+        raise
+
+    _save_checkpoint(ckpt, state)
+    print(f"🏁 Re-extracción {version} {state['status']}: ok={state['ok']} err={state['errors']} en {time.time() - t0:.1f}s")
+    return state
+
+
+# --- ejecución en segundo plano (API) ---
+
+_bg_lock = threading.Lock()
+_bg_thread: Optional[threading.Thread] = None
+_bg_stop = threading.Event()
+
+
+def is_running() -> bool:
+    return _bg_thread is not None and _bg_thread.is_alive()
+
+
+def start_background(**kwargs: Any) -> bool:
+    """Lanza reextract() en un hilo del proceso API. False si ya hay una en curso."""
+    global _bg_thread
+    with _bg_lock:
+        if is_running():
+            return False
+        _bg_stop.clear()
+
+        def _target():
+            try:
+                reextract(stop_event=_bg_stop, **kwargs)
+            except Exception as e:
+                print(f"❌ Re-extracción falló: {e}")
+
+        _bg_thread = threading.Thread(target=_target, name="xml-reextract", daemon=True)
+        _bg_thread.start()
+        return True
+
+
+def stop_background() -> bool:
+    if not is_running():
+        return False
+    _bg_stop.set()
+    return True
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--version", default=EXTRACTOR_VERSION, choices=sorted(EXTRACTORS))
+    ap.add_argument("--ruc", default=None)
+    ap.add_argument("--periodo", default=None, help="YYYYMM")
+    ap.add_argument("--workers", type=int, default=REEXTRACT_WORKERS)
+    ap.add_argument("--batch", type=int, default=REEXTRACT_BATCH)
+    ap.add_argument("--force", action="store_true", help="Re-extraer aunque el sha256 ya tenga fila para la versión")
+    ap.add_argument("--restart", action="store_true", help="Ignorar el checkpoint y empezar desde el inicio")
+    args = ap.parse_args()
+    reextract(
+        version=args.version,
+        ruc=args.ruc,
+        periodo=args.periodo,
+        workers=args.workers,
+        batch=args.batch,
+        force=args.force,
+        restart=args.restart,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,158 +1,22 @@
 import os
-import xml.etree.ElementTree as ET
-from decimal import Decimal, InvalidOperation
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Dict, Any, List, Optional
 
 import pandas as pd
+from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
-from core.database import Empresa, RCEPropuestaItem, CPEDetalle, CPEEvidencia
+from core.database import Empresa, RCEPropuestaItem, CPEDetalle, CPEEvidencia, CPEResumen
 from rce.xml_service.config import REGISTROS_DIR
+from .extractor import latest_detalle_clause
+from .resumen import resumen_from_json, resumen_to_json, save_resumenes_bulk
+from .ubl import extract_ubl_file
 
 
-def _report_path(ruc: str, periodo: str) -> str:
+def report_path(ruc: str, periodo: str) -> str:
+    """Ruta lógica del reporte (la que se pide por /files/download); el archivo vive en la cache."""
     base_dir = os.path.join(REGISTROS_DIR, "periodos", periodo, ruc, f"reporte_{periodo}")
-    os.makedirs(base_dir, exist_ok=True)
     return os.path.join(base_dir, f"reporte_{periodo}.xlsx")
 
-def _text(elem: Optional[ET.Element]) -> str:
-    if elem is None or elem.text is None:
-        return ""
-    return elem.text.strip()
-
-def _dec(val: str) -> Decimal:
-    if not val:
-        return Decimal("0")
-    try:
-        return Decimal(val)
-    except InvalidOperation:
-        return Decimal("0")
-
-def _split_id(doc_id: str) -> Tuple[str, str]:
-    if "-" not in doc_id:
-        return doc_id, ""
-    parts = doc_id.split("-", 1)
-    return parts[0], parts[1]
-
-def _sum_tax_subtotals(root: ET.Element) -> Dict[str, Decimal]:
-    totals = {
-        "nbase1": Decimal("0"),
-        "nigv1": Decimal("0"),
-        "nina": Decimal("0"),
-        "nexo": Decimal("0"),
-        "nisc": Decimal("0"),
-        "nicbper": Decimal("0"),
-    }
-
-    for sub in root.findall(".//{*}TaxSubtotal"):
-        scheme_id = _text(sub.find(".//{*}TaxScheme/{*}ID"))
-        reason = _text(sub.find(".//{*}TaxCategory/{*}TaxExemptionReasonCode"))
-        base = _dec(_text(sub.find("./{*}TaxableAmount")))
-        tax = _dec(_text(sub.find("./{*}TaxAmount")))
-
-        if scheme_id == "1000":
-            if reason == "10":
-                totals["nbase1"] += base
-                totals["nigv1"] += tax
-            elif reason.startswith("30"):
-                totals["nina"] += base
-            elif reason.startswith("20"):
-                totals["nexo"] += base
-        elif scheme_id == "2000":
-            totals["nisc"] += tax
-        elif scheme_id == "7152":
-            totals["nicbper"] += tax
-
-    return totals
-
-def _modo_from_xml(root: ET.Element) -> str:
-    # Anticipo si hay PrepaidPayment
-    if root.find(".//{*}PrepaidPayment/{*}PaidAmount") is not None:
-        return "A"
-    # No forzar modo si hay mezcla (default vacío)
-    return ""
-
-def _has_detraccion(root: ET.Element) -> bool:
-    for pt in root.findall(".//{*}PaymentTerms"):
-        if _text(pt.find("./{*}ID")).strip().lower() == "detraccion":
-            amt = _text(pt.find("./{*}Amount"))
-            pct = _text(pt.find("./{*}PaymentPercent"))
-            means = _text(pt.find("./{*}PaymentMeansID"))
-            if amt or pct or means:
-                return True
-            return True
-    for pm in root.findall(".//{*}PaymentMeans"):
-        if _text(pm.find("./{*}ID")).strip().lower() == "detraccion":
-            acct = _text(pm.find(".//{*}PayeeFinancialAccount/{*}ID"))
-            if acct:
-                return True
-    return False
-
-def _extract_summary(xml_path: str, ruc_empresa: str, razon_social: Optional[str]) -> Dict[str, Any]:
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    issue_date = _text(root.find(".//{*}IssueDate"))
-    due_date = _text(root.find(".//{*}DueDate"))
-    doc_id = _text(root.find(".//{*}ID"))
-    serie, numero = _split_id(doc_id)
-    doc_type = _text(root.find(".//{*}InvoiceTypeCode"))
-    currency = _text(root.find(".//{*}DocumentCurrencyCode"))
-
-    supplier_id = _text(root.find(".//{*}AccountingSupplierParty//{*}ID"))
-    supplier_name = _text(root.find(".//{*}AccountingSupplierParty//{*}RegistrationName"))
-
-    customer_id = _text(root.find(".//{*}AccountingCustomerParty//{*}ID"))
-    customer_name = _text(root.find(".//{*}AccountingCustomerParty//{*}RegistrationName"))
-
-    ntots = _dec(_text(root.find(".//{*}LegalMonetaryTotal/{*}PayableAmount")))
-    totals = _sum_tax_subtotals(root)
-
-    modo = _modo_from_xml(root)
-    ffechaven2 = due_date or issue_date
-    detraccion = _has_detraccion(root)
-    detrac_flag = "D" if detraccion else ""
-
-    return {
-        "ffechadoc": issue_date,
-        "ffechaven": due_date,
-        "ccoddoc": doc_type,
-        "ccoddas": "",
-        "cyeardas": "",
-        "cserie": serie,
-        "cnumero": numero,
-        "ccodenti": doc_type,
-        "cdesenti": "Mi Organizacion",
-        "ctipdoc": "6",
-        "ccodruc": supplier_id,
-        "crazsoc": supplier_name,
-        "ccodclas": modo,
-        "nbase1": totals["nbase1"],
-        "nigv1": totals["nigv1"],
-        "nbase2": Decimal("0"),
-        "nigv2": Decimal("0"),
-        "nbase3": Decimal("0"),
-        "nigv3": Decimal("0"),
-        "nina": totals["nina"],
-        "nisc": totals["nisc"],
-        "nicbper": totals["nicbper"],
-        "nexo": totals["nexo"],
-        "ntots": ntots,
-        "cdocnodom": "",
-        "cnumdere": detrac_flag,
-        "ffecre": detrac_flag,
-        "ntc": Decimal("0"),
-        "freffec": "",
-        "crefdoc": "",
-        "crefser": "",
-        "crefnum": "",
-        "cmreg": "S",
-        "ndolar": Decimal("0"),
-        "ffechaven2": ffechaven2,
-        "moneda": currency,
-    }
-
-
 def _flatten_item(
     item: RCEPropuestaItem,
     empresa: Optional[Empresa],
@@ -210,16 +74,22 @@ def build_reporte_detalle(
     db: Session,
     ruc: str,
     periodo: str,
+    path: Optional[str] = None,
 ) -> Dict[str, Any]:
     """
-    Genera (o sobreescribe) el Excel consolidado por empresa/periodo.
-    Solo incluye comprobantes con detalle (CPEDetalle).
+    Genera (o sobreescribe) el Excel consolidado por empresa/periodo en `path`
+    (por defecto la ruta lógica). Solo incluye comprobantes con detalle (CPEDetalle).
+    Para servirlo usar rce.derived_files.reporte_xlsx, que lo cachea por contenido.
+
+    Incremental: la fila Resumen de cada XML sale de cpe_resumen; solo se vuelve
+    a parsear el XML si falta o si su sha256 cambió, y lo recalculado se guarda.
     """
     q = (
-        db.query(RCEPropuestaItem, CPEDetalle, Empresa, CPEEvidencia)
-        .join(CPEDetalle, CPEDetalle.propuesta_item_id == RCEPropuestaItem.id)
+        db.query(RCEPropuestaItem, CPEDetalle, Empresa, CPEEvidencia, CPEResumen)
+        .join(CPEDetalle, and_(CPEDetalle.propuesta_item_id == RCEPropuestaItem.id, latest_detalle_clause()))
         .join(Empresa, Empresa.ruc == RCEPropuestaItem.ruc_empresa)
         .outerjoin(CPEEvidencia, CPEEvidencia.propuesta_item_id == RCEPropuestaItem.id)
+        .outerjoin(CPEResumen, CPEResumen.propuesta_item_id == RCEPropuestaItem.id)
         .filter(RCEPropuestaItem.ruc_empresa == ruc, RCEPropuestaItem.periodo == periodo)
         .filter(CPEEvidencia.tipo == "XML")
         .order_by(RCEPropuestaItem.id.asc())
@@ -227,12 +97,30 @@ def build_reporte_detalle(
 
     rows: List[Dict[str, Any]] = []
     resumen_rows: List[Dict[str, Any]] = []
-    for item, det, emp, ev in q.all():
+    recalculados: List[Dict[str, Any]] = []
+    for item, det, emp, ev, res in q.all():
         rows.extend(_flatten_item(item, emp, det.detalle_json or {}))
-        if ev and ev.storage_path and os.path.exists(ev.storage_path):
-            resumen_rows.append(_extract_summary(ev.storage_path, item.ruc_empresa, emp.razon_social if emp else None))
-
-    path = _report_path(ruc, periodo)
+        if not ev:
+            continue
+        if res and ev.sha256 and res.source_sha256 == ev.sha256:
+            resumen_rows.append(resumen_from_json(res.resumen_json))
+        elif ev.storage_path and os.path.exists(ev.storage_path):
+            resumen = extract_ubl_file(ev.storage_path)["resumen"]
+            resumen_rows.append(resumen)
+            recalculados.append({
+                "propuesta_item_id": item.id,
+                "resumen_json": resumen_to_json(resumen),
+                "source_sha256": ev.sha256,
+            })
+
+    if recalculados:
+        save_resumenes_bulk(db, recalculados)
+        db.commit()
+        print(f"🧮 Resumen {ruc}/{periodo}: {len(recalculados)} XML recalculados, {len(resumen_rows) - len(recalculados)} reutilizados")
+
+    if path is None:
+        path = report_path(ruc, periodo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
     df_detalle = pd.DataFrame(
         rows,
         columns=[
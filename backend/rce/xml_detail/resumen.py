@@ -0,0 +1,226 @@
+import xml.etree.ElementTree as ET
+from decimal import Decimal, InvalidOperation
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from core.database import CPEResumen
+
+NUMERIC_FIELDS = (
+    "nbase1", "nigv1", "nbase2", "nigv2", "nbase3", "nigv3",
+    "nina", "nisc", "nicbper", "nexo", "ntots", "ntc", "ndolar",
+)
+
+
+def _text(elem: Optional[ET.Element]) -> str:
+    if elem is None or elem.text is None:
+        return ""
+    return elem.text.strip()
+
+def _dec(val: str) -> Decimal:
+    if not val:
+        return Decimal("0")
+    try:
+        return Decimal(val)
+    except InvalidOperation:
+        return Decimal("0")
+
+def _split_id(doc_id: str) -> Tuple[str, str]:
+    if "-" not in doc_id:
+        return doc_id, ""
+    parts = doc_id.split("-", 1)
+    return parts[0], parts[1]
+
+def sum_tax_subtotals(subtotals: Iterable[Tuple[str, str, str, str]]) -> Dict[str, Decimal]:
+    """Acumula (scheme_id, reason_code, taxable_amount, tax_amount) por tipo de tributo."""
+    totals = {
+        "nbase1": Decimal("0"),
+        "nigv1": Decimal("0"),
+        "nina": Decimal("0"),
+        "nexo": Decimal("0"),
+        "nisc": Decimal("0"),
+        "nicbper": Decimal("0"),
+    }
+
+    for scheme_id, reason, base_txt, tax_txt in subtotals:
+        base = _dec(base_txt)
+        tax = _dec(tax_txt)
+
+        if scheme_id == "1000":
+            if reason == "10":
+                totals["nbase1"] += base
+                totals["nigv1"] += tax
+            elif reason.startswith("30"):
+                totals["nina"] += base
+            elif reason.startswith("20"):
+                totals["nexo"] += base
+        elif scheme_id == "2000":
+            totals["nisc"] += tax
+        elif scheme_id == "7152":
+            totals["nicbper"] += tax
+
+    return totals
+
+def _sum_tax_subtotals(root: ET.Element) -> Dict[str, Decimal]:
+    return sum_tax_subtotals(
+        (
+            _text(sub.find(".//{*}TaxScheme/{*}ID")),
+            _text(sub.find(".//{*}TaxCategory/{*}TaxExemptionReasonCode")),
+            _text(sub.find("./{*}TaxableAmount")),
+            _text(sub.find("./{*}TaxAmount")),
+        )
+        for sub in root.findall(".//{*}TaxSubtotal")
+    )
+
+def _modo_from_xml(root: ET.Element) -> str:
+    # Anticipo si hay PrepaidPayment
+    if root.find(".//{*}PrepaidPayment/{*}PaidAmount") is not None:
+        return "A"
+    # No forzar modo si hay mezcla (default vacío)
+    return ""
+
+def _has_detraccion(root: ET.Element) -> bool:
+    for pt in root.findall(".//{*}PaymentTerms"):
+        if _text(pt.find("./{*}ID")).strip().lower() == "detraccion":
+            amt = _text(pt.find("./{*}Amount"))
+            pct = _text(pt.find("./{*}PaymentPercent"))
+            means = _text(pt.find("./{*}PaymentMeansID"))
+            if amt or pct or means:
+                return True
+            return True
+    for pm in root.findall(".//{*}PaymentMeans"):
+        if _text(pm.find("./{*}ID")).strip().lower() == "detraccion":
+            acct = _text(pm.find(".//{*}PayeeFinancialAccount/{*}ID"))
+            if acct:
+                return True
+    return False
+
+def parse_resumen(xml_path: str) -> Dict[str, Any]:
+    """
+    Fila de la hoja Resumen para un XML. Solo depende del XML, así que se guarda
+    en cpe_resumen junto al source_sha256 y se reutiliza mientras no cambie.
+    Montos como Decimal; usar resumen_to_json para persistir.
+    """
+    tree = ET.parse(xml_path)
+    root = tree.getroot()
+
+    issue_date = _text(root.find(".//{*}IssueDate"))
+    due_date = _text(root.find(".//{*}DueDate"))
+    doc_id = _text(root.find(".//{*}ID"))
+    doc_type = _text(root.find(".//{*}InvoiceTypeCode"))
+    currency = _text(root.find(".//{*}DocumentCurrencyCode"))
+
+    supplier_id = _text(root.find(".//{*}AccountingSupplierParty//{*}ID"))
+    supplier_name = _text(root.find(".//{*}AccountingSupplierParty//{*}RegistrationName"))
+
+    return build_resumen(
+        issue_date=issue_date,
+        due_date=due_date,
+        doc_id=doc_id,
+        doc_type=doc_type,
+        currency=currency,
+        supplier_id=supplier_id,
+        supplier_name=supplier_name,
+        payable=_text(root.find(".//{*}LegalMonetaryTotal/{*}PayableAmount")),
+        totals=_sum_tax_subtotals(root),
+        modo=_modo_from_xml(root),
+        detraccion=_has_detraccion(root),
+    )
+
+
+def build_resumen(
+    issue_date: str,
+    due_date: str,
+    doc_id: str,
+    doc_type: str,
+    currency: str,
+    supplier_id: str,
+    supplier_name: str,
+    payable: str,
+    totals: Dict[str, Decimal],
+    modo: str,
+    detraccion: bool,
+) -> Dict[str, Any]:
+    """Arma la fila Resumen a partir de los campos ya leídos del XML (ET o ubl.extract_ubl)."""
+    serie, numero = _split_id(doc_id)
+    ntots = _dec(payable)
+    ffechaven2 = due_date or issue_date
+    detrac_flag = "D" if detraccion else ""
+
+    return {
+        "ffechadoc": issue_date,
+        "ffechaven": due_date,
+        "ccoddoc": doc_type,
+        "ccoddas": "",
+        "cyeardas": "",
+        "cserie": serie,
+        "cnumero": numero,
+        "ccodenti": doc_type,
+        "cdesenti": "Mi Organizacion",
+        "ctipdoc": "6",
+        "ccodruc": supplier_id,
+        "crazsoc": supplier_name,
+        "ccodclas": modo,
+        "nbase1": totals["nbase1"],
+        "nigv1": totals["nigv1"],
+        "nbase2": Decimal("0"),
+        "nigv2": Decimal("0"),
+        "nbase3": Decimal("0"),
+        "nigv3": Decimal("0"),
+        "nina": totals["nina"],
+        "nisc": totals["nisc"],
+        "nicbper": totals["nicbper"],
+        "nexo": totals["nexo"],
+        "ntots": ntots,
+        "cdocnodom": "",
+        "cnumdere": detrac_flag,
+        "ffecre": detrac_flag,
+        "ntc": Decimal("0"),
+        "freffec": "",
+        "crefdoc": "",
+        "crefser": "",
+        "crefnum": "",
+        "cmreg": "S",
+        "ndolar": Decimal("0"),
+        "ffechaven2": ffechaven2,
+        "moneda": currency,
+    }
+
+
+def resumen_to_json(resumen: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: (str(v) if isinstance(v, Decimal) else v) for k, v in resumen.items()}
+
+
+def resumen_from_json(data: Dict[str, Any]) -> Dict[str, Any]:
+    out = dict(data)
+    for k in NUMERIC_FIELDS:
+        if k in out:
+            out[k] = _dec(out[k] or "")
+    return out
+
+
+def save_resumenes_bulk(db: Session, rows: List[Dict[str, Any]]) -> None:
+    """
+    Upsert en bloque de cpe_resumen.
+    rows: [{"propuesta_item_id", "resumen_json", "source_sha256"}] sin items repetidos.
+    """
+    if not rows:
+        return
+    stmt = pg_insert(CPEResumen).values([
+        {
+            "propuesta_item_id": r["propuesta_item_id"],
+            "resumen_json": r["resumen_json"],
+            "source_sha256": r.get("source_sha256"),
+        }
+        for r in rows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_cpe_resumen_item",
+        set_={
+            "resumen_json": stmt.excluded.resumen_json,
+            "source_sha256": stmt.excluded.source_sha256,
+            "extracted_at": stmt.excluded.extracted_at,
+        },
+    )
+    db.execute(stmt)
@@ -1,13 +1,7 @@
 import os
 import zipfile
-import xml.etree.ElementTree as ET
 
-
-_LINE_TAGS = (
-    "InvoiceLine",
-    "CreditNoteLine",
-    "DebitNoteLine",
-)
+from .ubl import extract_ubl_bytes
 
 
 def _score_xml(xml_bytes: bytes) -> int:
@@ -15,25 +9,13 @@ def _score_xml(xml_bytes: bytes) -> int:
     Puntaje simple para elegir el XML con detalle.
     +2 si hay líneas (Invoice/Credit/Debit)
     +1 si hay descripciones dentro de ítems
+    El recorrido queda en la cache de ubl, así el extractor no vuelve a parsear.
     """
     try:
-        root = ET.fromstring(xml_bytes)
+        return extract_ubl_bytes(xml_bytes)["score"]
     except Exception:
         return -1
 
-    score = 0
-    lines = []
-    for tag in _LINE_TAGS:
-        lines.extend(root.findall(f".//{{*}}{tag}"))
-    if lines:
-        score += 2
-        for ln in lines:
-            if ln.findall(".//{*}Item") and ln.findall(".//{*}Description"):
-                score += 1
-                break
-
-    return score
-
 
 def select_xml_from_zip(zip_path: str, out_dir: str, final_xml_name: str) -> str:
     """
@@ -0,0 +1,451 @@
+import hashlib
+import io
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Union
+
+from rce.xml_service.config import XML_PARSER_BACKEND
+from .resumen import build_resumen, sum_tax_subtotals
+
+try:  # opcional: XPath compilado en C; sin lxml se usa ElementTree
+    from lxml import etree as LET
+except ImportError:  # pragma: no cover
+    LET = None
+
+# v2 = v1 (issue_date/currency/totals/lines) + document + tax_subtotals.
+# La hoja Resumen sale del mismo recorrido (cpe_resumen).
+# De más vieja a más nueva: define cuál gana si un item tiene varias extracciones
+# (comparar los strings pondría "v10" antes que "v9"). Las nuevas van al final.
+EXTRACTOR_VERSIONS = ("v1", "v2")
+EXTRACTOR_VERSION = EXTRACTOR_VERSIONS[-1]
+
+_LINE_TAGS = ("InvoiceLine", "CreditNoteLine", "DebitNoteLine")
+_QTY_TAGS = ("InvoicedQuantity", "CreditedQuantity", "DebitedQuantity")
+
+BACKEND = "lxml" if LET is not None and XML_PARSER_BACKEND in ("auto", "lxml") else "etree"
+
+# el selector ya recorrió el XML elegido del ZIP: el job lo reutiliza por sha256
+_CACHE_MAX = 64
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _dec(val: Optional[str]) -> Optional[str]:
+    if val is None:
+        return None
+    try:
+        return str(Decimal(val))
+    except InvalidOperation:
+        return val
+
+
+def _line_row(f: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """Línea de detalle (formato v1) a partir de los primeros valores hallados en la línea."""
+
+    def _v(key: str) -> Optional[str]:
+        return f.get(key) or None
+
+    qty = _v("InvoicedQuantity") or _v("CreditedQuantity") or _v("DebitedQuantity")
+    line_net = _v("LineExtensionAmount")
+    line_igv = _v("TaxTotal/TaxAmount")
+    total_line = None
+    if line_net and line_igv:
+        try:
+            total_line = str(Decimal(line_net) + Decimal(line_igv))
+        except InvalidOperation:
+            total_line = None
+
+    return {
+        "description": _v("Description"),
+        "quantity": _dec(qty),
+        "unit_value": _dec(_v("Price/PriceAmount")),
+        "unit_price_igv": _dec(f.get("unit_price_igv")),
+        "line_net": _dec(line_net),
+        "line_igv": _dec(line_igv),
+        "line_total": _dec(total_line),
+    }
+
+
+class _Walker:
+    """
+    Estado del recorrido único (iterparse start/end) sobre un documento UBL.
+
+    Reproduce las búsquedas de selector/extractor/resumen (`.//{*}X`, `./{*}X`):
+    cada campo se toma de la primera aparición en orden de documento y con el
+    mismo contexto (padre/ancestro) que usaban las consultas ElementTree.
+    """
+
+    def __init__(self):
+        self.stack: List[str] = []
+        self.first: Dict[str, str] = {}
+        self.lines: List[Dict[str, Any]] = []
+        self.subtotals: List[Dict[str, Any]] = []
+        self.score_item_desc = False
+        self.prepaid = False
+        self.detraccion = False
+        self._line: Optional[Dict[str, Any]] = None
+        self._sub: Optional[Dict[str, Any]] = None
+        self._alt: Optional[Dict[str, str]] = None
+        self._terms: Optional[Dict[str, str]] = None
+        self._means: Optional[Dict[str, str]] = None
+
+    def _in(self, name: str) -> bool:
+        return name in self.stack
+
+    def start(self, name: str) -> None:
+        if name in _LINE_TAGS and self._line is None:
+            self._line = {"tag": name, "depth": len(self.stack), "first": {}, "item": False, "desc": False, "alt_done": False}
+        elif name == "Item" and self._line is not None:
+            self._line["item"] = True
+        elif name == "TaxSubtotal" and self._sub is None:
+            self._sub = {"depth": len(self.stack), "first": {}, "scope": "line" if self._line is not None else "doc"}
+        elif name == "AlternativeConditionPrice" and self._line is not None and self.stack and self.stack[-1] == "PricingReference":
+            self._alt = {}
+        elif name == "PaymentTerms" and self._terms is None:
+            self._terms = {"depth": len(self.stack)}
+        elif name == "PaymentMeans" and self._means is None:
+            self._means = {"depth": len(self.stack)}
+        self.stack.append(name)
+
+    def end(self, name: str, text: str) -> None:
+        self.stack.pop()
+        parent = self.stack[-1] if self.stack else ""
+        depth = len(self.stack)
+
+        # --- cabecera (primera aparición en todo el documento) ---
+        if name in ("DocumentCurrencyCode", "IssueDate", "DueDate", "InvoiceTypeCode", "ID"):
+            self.first.setdefault(name, text)
+        if name in ("ID", "RegistrationName"):
+            for party in ("AccountingSupplierParty", "AccountingCustomerParty"):
+                if self._in(party):
+                    self.first.setdefault(f"{party}/{name}", text)
+        if name == "TaxAmount" and parent == "TaxTotal":
+            self.first.setdefault("TaxTotal/TaxAmount", text)
+        if name == "PayableAmount" and parent == "LegalMonetaryTotal":
+            self.first.setdefault("LegalMonetaryTotal/PayableAmount", text)
+        if name == "PaidAmount" and parent == "PrepaidPayment":
+            self.prepaid = True
+
+        # --- línea ---
+        ln = self._line
+        if ln is not None:
+            f = ln["first"]
+            if name == "Description":
+                ln["desc"] = True
+                f.setdefault("Description", text)
+            elif name in _QTY_TAGS:
+                f.setdefault(name, text)
+            elif name == "PriceAmount" and parent == "Price":
+                f.setdefault("Price/PriceAmount", text)
+            elif name == "LineExtensionAmount" and depth == ln["depth"] + 1:
+                f.setdefault("LineExtensionAmount", text)
+            elif name == "TaxAmount" and parent == "TaxTotal" and depth == ln["depth"] + 2:
+                f.setdefault("TaxTotal/TaxAmount", text)
+
+            if self._alt is not None and parent == "AlternativeConditionPrice" and name in ("PriceTypeCode", "PriceAmount"):
+                self._alt.setdefault(name, text)
+            elif name == "AlternativeConditionPrice" and self._alt is not None:
+                if not ln["alt_done"] and self._alt.get("PriceTypeCode") == "01":
+                    f["unit_price_igv"] = self._alt.get("PriceAmount") or None
+                    ln["alt_done"] = True
+                self._alt = None
+
+            if name == ln["tag"] and depth == ln["depth"]:
+                self._close_line()
+
+        # --- subtotales de impuestos ---
+        sub = self._sub
+        if sub is not None:
+            f = sub["first"]
+            if name == "ID" and parent == "TaxScheme":
+                f.setdefault("scheme_id", text)
+            elif name == "TaxExemptionReasonCode" and parent == "TaxCategory":
+                f.setdefault("reason", text)
+            elif name == "TaxableAmount" and depth == sub["depth"] + 1:
+                f.setdefault("base", text)
+            elif name == "TaxAmount" and depth == sub["depth"] + 1:
+                f.setdefault("tax", text)
+            elif name == "TaxSubtotal" and depth == sub["depth"]:
+                self.subtotals.append({
+                    "scheme_id": f.get("scheme_id", ""),
+                    "reason": f.get("reason", ""),
+                    "taxable_amount": f.get("base", ""),
+                    "tax_amount": f.get("tax", ""),
+                    "scope": sub["scope"],
+                })
+                self._sub = None
+
+        # --- detracción ---
+        terms = self._terms
+        if terms is not None:
+            if name == "ID" and depth == terms["depth"] + 1:
+                terms.setdefault("id", text)
+            elif name == "PaymentTerms" and depth == terms["depth"]:
+                if terms.get("id", "").lower() == "detraccion":
+                    self.detraccion = True
+                self._terms = None
+        means = self._means
+        if means is not None:
+            if name == "ID" and depth == means["depth"] + 1:
+                means.setdefault("id", text)
+            elif name == "ID" and parent == "PayeeFinancialAccount":
+                means.setdefault("acct", text)
+            elif name == "PaymentMeans" and depth == means["depth"]:
+                if means.get("id", "").lower() == "detraccion" and means.get("acct"):
+                    self.detraccion = True
+                self._means = None
+
+    def _close_line(self) -> None:
+        ln = self._line
+        if ln["item"] and ln["desc"]:
+            self.score_item_desc = True
+        self.lines.append(_line_row(ln["first"]))
+        self._line = None
+
+    @property
+    def score(self) -> int:
+        # mismo criterio que selector._score_xml
+        if not self.lines:
+            return 0
+        return 3 if self.score_item_desc else 2
+
+
+CBC_NS = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+CAC_NS = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+
+if LET is not None:
+    _NS = {"cbc": CBC_NS, "cac": CAC_NS}
+    _PARSER = LET.XMLParser(resolve_entities=False, no_network=True, remove_comments=True)
+    _C = "{%s}" % CBC_NS
+    _A = "{%s}" % CAC_NS
+
+    def _xp(expr: str):
+        return LET.XPath(expr, namespaces=_NS)
+
+    # cabecera: find() (ElementPath) corta en la primera coincidencia, igual que el ET original
+    _DOC_PATHS = {
+        "DocumentCurrencyCode": f".//{_C}DocumentCurrencyCode",
+        "IssueDate": f".//{_C}IssueDate",
+        "DueDate": f".//{_C}DueDate",
+        "InvoiceTypeCode": f".//{_C}InvoiceTypeCode",
+        "ID": f".//{_C}ID",
+        "TaxTotal/TaxAmount": f".//{_A}TaxTotal/{_C}TaxAmount",
+        "LegalMonetaryTotal/PayableAmount": f".//{_A}LegalMonetaryTotal/{_C}PayableAmount",
+    }
+    _PARTIES = ("AccountingSupplierParty", "AccountingCustomerParty")
+
+    _X_LINES = _xp(".//cac:InvoiceLine | .//cac:CreditNoteLine | .//cac:DebitNoteLine")
+    # un solo XPath por línea: los nodos vuelven en orden de documento y se
+    # clasifican por nombre (cada nombre solo puede venir de su ruta)
+    _X_LINE_FIELDS = _xp(
+        ".//cbc:Description | .//cbc:InvoicedQuantity | .//cbc:CreditedQuantity | .//cbc:DebitedQuantity"
+        " | .//cac:Price/cbc:PriceAmount | cbc:LineExtensionAmount | cac:TaxTotal/cbc:TaxAmount | .//cac:Item"
+    )
+    _LINE_KEYS = {
+        "PriceAmount": "Price/PriceAmount",
+        "TaxAmount": "TaxTotal/TaxAmount",
+    }
+    _X_ALT_01 = _xp(
+        "(.//cac:PricingReference/cac:AlternativeConditionPrice"
+        "[normalize-space(cbc:PriceTypeCode[1])='01'])[1]/cbc:PriceAmount"
+    )
+    _X_SUBTOTALS = _xp(".//cac:TaxSubtotal")
+    _X_LINE_SUBTOTALS = _xp(
+        ".//cac:InvoiceLine//cac:TaxSubtotal | .//cac:CreditNoteLine//cac:TaxSubtotal | .//cac:DebitNoteLine//cac:TaxSubtotal"
+    )
+    _X_SUB_FIELDS = _xp(
+        ".//cac:TaxScheme/cbc:ID | .//cac:TaxCategory/cbc:TaxExemptionReasonCode | cbc:TaxableAmount | cbc:TaxAmount"
+    )
+    _SUB_KEYS = {
+        "ID": "scheme_id",
+        "TaxExemptionReasonCode": "reason",
+        "TaxableAmount": "taxable_amount",
+        "TaxAmount": "tax_amount",
+    }
+    _X_PREPAID = _xp("boolean(.//cac:PrepaidPayment/cbc:PaidAmount)")
+    _X_TERMS_IDS = _xp(".//cac:PaymentTerms/cbc:ID[1]")
+    _X_MEANS = _xp(".//cac:PaymentMeans")
+
+
+def _ltext(el) -> str:
+    return (el.text or "").strip() if el is not None else ""
+
+
+def _extract_lxml(source: Union[str, bytes]) -> Optional[Dict[str, Any]]:
+    """
+    Backend lxml: árbol en C + XPath compilado con los namespaces UBL (cbc/cac).
+    None si el documento no usa esos namespaces (se cae al walker ET, que
+    busca por nombre local como el `{*}` original).
+    """
+    if isinstance(source, (bytes, bytearray)):
+        root = LET.fromstring(bytes(source), _PARSER)
+    else:
+        root = LET.parse(source, _PARSER).getroot()
+    if CBC_NS not in root.nsmap.values():
+        return None
+
+    first: Dict[str, str] = {}
+    for key, path in _DOC_PATHS.items():
+        el = root.find(path)
+        if el is not None:
+            first[key] = _ltext(el)
+    for party in _PARTIES:
+        node = root.find(f".//{_A}{party}")
+        if node is None:
+            continue
+        for name in ("ID", "RegistrationName"):
+            el = node.find(f".//{_C}{name}")
+            if el is not None:
+                first[f"{party}/{name}"] = _ltext(el)
+
+    lines = []
+    score_item_desc = False
+    for ln in _X_LINES(root):
+        f: Dict[str, Optional[str]] = {}
+        has_item = False
+        for el in _X_LINE_FIELDS(ln):
+            name = LET.QName(el).localname
+            if name == "Item":
+                has_item = True
+                continue
+            f.setdefault(_LINE_KEYS.get(name, name), _ltext(el))
+        alt = _X_ALT_01(ln)
+        if alt:
+            f["unit_price_igv"] = _ltext(alt[0]) or None
+        if has_item and "Description" in f:
+            score_item_desc = True
+        lines.append(_line_row(f))
+
+    in_line = set(_X_LINE_SUBTOTALS(root))
+    subtotals = []
+    for sub in _X_SUBTOTALS(root):
+        row = {"scheme_id": "", "reason": "", "taxable_amount": "", "tax_amount": ""}
+        seen = set()
+        for el in _X_SUB_FIELDS(sub):
+            key = _SUB_KEYS[LET.QName(el).localname]
+            if key not in seen:
+                seen.add(key)
+                row[key] = _ltext(el)
+        row["scope"] = "line" if sub in in_line else "doc"
+        subtotals.append(row)
+
+    detraccion = any(_ltext(el).lower() == "detraccion" for el in _X_TERMS_IDS(root))
+    if not detraccion:
+        for pm in _X_MEANS(root):
+            if _ltext(pm.find(f"{_C}ID")).lower() == "detraccion" and _ltext(
+                pm.find(f".//{_A}PayeeFinancialAccount/{_C}ID")
+            ):
+                detraccion = True
+                break
+    score = (3 if score_item_desc else 2) if lines else 0
+    return _assemble(first, lines, subtotals, bool(_X_PREPAID(root)), detraccion, score)
+
+
+def _extract_etree(source: Union[str, bytes]) -> Dict[str, Any]:
+    fh = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    w = _Walker()
+    for event, elem in ET.iterparse(fh, events=("start", "end")):
+        name = _local(elem.tag)
+        if event == "start":
+            w.start(name)
+        else:
+            w.end(name, (elem.text or "").strip())
+            elem.clear()
+    return _assemble(w.first, w.lines, w.subtotals, w.prepaid, w.detraccion, w.score)
+
+
+def _assemble(
+    first: Dict[str, str],
+    lines: List[Dict[str, Any]],
+    subtotals: List[Dict[str, Any]],
+    prepaid: bool,
+    detraccion: bool,
+    score: int,
+) -> Dict[str, Any]:
+    doc_id = first.get("ID", "")
+    serie, _, numero = doc_id.partition("-")
+    detalle = {
+        "issue_date": first.get("IssueDate") or None,
+        "currency": first.get("DocumentCurrencyCode") or None,
+        "totals": {
+            "tax_amount": first.get("TaxTotal/TaxAmount") or None,
+            "payable_amount": first.get("LegalMonetaryTotal/PayableAmount") or None,
+        },
+        "lines": lines,
+        "document": {
+            "id": doc_id or None,
+            "serie": serie or None,
+            "numero": numero or None,
+            "type_code": first.get("InvoiceTypeCode") or None,
+            "due_date": first.get("DueDate") or None,
+            "supplier_id": first.get("AccountingSupplierParty/ID") or None,
+            "supplier_name": first.get("AccountingSupplierParty/RegistrationName") or None,
+            "customer_id": first.get("AccountingCustomerParty/ID") or None,
+            "customer_name": first.get("AccountingCustomerParty/RegistrationName") or None,
+        },
+        "tax_subtotals": subtotals,
+    }
+
+    resumen = build_resumen(
+        issue_date=first.get("IssueDate", ""),
+        due_date=first.get("DueDate", ""),
+        doc_id=doc_id,
+        doc_type=first.get("InvoiceTypeCode", ""),
+        currency=first.get("DocumentCurrencyCode", ""),
+        supplier_id=first.get("AccountingSupplierParty/ID", ""),
+        supplier_name=first.get("AccountingSupplierParty/RegistrationName", ""),
+        payable=first.get("LegalMonetaryTotal/PayableAmount", ""),
+        totals=sum_tax_subtotals(
+            (s["scheme_id"], s["reason"], s["taxable_amount"], s["tax_amount"]) for s in subtotals
+        ),
+        modo="A" if prepaid else "",
+        detraccion=detraccion,
+    )
+
+    return {"score": score, "detalle": detalle, "resumen": resumen}
+
+
+
+
+def extract_ubl(source: Union[str, bytes], backend: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Recorre el XML UBL una sola vez y devuelve:
+      - score: puntaje del selector (XML con detalle)
+      - detalle: superset de parse_detalle (v1) + document + tax_subtotals
+      - resumen: fila de la hoja Resumen (igual a parse_resumen)
+    `source` puede ser una ruta o los bytes del XML. Con lxml instalado se usa
+    XPath compilado; si no, iterparse de ElementTree (mismo resultado).
+    """
+    backend = backend or BACKEND
+    if backend == "lxml" and LET is not None:
+        out = _extract_lxml(source)
+        if out is not None:
+            return out
+    return _extract_etree(source)
+
+
+def extract_ubl_bytes(data: bytes) -> Dict[str, Any]:
+    """extract_ubl con cache LRU por sha256 del contenido. No mutar el resultado."""
+    key = hashlib.sha256(data).hexdigest()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is not None:
+            _cache.move_to_end(key)
+            return hit
+    out = extract_ubl(data)
+    with _cache_lock:
+        _cache[key] = out
+        while len(_cache) > _CACHE_MAX:
+            _cache.popitem(last=False)
+    return out
+
+
+def extract_ubl_file(xml_path: str) -> Dict[str, Any]:
+    with open(xml_path, "rb") as f:
+        return extract_ubl_bytes(f.read())
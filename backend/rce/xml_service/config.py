@@ -15,6 +15,7 @@ MENU_RUTA_CONSULTA = [
 TIMEOUT_ANGULAR_MS = 15000
 TIMEOUT_RESULTADO_MS = 15000          # rápido para “si SUNAT cuelga, saltar”
 TIMEOUT_XML_BUTTON_MS = 2000          # si no aparece, asumimos colgado o sin resultado
+TIMEOUT_SESSION_CHECK_MS = 5000       # validar sesión guardada antes de hacer login completo
 WAIT_ON_FAIL_SECONDS = 10             # tu regla: espera 10s y sigue
 
 # retries por comprobante (además de esperar 10s)
@@ -22,3 +23,58 @@ MAX_ATTEMPTS_PER_ITEM = 2
 
 # modo navegador
 DEFAULT_HEADLESS = True
+
+# worker: cuántos runs (empresa/periodo) se procesan en paralelo.
+# Cada slot es un proceso con su propio navegador.
+WORKER_SLOTS = int(os.getenv("XML_WORKER_SLOTS", "1"))
+# cada cuántos segundos cada slot imprime su throughput
+WORKER_STATS_SECONDS = int(os.getenv("XML_WORKER_STATS_SECONDS", "300"))
+# latido del slot sobre su run RUNNING; sin latido por RUN_STALE_SECONDS el run
+# se considera huérfano (slot muerto) y vuelve a PENDING
+RUN_HEARTBEAT_SECONDS = int(os.getenv("XML_RUN_HEARTBEAT_SECONDS", "30"))
+RUN_STALE_SECONDS = int(os.getenv("XML_RUN_STALE_SECONDS", "180"))
+
+# sharding intra-empresa: varias sesiones SOL del mismo RUC repartiéndose los items
+SHARDS_PER_RUC = int(os.getenv("XML_SHARDS_PER_RUC", "1"))
+# tope duro de sesiones simultáneas por RUC (evita throttling de SUNAT)
+MAX_SESSIONS_PER_RUC = int(os.getenv("XML_MAX_SESSIONS_PER_RUC", "3"))
+# por debajo de esta cantidad de items no vale la pena abrir más sesiones
+SHARD_MIN_ITEMS = int(os.getenv("XML_SHARD_MIN_ITEMS", "200"))
+# lease del claim: otro proceso no toma el item hasta que venza
+SHARD_CLAIM_LEASE_SECONDS = 300
+
+# pausa entre comprobantes (por sesión) para no saturar la UI
+PAUSE_BETWEEN_ITEMS_SECONDS = 0.8
+
+# modo directo: consulta/descarga por HTTP reutilizando las cookies del navegador
+# (sin llenar el formulario Angular). Si falla, se cae al flujo UI.
+DIRECT_MODE = os.getenv("SOL_XML_DIRECT_MODE", "0") == "1"
+# base de los endpoints; vacío = origen del iframe de la consulta (app Angular)
+DIRECT_API_BASE = os.getenv("SOL_XML_DIRECT_BASE", "")
+# rutas de los endpoints que usa la app Angular (verificar en DevTools si SUNAT las cambia)
+DIRECT_CONSULTA_PATH = os.getenv("SOL_XML_DIRECT_CONSULTA_PATH", "/api/v1/comprobantes/consulta")
+DIRECT_DESCARGA_XML_PATH = os.getenv("SOL_XML_DIRECT_XML_PATH", "/api/v1/comprobantes/descarga/xml")
+DIRECT_DESCARGA_PDF_PATH = os.getenv("SOL_XML_DIRECT_PDF_PATH", "/api/v1/comprobantes/descarga/pdf")
+DIRECT_TIMEOUT_SECONDS = int(os.getenv("SOL_XML_DIRECT_TIMEOUT", "20"))
+# fallos seguidos antes de desactivar el modo directo para la sesión
+DIRECT_MAX_FAILURES = 3
+
+# write-behind de resultados: se vuelca a la BD cada N items o T segundos.
+# Mientras tanto cada resultado queda en un journal (JSONL con fsync) que se
+# reaplica al reiniciar el job si el proceso murió a mitad de lote.
+WRITE_BATCH_ITEMS = int(os.getenv("XML_WRITE_BATCH_ITEMS", "25"))
+WRITE_BATCH_SECONDS = float(os.getenv("XML_WRITE_BATCH_SECONDS", "10"))
+JOURNAL_DIR = os.getenv("XML_JOURNAL_DIR", os.path.join(REGISTROS_DIR, ".journal"))
+
+# Re-extracción masiva de cpe_detalle (rce.xml_detail.reextract)
+REEXTRACT_WORKERS = int(os.getenv("XML_REEXTRACT_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+REEXTRACT_BATCH = int(os.getenv("XML_REEXTRACT_BATCH", "500"))
+
+# /xml/repository: segundos que se reutiliza el total de una búsqueda (sin búsqueda sale de los contadores)
+REPOSITORY_COUNT_TTL_SECONDS = int(os.getenv("XML_REPOSITORY_COUNT_TTL", "60"))
+
+# /xml/report/stream: filas por vuelta del cursor del servidor (yield_per)
+REPORT_STREAM_BATCH = int(os.getenv("XML_REPORT_STREAM_BATCH", "500"))
+
+# Parser UBL (rce.xml_detail.ubl): auto = lxml si está instalado, si no ElementTree
+XML_PARSER_BACKEND = os.getenv("XML_PARSER_BACKEND", "auto").strip().lower()
@@ -1,18 +1,29 @@
+import threading
 import time
-from typing import Optional
+from typing import Callable, Dict, List, Optional
 from datetime import datetime, timezone
 
 from core.database import db_session, RCERun
+from core.events import CHANNEL_XML, CHANNEL_XML_PROGRESS, StopFlags, notify
 from .repository import (
     get_empresa,
     fetch_items_pendientes_xml,
-    get_or_create_evidencia,
-    get_or_create_evidencia_xml,
-    mark_attempt,
+    fetch_evidencia_status,
+    ensure_evidencias_xml,
+    claim_next_item_xml,
 )
 from .scraper import SolXMLScraper
-from rce.xml_detail import parse_detalle, save_detalle
-from .config import MAX_ATTEMPTS_PER_ITEM, WAIT_ON_FAIL_SECONDS
+from .writer import ResultWriter
+from rce.xml_detail import extract_ubl_file, resumen_to_json
+from .config import (
+    MAX_ATTEMPTS_PER_ITEM,
+    WAIT_ON_FAIL_SECONDS,
+    SHARDS_PER_RUC,
+    MAX_SESSIONS_PER_RUC,
+    SHARD_MIN_ITEMS,
+    SHARD_CLAIM_LEASE_SECONDS,
+    PAUSE_BETWEEN_ITEMS_SECONDS,
+)
 
 TIPO_CP_TO_LABEL = {
     "01": "Factura",
@@ -20,6 +31,18 @@ TIPO_CP_TO_LABEL = {
     "08": "Factura - Nota de Débito",
 }
 
+# Stops recibidos por NOTIFY (los workers suscriben STOP_FLAGS.handler a su listener)
+STOP_FLAGS = StopFlags()
+_events_listener = None
+
+
+def use_events(listener) -> None:
+    """Activa el chequeo de stop por eventos; la BD queda como respaldo periódico."""
+    global _events_listener
+    listener.subscribe(STOP_FLAGS.handler)
+    _events_listener = listener
+
+
 def request_stop(ruc: Optional[str] = None, periodo: Optional[str] = None) -> None:
     with db_session() as db:
         base = db.query(RCERun).filter(RCERun.modulo == "XML")
@@ -29,10 +52,13 @@ def request_stop(ruc: Optional[str] = None, periodo: Optional[str] = None) -> No
             base = base.filter(RCERun.periodo == periodo)
 
         running = base.filter(RCERun.status == "RUNNING")
+        running_ids = [r[0] for r in running.with_entities(RCERun.id).all()]
         running.update({"status": "STOP_REQUESTED"}, synchronize_session=False)
 
         pending = base.filter(RCERun.status == "PENDING")
         pending.update({"status": "STOPPED"}, synchronize_session=False)
+        if running_ids:
+            notify(db, CHANNEL_XML, {"event": "stop", "run_ids": running_ids})
         db.commit()
 
 def _should_stop_db(run_id: Optional[int], ruc: str, periodo: str) -> bool:
@@ -49,32 +75,269 @@ def _should_stop_db(run_id: Optional[int], ruc: str, periodo: str) -> bool:
 
 
 def _should_stop(ruc: str, periodo: str, run_id: Optional[int]) -> bool:
-    return _should_stop_db(run_id, ruc, periodo)
+    listener = _events_listener
+    if run_id and listener is not None and listener.connected:
+        if STOP_FLAGS.is_set(run_id):
+            return True
+        if not STOP_FLAGS.needs_db_check(run_id):
+            return False
+    stop = _should_stop_db(run_id, ruc, periodo)
+    if stop and run_id:
+        STOP_FLAGS.mark(run_id)
+    return stop
 
 def tipo_label_from_tipo_cp(tipo_cp: str) -> str:
     return TIPO_CP_TO_LABEL.get(tipo_cp, "Factura")
 
+class _JobState:
+    """Contadores compartidos por los shards (sesiones SOL) de un mismo job."""
+
+    def __init__(self, limit: Optional[int]):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.counts = {"ok": 0, "error": 0, "auth": 0, "not_found": 0}
+        self.processed = 0
+        self.stopped = False
+        self.limit_reached = False
+        self.writer: Optional[ResultWriter] = None
+        self.prev_status: Dict[int, str] = {}
+        self.run_id: Optional[int] = None
+
+    def add(self, key: str) -> None:
+        with self.lock:
+            self.counts[key] += 1
+            self.processed += 1
+            if self.limit is not None and self.processed >= self.limit:
+                self.limit_reached = True
+
+    def halted(self) -> bool:
+        return self.stopped or self.limit_reached
+
+
+def _item_event(item: dict) -> dict:
+    """Campos del comprobante que viajan en el evento "progress" del volcado."""
+    return {"tipo_cp": item["tipo_cp"], "serie": item["serie"], "numero": item["numero"]}
+
+
+def _notify_run(db, run: RCERun) -> None:
+    """Cambio de estado del run; sale con el commit de `db`."""
+    notify(db, CHANNEL_XML_PROGRESS, {
+        "event": "run",
+        "run_id": run.id,
+        "ruc": run.ruc_empresa,
+        "periodo": run.periodo,
+        "status": run.status,
+        "stats": run.stats_json,
+    })
+
+
+def _resolve_shards(requested: Optional[int], n_items: int) -> int:
+    shards = requested if requested is not None else SHARDS_PER_RUC
+    shards = max(1, min(int(shards), MAX_SESSIONS_PER_RUC))
+    if n_items < SHARD_MIN_ITEMS:
+        return 1
+    # nunca más sesiones que bloques de SHARD_MIN_ITEMS
+    return max(1, min(shards, n_items // SHARD_MIN_ITEMS))
+
+
+def _process_item(scraper: SolXMLScraper, item: dict, state: _JobState, emp: dict, tag: str) -> bool:
+    """
+    Procesa 1 comprobante. Devuelve True si se intentó una descarga
+    (para aplicar la pausa entre comprobantes).
+    Los resultados van al write-behind (state.writer); no abre sesión DB por item.
+    """
+    # Tipo 14 (Servicios): no hay etiqueta XML para descargar.
+    if str(item["tipo_cp"]).strip() == "14":
+        state.writer.record_attempt(
+            item["id"],
+            status="NOT_FOUND",
+            error_message="SERVICIOS (tipo_cp=14): sin etiqueta para descarga",
+            attempts=MAX_ATTEMPTS_PER_ITEM,
+            attempts_absolute=True,
+            event=_item_event(item),
+        )
+        state.add("not_found")
+        print(f"⏭️ {tag}SERVICIOS item_id={item['id']} tipo_cp=14 marcado NOT_FOUND")
+        return False
+
+    # idempotencia: si ya está OK o marcado NOT_FOUND, saltar (estado precargado al inicio del job)
+    prev_status = state.prev_status.get(item["id"])
+    if prev_status == "OK":
+        print(f"⏭️ {tag}SKIP OK item_id={item['id']}")
+        return False
+    if prev_status == "NOT_FOUND":
+        print(f"⏭️ {tag}SKIP NOT_FOUND item_id={item['id']}")
+        return False
+
+    busq = _to_busqueda(item)
+
+    result = scraper.descargar_xml(item["ruc_empresa"], item["periodo"], busq)
+
+    if result.ok:
+        detalle_json = None
+        resumen_json = None
+        try:
+            # un solo recorrido (normalmente ya cacheado por el selector del ZIP)
+            doc = extract_ubl_file(result.xml_path)
+            detalle_json = doc["detalle"]
+            # fila Resumen del reporte: se calcula aquí para no re-parsear al exportar
+            resumen_json = resumen_to_json(doc["resumen"])
+        except Exception as e:
+            print(f"⚠️ {tag}Detalle no extraído item_id={item['id']}: {e}")
+        state.writer.record_attempt(
+            item["id"],
+            status="OK",
+            storage_path=result.xml_path,
+            sha256=result.sha256,
+            downloaded=True,
+            pdf_path=result.pdf_path,
+            detalle=detalle_json,
+            resumen=resumen_json,
+            event=_item_event(item),
+        )
+        state.add("ok")
+        print(f"✅ {tag}OK item_id={item['id']} xml={result.xml_path}")
+    elif result.not_found:
+        state.writer.record_attempt(
+            item["id"],
+            status="NOT_FOUND",
+            error_message=result.error,
+            event=_item_event(item),
+        )
+        state.add("not_found")
+        print(f"🔎 {tag}NOT_FOUND item_id={item['id']} ({result.error})")
+    else:
+        status = "AUTH" if result.auth_error else "ERROR"
+        state.writer.record_attempt(
+            item["id"],
+            status=status,
+            error_message=result.error,
+            wait_seconds=WAIT_ON_FAIL_SECONDS,
+            event=_item_event(item),
+        )
+        state.add("auth" if status == "AUTH" else "error")
+        print(f"❌ {tag}{status} item_id={item['id']} err={result.error}")
+
+        # si fue AUTH, podrías relogin inmediato:
+        if status == "AUTH":
+            print(f"🔁 {tag}Re-login por AUTH…")
+            try:
+                ok = scraper.login_and_navigate(emp["ruc"], emp["usuario_sol"], emp["clave_sol"], force_login=True)
+                if not ok:
+                    print("⚠️ Re-login falló, continuando con el siguiente…")
+            except Exception as e:
+                print(f"⚠️ Re-login excepción: {e}")
+    return True
+
+
+def _run_shard(
+    next_item: Callable[[], Optional[dict]],
+    state: _JobState,
+    emp: dict,
+    periodo: str,
+    run_id: Optional[int],
+    headless: bool,
+    tag: str = "",
+) -> None:
+    """Una sesión SOL (navegador propio) consumiendo items hasta agotar/stop/límite."""
+    # scraper fuera del scope DB para no tener session abierta en todo el loop
+    scraper = SolXMLScraper(headless=headless)
+    scraper.start()
+    try:
+        ok_login = scraper.login_and_navigate(emp["ruc"], emp["usuario_sol"], emp["clave_sol"])
+        if not ok_login:
+            raise RuntimeError("No se pudo loguear/navegar en SOL")
+
+        while not state.halted():
+            if _should_stop(emp["ruc"], periodo, run_id):
+                state.stopped = True
+                print(f"🛑 {tag}Stop solicitado. Deteniendo empresa {emp['ruc']} periodo {periodo}.")
+                break
+            item = next_item()
+            if item is None:
+                break
+            if not _process_item(scraper, item, state, emp, tag):
+                continue
+
+            # pequeña pausa para no matar UI
+            time.sleep(PAUSE_BETWEEN_ITEMS_SECONDS)
+            if state.limit_reached:
+                print(f"⏹️ {tag}Límite alcanzado ({state.limit}). Deteniendo empresa {emp['ruc']} periodo {periodo}.")
+                break
+    finally:
+        scraper.stop()
+
+
+def _claim_iterator(items: List[dict], ruc_empresa: str, periodo: str, mode: Optional[str]) -> Callable[[], Optional[dict]]:
+    """
+    next_item() para shards: reclama con lock de fila en cpe_evidencias
+    (FOR UPDATE SKIP LOCKED + lease), avanzando un cursor compartido por id.
+    """
+    by_id = {it["id"]: it for it in items}
+    max_id = max(by_id)
+    lock = threading.Lock()
+    cursor = {"after_id": 0}
+
+    with db_session() as db:
+        ensure_evidencias_xml(db, list(by_id))
+        db.commit()
+
+    def next_item() -> Optional[dict]:
+        with lock:
+            while True:
+                with db_session() as db:
+                    item_id = claim_next_item_xml(
+                        db,
+                        ruc_empresa,
+                        periodo,
+                        after_id=cursor["after_id"],
+                        max_id=max_id,
+                        lease_seconds=SHARD_CLAIM_LEASE_SECONDS,
+                        mode=mode,
+                    )
+                    db.commit()
+                if item_id is None:
+                    return None
+                cursor["after_id"] = item_id
+                if item_id in by_id:
+                    return by_id[item_id]
+
+    return next_item
+
+
 def run_xml_job_for_empresa_periodo(
     ruc_empresa: str,
     periodo: str,
     limit: Optional[int] = None,
     headless: bool = False,
     run_id: Optional[int] = None,
+    shards: Optional[int] = None,
 ):
+    """
+    Descarga los XML pendientes de una empresa/periodo.
+    shards > 1 reparte los items entre varias sesiones SOL del mismo RUC
+    (topado por MAX_SESSIONS_PER_RUC); si es None se toma del run o de la config.
+    """
+    # resultados que un proceso anterior no alcanzó a volcar (caída a mitad de lote)
+    writer = ResultWriter(ruc_empresa, periodo, run_id=run_id)
+    recovered = writer.replay()
+    if recovered:
+        print(f"♻️ Recuperados {recovered} resultados del journal | empresa={ruc_empresa} periodo={periodo}")
+
     with db_session() as db:
         emp = get_empresa(db, ruc_empresa)
         if not emp:
             raise RuntimeError(f"No existe empresa activa {ruc_empresa}")
 
-        emp_ruc = emp.ruc
-        emp_usuario = emp.usuario_sol
-        emp_clave = emp.clave_sol
+        emp_data = {"ruc": emp.ruc, "usuario_sol": emp.usuario_sol, "clave_sol": emp.clave_sol}
 
         mode = None
         if run_id:
             run = db.query(RCERun).filter(RCERun.id == run_id).first()
             if run and run.stats_json:
                 mode = run.stats_json.get("mode")
+                if shards is None:
+                    shards = run.stats_json.get("shards")
         raw_items = fetch_items_pendientes_xml(db, ruc_empresa, periodo, limit=limit, mode=mode)
         items = [
             {
@@ -88,6 +351,7 @@ def run_xml_job_for_empresa_periodo(
             }
             for it in raw_items
         ]
+        prev_status = fetch_evidencia_status(db, [it["id"] for it in items])
         print(f"📌 Pendientes XML: {len(items)} | empresa={ruc_empresa} periodo={periodo}")
 
         if not items:
@@ -97,167 +361,74 @@ def run_xml_job_for_empresa_periodo(
                     run.status = "OK"
                     run.finished_at = datetime.now(timezone.utc)
                     run.stats_json = {"ok": 0, "error": 0, "auth": 0, "not_found": 0}
+                    _notify_run(db, run)
                     db.commit()
-            return
+            return {"ok": 0, "error": 0, "auth": 0, "not_found": 0}
 
         if run_id:
             run = db.query(RCERun).filter(RCERun.id == run_id).first()
             if run:
                 run.status = "RUNNING"
                 run.started_at = datetime.now(timezone.utc)
+                _notify_run(db, run)
                 db.commit()
 
-    # scraper fuera del scope DB para no tener session abierta en todo el loop
-    scraper = SolXMLScraper(headless=headless)
-    scraper.start()
-    ok_count = 0
-    error_count = 0
-    not_found_count = 0
-    auth_count = 0
-    stopped = False
-    limit_reached = False
-    processed_count = 0
+    n_shards = _resolve_shards(shards, len(items))
+    state = _JobState(limit)
+    state.writer = writer
+    state.prev_status = prev_status
+    state.run_id = run_id
     try:
-        ok_login = scraper.login_and_navigate(emp_ruc, emp_usuario, emp_clave)
-        if not ok_login:
-            raise RuntimeError("No se pudo loguear/navegar en SOL")
+        if n_shards == 1:
+            pending = iter(items)
+            _run_shard(lambda: next(pending, None), state, emp_data, periodo, run_id, headless)
+        else:
+            print(f"🧩 {n_shards} sesiones SOL en paralelo para empresa {ruc_empresa} periodo {periodo}")
+            next_item = _claim_iterator(items, ruc_empresa, periodo, mode)
+            errors: List[Exception] = []
 
-        for item in items:
-            if _should_stop(emp_ruc, periodo, run_id):
-                stopped = True
-                print(f"🛑 Stop solicitado. Deteniendo empresa {emp_ruc} periodo {periodo}.")
-                break
-            # reabrimos sesión DB por item (simple y seguro)
-            with db_session() as db:
-                ev = get_or_create_evidencia_xml(db, item["id"])
-
-                # Tipo 14 (Servicios): no hay etiqueta XML para descargar.
-                if str(item["tipo_cp"]).strip() == "14":
-                    mark_attempt(
-                        db,
-                        ev,
-                        status="NOT_FOUND",
-                        error_message="SERVICIOS (tipo_cp=14): sin etiqueta para descarga",
-                        wait_seconds=0,
-                    )
-                    ev.attempt_count = MAX_ATTEMPTS_PER_ITEM
-                    db.commit()
-                    not_found_count += 1
-                    processed_count += 1
-                    print(f"⏭️ SERVICIOS item_id={item['id']} tipo_cp=14 marcado NOT_FOUND")
-                    continue
-
-                # idempotencia: si ya está OK o marcado NOT_FOUND, saltar
-                if ev.status == "OK":
-                    print(f"⏭️ SKIP OK item_id={item['id']}")
-                    continue
-                if ev.status == "NOT_FOUND":
-                    print(f"⏭️ SKIP NOT_FOUND item_id={item['id']}")
-                    continue
-
-            # intentamos descargar (sin DB abierta)
-            busq = _to_busqueda(item)
-
-            result = scraper.descargar_xml(item["ruc_empresa"], item["periodo"], busq)
-
-            with db_session() as db:
-                ev = get_or_create_evidencia_xml(db, item["id"])
-
-                if result.ok:
-                    mark_attempt(
-                        db,
-                        ev,
-                        status="OK",
-                        error_message=None,
-                        storage_path=result.xml_path,
-                        sha256=result.sha256,
-                        downloaded_at=datetime.now(timezone.utc),
-                        wait_seconds=0,
-                    )
-                    if result.pdf_path:
-                        ev_pdf = get_or_create_evidencia(db, item["id"], "PDF")
-                        mark_attempt(
-                            db,
-                            ev_pdf,
-                            status="OK",
-                            error_message=None,
-                            storage_path=result.pdf_path,
-                            wait_seconds=0,
-                        )
-                    try:
-                        detalle_json = parse_detalle(result.xml_path)
-                        save_detalle(
-                            db,
-                            propuesta_item_id=item["id"],
-                            detalle_json=detalle_json,
-                            source_sha256=result.sha256,
-                        )
-                    except Exception as e:
-                        print(f"⚠️ Detalle no extraído item_id={item['id']}: {e}")
-                    db.commit()
-                    ok_count += 1
-                    processed_count += 1
-                    print(f"✅ OK item_id={item['id']} xml={result.xml_path}")
-                else:
-                    status = "AUTH" if result.auth_error else "ERROR"
-                    mark_attempt(
-                        db,
-                        ev,
-                        status=status,
-                        error_message=result.error,
-                        wait_seconds=WAIT_ON_FAIL_SECONDS,
-                    )
-                    db.commit()
-                    if status == "AUTH":
-                        auth_count += 1
-                    else:
-                        error_count += 1
-                    processed_count += 1
-                    print(f"❌ {status} item_id={item['id']} err={result.error}")
-
-                    # si fue AUTH, podrías relogin inmediato:
-                    if status == "AUTH":
-                        print("🔁 Re-login por AUTH…")
-                        try:
-                            ok = scraper.login_and_navigate(emp_ruc, emp_usuario, emp_clave)
-                            if not ok:
-                                print("⚠️ Re-login falló, continuando con el siguiente…")
-                        except Exception as e:
-                            print(f"⚠️ Re-login excepción: {e}")
-
-            # pequeña pausa para no matar UI
-            time.sleep(0.8)
-            if limit is not None and processed_count >= limit:
-                limit_reached = True
-                print(f"⏹️ Límite alcanzado ({limit}). Deteniendo empresa {emp_ruc} periodo {periodo}.")
-                break
+            def _shard_entry(idx: int) -> None:
+                try:
+                    _run_shard(next_item, state, emp_data, periodo, run_id, headless, tag=f"[s{idx}] ")
+                except Exception as e:
+                    print(f"❌ [s{idx}] Shard abortado: {e}")
+                    errors.append(e)
 
+            threads = [
+                threading.Thread(target=_shard_entry, args=(idx,), name=f"xml-{ruc_empresa}-s{idx}")
+                for idx in range(n_shards)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if len(errors) == n_shards:
+                raise errors[0]
     finally:
-        scraper.stop()
+        writer.close()
+        stats = dict(state.counts)
+        stats.update({"limit": limit, "limit_reached": state.limit_reached, "shards": n_shards})
         if run_id:
             status = "OK"
-            if stopped:
+            if state.stopped:
                 status = "STOPPED"
-            elif error_count > 0 or auth_count > 0:
+            elif stats["error"] > 0 or stats["auth"] > 0:
                 status = "PARTIAL"
             with db_session() as db:
                 run = db.query(RCERun).filter(RCERun.id == run_id).first()
                 if run:
                     run.status = status
                     run.finished_at = datetime.now(timezone.utc)
-                    run.stats_json = {
-                        "ok": ok_count,
-                        "error": error_count,
-                        "auth": auth_count,
-                        "not_found": not_found_count,
-                        "limit": limit,
-                        "limit_reached": limit_reached,
-                    }
+                    run.stats_json = stats
                     if status == "STOPPED":
                         run.error_message = "Detenido por el usuario"
                     elif status != "OK" and run.error_message is None:
                         run.error_message = "Proceso con errores"
+                    _notify_run(db, run)
                     db.commit()
+            STOP_FLAGS.discard(run_id)
+
+    return stats
 
 
 def _to_busqueda(item) -> "BusquedaComprobante":
@@ -270,4 +441,5 @@ def _to_busqueda(item) -> "BusquedaComprobante":
         serie=item["serie"],
         numero=item["numero"],
         tipo_label=tipo_label,
+        tipo_cp=str(item["tipo_cp"]).strip(),
     )
@@ -1,10 +1,11 @@
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from core.database import Empresa, RCEPropuestaItem, CPEEvidencia
+from core.database import Empresa, RCEPropuestaItem, CPEEvidencia, XMLProgressCounter, XML_PROGRESS_ITEMS
 
 
 def get_empresa(db: Session, ruc: str) -> Optional[Empresa]:
@@ -104,3 +105,144 @@ def mark_attempt(
         ev.next_retry_at = None
 
     db.flush()
+
+
+def ensure_evidencias_xml(db: Session, item_ids: List[int], chunk_size: int = 1000) -> None:
+    """
+    Crea (PENDING) las evidencias XML que falten, en bloque.
+    Necesario para poder reclamar items con lock de fila sobre cpe_evidencias.
+    """
+    for start in range(0, len(item_ids), chunk_size):
+        chunk = item_ids[start:start + chunk_size]
+        stmt = (
+            pg_insert(CPEEvidencia)
+            .values([
+                {"propuesta_item_id": item_id, "tipo": "XML", "status": "PENDING", "attempt_count": 0}
+                for item_id in chunk
+            ])
+            .on_conflict_do_nothing(constraint="uq_cpe_evidencia_item_tipo")
+        )
+        db.execute(stmt)
+    db.flush()
+
+
+def claim_next_item_xml(
+    db: Session,
+    ruc_empresa: str,
+    periodo: str,
+    after_id: int,
+    max_id: int,
+    lease_seconds: int,
+    mode: Optional[str] = None,
+) -> Optional[int]:
+    """
+    Reclama el siguiente item pendiente (id > after_id) con FOR UPDATE SKIP LOCKED
+    sobre cpe_evidencias y le pone un lease en next_retry_at.
+    Devuelve el propuesta_item_id o None si no queda trabajo.
+    El caller hace commit.
+    """
+    now = datetime.now(timezone.utc)
+    q = (
+        db.query(CPEEvidencia)
+        .join(RCEPropuestaItem, RCEPropuestaItem.id == CPEEvidencia.propuesta_item_id)
+        .filter(RCEPropuestaItem.ruc_empresa == ruc_empresa)
+        .filter(RCEPropuestaItem.periodo == periodo)
+        .filter(RCEPropuestaItem.vigente == True)
+        .filter(CPEEvidencia.tipo == "XML")
+        .filter(CPEEvidencia.propuesta_item_id > after_id)
+        .filter(CPEEvidencia.propuesta_item_id <= max_id)
+        .filter(or_(CPEEvidencia.next_retry_at == None, CPEEvidencia.next_retry_at <= now))
+    )
+    if mode == "pending_error":
+        q = q.filter(CPEEvidencia.status.in_(["PENDING", "ERROR", "AUTH"]))
+    else:
+        q = q.filter(CPEEvidencia.status.notin_(["OK", "NOT_FOUND"]))
+
+    ev = (
+        q.order_by(CPEEvidencia.propuesta_item_id.asc())
+        .with_for_update(skip_locked=True, of=CPEEvidencia)
+        .first()
+    )
+    if not ev:
+        return None
+    ev.next_retry_at = now + timedelta(seconds=lease_seconds)
+    db.flush()
+    return ev.propuesta_item_id
+
+
+def fetch_evidencia_status(db: Session, item_ids: List[int], tipo: str = "XML") -> Dict[int, str]:
+    """Estado actual de las evidencias de varios items en una sola consulta."""
+    out: Dict[int, str] = {}
+    for start in range(0, len(item_ids), 1000):
+        chunk = item_ids[start:start + 1000]
+        rows = (
+            db.query(CPEEvidencia.propuesta_item_id, CPEEvidencia.status)
+            .filter(CPEEvidencia.tipo == tipo, CPEEvidencia.propuesta_item_id.in_(chunk))
+            .all()
+        )
+        out.update({item_id: status for item_id, status in rows})
+    return out
+
+
+def upsert_evidencias_bulk(db: Session, rows: List[Dict]) -> None:
+    """
+    Aplica intentos en bloque: INSERT ... ON CONFLICT (propuesta_item_id, tipo) DO UPDATE.
+    Cada fila trae attempt_count como incremento (equivalente a N llamadas a mark_attempt),
+    salvo las marcadas con attempt_count_set=True, que lo fijan (como `ev.attempt_count = N`).
+    Las claves (propuesta_item_id, tipo) no deben repetirse dentro de `rows`.
+    """
+    groups: Dict[bool, List[Dict]] = {False: [], True: []}
+    for row in rows:
+        row = dict(row)
+        groups[bool(row.pop("attempt_count_set", False))].append(row)
+    for absolute, group in groups.items():
+        for start in range(0, len(group), 500):
+            _upsert_evidencias_chunk(db, group[start:start + 500], absolute)
+
+
+def _upsert_evidencias_chunk(db: Session, rows: List[Dict], absolute: bool) -> None:
+    stmt = pg_insert(CPEEvidencia).values(rows)
+    ex = stmt.excluded
+    cur = CPEEvidencia.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        constraint="uq_cpe_evidencia_item_tipo",
+        set_={
+            "status": ex.status,
+            "error_message": ex.error_message,
+            "attempt_count": ex.attempt_count if absolute else cur.attempt_count + ex.attempt_count,
+            "last_attempt_at": ex.last_attempt_at,
+            "next_retry_at": ex.next_retry_at,
+            "storage_path": func.coalesce(ex.storage_path, cur.storage_path),
+            "sha256": func.coalesce(ex.sha256, cur.sha256),
+            "downloaded_at": func.coalesce(ex.downloaded_at, cur.downloaded_at),
+            "updated_at": func.now(),
+        },
+    )
+    db.execute(stmt)
+
+
+def progress_from_counters(counts: Dict[str, int]) -> Dict[str, int]:
+    """Contadores (status -> n) de xml_progress_counters a los campos de /xml/progress."""
+    counts = dict(counts)
+    total_items = counts.pop(XML_PROGRESS_ITEMS, 0)
+    ok = counts.get("OK", 0)
+    not_found = counts.get("NOT_FOUND", 0)
+    return {
+        "total_items": total_items,
+        "total_evidencias": sum(counts.values()),
+        "ok": ok,
+        "error": counts.get("ERROR", 0),
+        "not_found": not_found,
+        "auth": counts.get("AUTH", 0),
+        "pending": counts.get("PENDING", 0),
+        "remaining": max(total_items - ok - not_found, 0),
+    }
+
+
+def fetch_progress(db: Session, ruc_empresa: str, periodo: str) -> Dict[str, int]:
+    rows = (
+        db.query(XMLProgressCounter.status, XMLProgressCounter.n)
+        .filter(XMLProgressCounter.ruc_empresa == ruc_empresa, XMLProgressCounter.periodo == periodo)
+        .all()
+    )
+    return progress_from_counters({status: n for status, n in rows})
@@ -9,12 +9,15 @@ def main():
     ap.add_argument("--ruc", default=None, help="Procesar solo 1 empresa")
     ap.add_argument("--limit", type=int, default=200)
     ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--shards", type=int, default=None, help="Sesiones SOL en paralelo por empresa")
     args = ap.parse_args()
 
     periodo = args.periodo
 
     if args.ruc:
-        run_xml_job_for_empresa_periodo(args.ruc, periodo, limit=args.limit, headless=args.headless)
+        run_xml_job_for_empresa_periodo(
+            args.ruc, periodo, limit=args.limit, headless=args.headless, shards=args.shards
+        )
         return
 
     # multiempresa: todas las activas (que tengan items en ese periodo)
@@ -24,7 +27,9 @@ def main():
     for ruc in rucs:
         print(f"\n=== Empresa {ruc} periodo={periodo} ===")
         try:
-            run_xml_job_for_empresa_periodo(ruc, periodo, limit=args.limit, headless=args.headless)
+            run_xml_job_for_empresa_periodo(
+                ruc, periodo, limit=args.limit, headless=args.headless, shards=args.shards
+            )
         except Exception as e:
             print(f"❌ ERROR empresa {ruc}: {e}")
 
@@ -3,25 +3,40 @@ import hashlib
 import time
 from dataclasses import dataclass
 from typing import Optional
+from urllib.parse import urlsplit
 
 from playwright.sync_api import sync_playwright, Page
 
+from core.browser_pool import connect_browser, new_context
 from core.config import init_dirs
+from core import request_filter
+from core.session_store import cached_state, invalidate, save_state
 from automation.auth import intentar_login_automatico, handle_post_login_popups
-from automation.utils import goto_menu, buscar_y_clickear
+from automation.utils import goto_menu, buscar_y_clickear, check_session
 
 from rce.sol.navigation import navegar_menu_jerarquico
 from rce.sol.consulta_individual import BusquedaComprobante, consultar_y_descargar_xml_individual
+from rce.sol.consulta_directa import SolDirectClient
 
 from .config import (
     MENU_RUTA_CONSULTA,
     TIMEOUT_RESULTADO_MS,
+    TIMEOUT_SESSION_CHECK_MS,
     TIMEOUT_XML_BUTTON_MS,
     WAIT_ON_FAIL_SECONDS,
     DEFAULT_HEADLESS,
     REGISTROS_DIR,
+    DIRECT_MODE,
+    DIRECT_API_BASE,
+    DIRECT_CONSULTA_PATH,
+    DIRECT_DESCARGA_XML_PATH,
+    DIRECT_DESCARGA_PDF_PATH,
+    DIRECT_TIMEOUT_SECONDS,
+    DIRECT_MAX_FAILURES,
 )
 
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
 
 @dataclass
 class ScrapeResult:
@@ -31,6 +46,7 @@ class ScrapeResult:
     sha256: Optional[str] = None
     error: Optional[str] = None
     auth_error: bool = False
+    not_found: bool = False
 
 def _overlay_visible(page) -> bool:
     # overlay está dentro del iframe angular
@@ -86,29 +102,98 @@ def _sha256_file(path: str) -> str:
 
 
 class SolXMLScraper:
-    def __init__(self, headless: bool = DEFAULT_HEADLESS):
+    def __init__(self, headless: bool = DEFAULT_HEADLESS, direct_mode: Optional[bool] = None):
         self.headless = headless
+        self.direct_mode = DIRECT_MODE if direct_mode is None else direct_mode
         self._p = None
         self._browser = None
         self._context = None
         self.page: Optional[Page] = None
+        self._direct: Optional[SolDirectClient] = None
+        self._direct_failures = 0
+        self._authorization: Optional[str] = None
+        # RUC cuya sesión guardada ya está cargada en el contexto
+        self._state_ruc: Optional[str] = None
 
     def start(self):
         init_dirs()
         self._p = sync_playwright().start()
-        self._browser = self._p.chromium.launch(
-            headless=self.headless,
-            args=["--start-maximized", "--disable-blink-features=AutomationControlled"]
-        )
-        USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-        self._context = self._browser.new_context(
-            viewport={"width": 1366, "height": 768},
-            user_agent=USER_AGENT
-        )
+        # host residente (BROWSER_HOST_URL) o Chromium propio; close() en stop() solo desconecta del host
+        self._browser = connect_browser(self._p, self.headless)
+        self._open_context()
+
+    def _open_context(self, ruc: Optional[str] = None) -> None:
+        """(Re)abre contexto y página; con `ruc` carga su sesión guardada en SESSION_DIR."""
+        if self._context:
+            self._context.close()
+        self._context = new_context(self._browser, ruc)
+        if self.direct_mode:
+            self._context.on("request", self._capture_authorization)
         self.page = self._context.new_page()
 
+    def _capture_authorization(self, request) -> None:
+        # La app Angular manda un Bearer propio en sus XHR; lo reutiliza el modo directo.
+        try:
+            if request.resource_type in ("xhr", "fetch"):
+                auth = request.headers.get("authorization")
+                if auth:
+                    self._authorization = auth
+        except Exception:
+            pass
+
+    def _init_direct(self) -> None:
+        """Prepara el cliente HTTP directo con la sesión actual del navegador."""
+        base = DIRECT_API_BASE
+        if not base:
+            frame = self.page.frame(name="iframeApplication") if self.page else None
+            if not frame or not frame.url:
+                print("⚠️ Modo directo: no se pudo determinar la base (iframe sin URL). Se usa flujo UI.")
+                return
+            parts = urlsplit(frame.url)
+            base = f"{parts.scheme}://{parts.netloc}"
+        if self._direct is None:
+            self._direct = SolDirectClient(
+                base_url=base,
+                consulta_path=DIRECT_CONSULTA_PATH,
+                descarga_xml_path=DIRECT_DESCARGA_XML_PATH,
+                descarga_pdf_path=DIRECT_DESCARGA_PDF_PATH,
+                timeout=DIRECT_TIMEOUT_SECONDS,
+            )
+        self._direct.sync_from_context(self._context, authorization=self._authorization, user_agent=USER_AGENT)
+        self._direct_failures = 0
+        print(f"⚡ Modo directo activo (base={base})")
+
+    def _descargar_directo(self, busqueda: BusquedaComprobante, out_dir: str) -> Optional[ScrapeResult]:
+        """
+        Intenta el modo directo; None si no aplica o falló (el caller cae al flujo UI).
+        "No existe" es una respuesta válida de SUNAT: se devuelve como NOT_FOUND,
+        sin flujo UI ni contar como fallo del modo directo.
+        """
+        if not self._direct:
+            return None
+        res = self._direct.consultar_y_descargar_xml(busqueda, out_dir=out_dir)
+        if res.ok:
+            self._direct_failures = 0
+            sha = _sha256_file(res.xml_path)
+            return ScrapeResult(ok=True, xml_path=res.xml_path, pdf_path=res.pdf_path, sha256=sha)
+        if res.not_found:
+            self._direct_failures = 0
+            return ScrapeResult(ok=False, error=res.error, not_found=True)
+
+        self._direct_failures += 1
+        print(f"↩️ Modo directo falló ({res.error}). Usando flujo UI…")
+        if self._direct_failures >= DIRECT_MAX_FAILURES:
+            print(f"⚠️ {self._direct_failures} fallos seguidos en modo directo: se desactiva para esta sesión.")
+            self._direct.close()
+            self._direct = None
+        return None
+
     def stop(self):
+        if self._context:
+            print(f"🚧 Requests SOL: {request_filter.summary()}")
         try:
+            if self._direct:
+                self._direct.close()
             if self._context:
                 self._context.close()
             if self._browser:
@@ -120,26 +205,69 @@ class SolXMLScraper:
             self._browser = None
             self._context = None
             self.page = None
+            self._direct = None
+            self._state_ruc = None
+
+    def _sesion_valida(self) -> bool:
+        """Chequeo barato tras goto_menu: espera el form de login o 'Salir', lo que aparezca."""
+        try:
+            self.page.locator("#txtRuc").or_(self.page.get_by_text("Salir")).first.wait_for(
+                state="visible", timeout=TIMEOUT_SESSION_CHECK_MS
+            )
+        except Exception:
+            pass
+        return check_session(self.page)
 
-    def login_and_navigate(self, ruc: str, usuario_sol: str, clave_sol: str) -> bool:
+    def login_and_navigate(self, ruc: str, usuario_sol: str, clave_sol: str, force_login: bool = False) -> bool:
+        """
+        Deja la página en el formulario de consulta. Reutiliza la sesión guardada
+        del RUC (la misma que usa el buzón) si sigue viva; si no, o con
+        force_login (p.ej. tras un AUTH), hace el login completo y la guarda.
+        """
         assert self.page is not None
 
+        if force_login:
+            invalidate(ruc)
+        elif self._state_ruc != ruc and cached_state(ruc):
+            self._open_context(ruc)
+            self._state_ruc = ruc
+
         if not goto_menu(self.page):
             return False
 
-        class MockEmp:
-            def __init__(self, ruc: str, usuario_sol: str, clave_sol: str):
-                self.ruc = ruc
-                self.usuario_sol = usuario_sol
-                self.clave_sol = clave_sol
+        reused = False
+        if not force_login and self._state_ruc == ruc and self._sesion_valida():
+            print(f"♻️ Sesión SOL reutilizada para {ruc} (sin login).")
+            handle_post_login_popups(self.page)
+            try:
+                navegar_menu_jerarquico(self.page, MENU_RUTA_CONSULTA)
+                reused = True
+            except Exception as e:
+                print(f"⚠️ Sesión guardada no sirvió ({e}). Login completo…")
+                invalidate(ruc)
 
-        if not intentar_login_automatico(self.page, MockEmp(ruc, usuario_sol, clave_sol)):
-            return False
+        if not reused:
+            class MockEmp:
+                def __init__(self, ruc: str, usuario_sol: str, clave_sol: str):
+                    self.ruc = ruc
+                    self.usuario_sol = usuario_sol
+                    self.clave_sol = clave_sol
 
-        handle_post_login_popups(self.page)
+            if not intentar_login_automatico(self.page, MockEmp(ruc, usuario_sol, clave_sol)):
+                return False
+            save_state(self._context, ruc)
+            self._state_ruc = ruc
+
+            handle_post_login_popups(self.page)
 
-        # navegar una sola vez al formulario
-        navegar_menu_jerarquico(self.page, MENU_RUTA_CONSULTA)
+            # navegar una sola vez al formulario
+            navegar_menu_jerarquico(self.page, MENU_RUTA_CONSULTA)
+        if self.direct_mode:
+            try:
+                self._init_direct()
+            except Exception as e:
+                print(f"⚠️ Modo directo no disponible: {e}")
+                self._direct = None
         return True
 
     def _reset_form_minimo(self):
@@ -164,6 +292,7 @@ class SolXMLScraper:
     ) -> ScrapeResult:
         """
         Intenta descargar 1 XML sin relogin.
+        En modo directo prueba primero por HTTP; si falla, sigue con el flujo UI.
         Si SUNAT no responde (no aparece botón XML), espera 10s y devuelve ERROR.
         """
         assert self.page is not None
@@ -171,6 +300,10 @@ class SolXMLScraper:
         out_dir = os.path.join(REGISTROS_DIR, "periodos", periodo, ruc_empresa, "xml")
         os.makedirs(out_dir, exist_ok=True)
 
+        direct = self._descargar_directo(busqueda, out_dir)
+        if direct is not None:
+            return direct
+
         # Ajustamos timeouts para tu regla: si no aparece el botón, no nos quedamos 45s
         res = consultar_y_descargar_xml_individual(
             self.page,
@@ -1,12 +1,109 @@
+import argparse
+import multiprocessing as mp
+import os
+import socket
+import threading
 import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import func
 
 from core.database import db_session, RCERun, RCEPropuestaItem, CPEEvidencia
-from .job import run_xml_job_for_empresa_periodo
+from core.events import CHANNEL_XML, CHANNEL_XML_PROGRESS, IDLE_POLL_SECONDS, EventListener, notify
+from .config import RUN_HEARTBEAT_SECONDS, RUN_STALE_SECONDS, WORKER_SLOTS, WORKER_STATS_SECONDS
+from .job import run_xml_job_for_empresa_periodo, use_events
 
 POLL_SECONDS = 3
 
 
-def pick_next_run():
+def worker_id(slot: int) -> str:
+    """Identidad del slot en rce_runs.worker_id (host:pid:slot)."""
+    return f"{socket.gethostname()}:{os.getpid()}:s{slot}"
+
+
+def recover_orphan_runs() -> int:
+    """
+    Devuelve a PENDING los runs XML en RUNNING cuyo slot dejó de latir por
+    RUN_STALE_SECONDS (proceso muerto, contenedor reiniciado). El job retoma
+    desde las evidencias ya guardadas y el journal del write-behind.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=RUN_STALE_SECONDS)
+    with db_session() as db:
+        runs = (
+            db.query(RCERun)
+            .filter(
+                RCERun.modulo == "XML",
+                RCERun.status == "RUNNING",
+                # runs tomados antes de existir el latido: cuenta desde started_at
+                func.coalesce(RCERun.heartbeat_at, RCERun.started_at) < cutoff,
+            )
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for run in runs:
+            print(f"♻️ Run huérfano {run.id} (empresa={run.ruc_empresa} periodo={run.periodo}, slot={run.worker_id}). Reencolando…")
+            run.status = "PENDING"
+            run.worker_id = None
+            run.heartbeat_at = None
+            notify(db, CHANNEL_XML_PROGRESS, {
+                "event": "run",
+                "run_id": run.id,
+                "ruc": run.ruc_empresa,
+                "periodo": run.periodo,
+                "status": run.status,
+                "stats": run.stats_json,
+            })
+        db.commit()
+        return len(runs)
+
+
+class RunHeartbeat:
+    """Hilo que refresca rce_runs.heartbeat_at mientras el slot ejecuta el run."""
+
+    def __init__(self, run_id: int, owner: str, interval: float = RUN_HEARTBEAT_SECONDS):
+        self.run_id = run_id
+        self.owner = owner
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _beat(self) -> None:
+        with db_session() as db:
+            n = (
+                db.query(RCERun)
+                .filter(RCERun.id == self.run_id, RCERun.worker_id == self.owner)
+                .update({RCERun.heartbeat_at: func.now()}, synchronize_session=False)
+            )
+            db.commit()
+        if not n:
+            print(f"⚠️ Run {self.run_id} ya no pertenece a {self.owner} (reencolado por falta de latido).")
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self._beat()
+            except Exception as e:
+                # BD caída un rato: se reintenta en el próximo latido
+                print(f"⚠️ Latido del run {self.run_id} falló: {e}")
+
+    def __enter__(self) -> "RunHeartbeat":
+        self._thread = threading.Thread(target=self._loop, name=f"xml-heartbeat-{self.run_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def pick_next_run(owner: Optional[str] = None):
+    """
+    Reclama el siguiente run PENDING.
+    FOR UPDATE SKIP LOCKED + marcarlo RUNNING en la misma transacción:
+    varios slots/procesos nunca toman el mismo run. Queda a nombre de `owner`
+    con el primer latido.
+    """
     with db_session() as db:
         run = (
             db.query(RCERun)
@@ -14,11 +111,18 @@ def pick_next_run():
             # ERROR/PARTIAL se reintentan solo cuando el frontend vuelve a encolarlos.
             .filter(RCERun.modulo == "XML", RCERun.status == "PENDING")
             .order_by(RCERun.started_at.asc().nullsfirst(), RCERun.id.asc())
+            .with_for_update(skip_locked=True)
             .first()
         )
         if not run:
             return None
-        return run.id, run.ruc_empresa, run.periodo, run.stats_json or {}
+        picked = (run.id, run.ruc_empresa, run.periodo, run.stats_json or {})
+        run.status = "RUNNING"
+        run.started_at = datetime.now(timezone.utc)
+        run.worker_id = owner
+        run.heartbeat_at = run.started_at
+        db.commit()
+        return picked
 
 
 def _has_pending_items(ruc: str, periodo: str) -> bool:
@@ -37,36 +141,128 @@ def _has_pending_items(ruc: str, periodo: str) -> bool:
         return db.query(q.exists()).scalar()
 
 
-def main():
-    print("🔧 XML Worker iniciado. Esperando jobs...")
+class SlotStats:
+    """Throughput acumulado de un slot (runs, items y tiempo ocupado)."""
+
+    def __init__(self, slot: int):
+        self.slot = slot
+        self.started = time.time()
+        self.last_report = self.started
+        self.runs = 0
+        self.items = 0
+        self.ok = 0
+        self.busy_seconds = 0.0
+
+    def record(self, stats: dict, elapsed: float) -> None:
+        stats = stats or {}
+        self.runs += 1
+        self.ok += int(stats.get("ok", 0))
+        self.items += sum(int(stats.get(k, 0)) for k in ("ok", "error", "auth", "not_found"))
+        self.busy_seconds += elapsed
+
+    def report(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self.last_report < WORKER_STATS_SECONDS:
+            return
+        self.last_report = now
+        busy_min = self.busy_seconds / 60
+        rate = self.items / busy_min if busy_min > 0 else 0.0
+        uso = self.busy_seconds / max(now - self.started, 1e-6)
+        print(
+            f"📈 [slot {self.slot}] runs={self.runs} items={self.items} ok={self.ok} "
+            f"| {rate:.1f} items/min | uso={uso:.0%}"
+        )
+
+
+def _run_one(run_id: int, ruc: str, periodo: str, stats: dict):
+    limit = stats.get("limit")
+    headless = stats.get("headless", True)
+
+    if not _has_pending_items(ruc, periodo):
+        with db_session() as db:
+            run = db.query(RCERun).filter(RCERun.id == run_id).first()
+            if run:
+                run.status = "OK"
+                run.error_message = None
+                db.commit()
+        return None
+
+    try:
+        return run_xml_job_for_empresa_periodo(ruc, periodo, limit=limit, headless=headless, run_id=run_id)
+    except Exception as e:
+        with db_session() as db:
+            run = db.query(RCERun).filter(RCERun.id == run_id).first()
+            if run:
+                run.status = "ERROR"
+                run.error_message = str(e)
+                db.commit()
+        return None
+
+
+def run_slot(slot: int = 0):
+    """Loop de un slot: reclama runs de uno en uno y los procesa."""
+    stats = SlotStats(slot)
+    # LISTEN en xml_jobs: /xml/run despierta al slot y /xml/stop llega sin consultar la BD.
+    # Si el listener está caído se vuelve al polling de POLL_SECONDS.
+    listener = EventListener([CHANNEL_XML]).start()
+    use_events(listener)
+    owner = worker_id(slot)
+    print(f"🔧 XML Worker [slot {slot}] iniciado ({owner}). Esperando jobs...")
+    last_recovery = 0.0
     while True:
-        picked = pick_next_run()
+        stats.report()
+        # al arrancar y luego cada latido: runs de slots muertos vuelven a la cola
+        if time.time() - last_recovery >= RUN_HEARTBEAT_SECONDS:
+            last_recovery = time.time()
+            try:
+                recover_orphan_runs()
+            except Exception as e:
+                print(f"⚠️ [slot {slot}] No se pudo revisar runs huérfanos: {e}")
+        picked = pick_next_run(owner)
         if not picked:
-            time.sleep(POLL_SECONDS)
+            listener.wait(IDLE_POLL_SECONDS if listener.connected else POLL_SECONDS)
             continue
 
-        run_id, ruc, periodo, stats = picked
-        limit = stats.get("limit")
-        headless = stats.get("headless", True)
-
-        if not _has_pending_items(ruc, periodo):
-            with db_session() as db:
-                run = db.query(RCERun).filter(RCERun.id == run_id).first()
-                if run:
-                    run.status = "OK"
-                    run.error_message = None
-                    db.commit()
-            continue
+        run_id, ruc, periodo, run_stats = picked
+        print(f"▶️ [slot {slot}] run={run_id} empresa={ruc} periodo={periodo}")
+        t0 = time.time()
+        with RunHeartbeat(run_id, owner):
+            result = _run_one(run_id, ruc, periodo, run_stats)
+        stats.record(result, time.time() - t0)
+        stats.report(force=True)
 
-        try:
-            run_xml_job_for_empresa_periodo(ruc, periodo, limit=limit, headless=headless, run_id=run_id)
-        except Exception as e:
-            with db_session() as db:
-                run = db.query(RCERun).filter(RCERun.id == run_id).first()
-                if run:
-                    run.status = "ERROR"
-                    run.error_message = str(e)
-                    db.commit()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--slots", type=int, default=WORKER_SLOTS, help="Runs en paralelo (1 proceso/navegador por slot)")
+    args = ap.parse_args()
+    slots = max(1, args.slots)
+
+    if slots == 1:
+        run_slot(0)
+        return
+
+    # spawn: cada slot arranca limpio (sin conexiones DB ni Playwright heredados)
+    ctx = mp.get_context("spawn")
+    procs = {}
+    for slot in range(slots):
+        procs[slot] = ctx.Process(target=run_slot, args=(slot,), name=f"xml-slot-{slot}")
+        procs[slot].start()
+    print(f"🔧 XML Worker pool iniciado con {slots} slots.")
+
+    try:
+        while True:
+            time.sleep(POLL_SECONDS)
+            for slot, proc in list(procs.items()):
+                if proc.is_alive():
+                    continue
+                print(f"⚠️ Slot {slot} terminó (exitcode={proc.exitcode}). Reiniciando…")
+                procs[slot] = ctx.Process(target=run_slot, args=(slot,), name=f"xml-slot-{slot}")
+                procs[slot].start()
+    finally:
+        for proc in procs.values():
+            if proc.is_alive():
+                proc.terminate()
 
 
 if __name__ == "__main__":
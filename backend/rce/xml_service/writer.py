@@ -0,0 +1,300 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.database import db_session, RCERun
+from core.events import CHANNEL_XML_PROGRESS, notify
+from rce.xml_detail import EXTRACTOR_VERSION, save_detalles_bulk, save_resumenes_bulk
+from .config import JOURNAL_DIR, WRITE_BATCH_ITEMS, WRITE_BATCH_SECONDS
+from .repository import fetch_progress, upsert_evidencias_bulk
+
+# pg_notify admite hasta 8000 bytes por payload; margen para el resto de campos
+NOTIFY_MAX_BYTES = 7500
+
+
+def _iso(dt: Optional[datetime]) -> Optional[str]:
+    return dt.isoformat() if dt else None
+
+
+def _dt(val: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(val) if val else None
+
+
+class ResultWriter:
+    """
+    Write-behind de los resultados del job XML (evidencias + detalle).
+
+    add() deja el resultado en un journal JSONL (append + fsync) y en memoria;
+    cada WRITE_BATCH_ITEMS resultados o WRITE_BATCH_SECONDS segundos se vuelca
+    todo en una transacción con upserts en bloque y el journal se vacía. El
+    plazo por tiempo lo vigila un hilo propio: un shard que se queda esperando
+    (reintento, relogin, SOL lento) no deja resultados sin volcar.
+    Si el proceso muere antes del volcado, el siguiente job de la misma
+    empresa/periodo reaplica el journal (replay) antes de empezar.
+    Thread-safe: los shards de un job comparten la misma instancia.
+    Con run_id, cada volcado deja en RCERun.current_item_id el último item
+    procesado (puntero que lee /xml/progress). Cada volcado publica además un
+    evento "progress" con los contadores y los items del lote (`items`), en el
+    mismo NOTIFY: llega a los suscriptores al commit, sin transacción por item.
+    """
+
+    def __init__(
+        self,
+        ruc: str,
+        periodo: str,
+        batch_items: int = WRITE_BATCH_ITEMS,
+        batch_seconds: float = WRITE_BATCH_SECONDS,
+        run_id: Optional[int] = None,
+    ):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        self.ruc = ruc
+        self.periodo = periodo
+        self.journal_path = os.path.join(JOURNAL_DIR, f"xml_{ruc}_{periodo}.jsonl")
+        self.batch_items = max(1, batch_items)
+        self.batch_seconds = batch_seconds
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self._buffer: List[Dict[str, Any]] = []
+        self._last_flush = time.time()
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+
+    def record_attempt(
+        self,
+        item_id: int,
+        status: str,
+        error_message: Optional[str] = None,
+        storage_path: Optional[str] = None,
+        sha256: Optional[str] = None,
+        downloaded: bool = False,
+        wait_seconds: int = 0,
+        attempts: int = 1,
+        attempts_absolute: bool = False,
+        pdf_path: Optional[str] = None,
+        detalle: Optional[Dict[str, Any]] = None,
+        resumen: Optional[Dict[str, Any]] = None,
+        event: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Equivalente diferido de mark_attempt (+ evidencia PDF, save_detalle y resumen).
+        `event`: campos extra del item para el evento del volcado (tipo_cp, serie, numero).
+        `attempts_absolute`: `attempts` fija attempt_count en vez de sumarse.
+        """
+        now = datetime.now(timezone.utc)
+        next_retry = None
+        if wait_seconds and status in ("ERROR", "AUTH"):
+            next_retry = now + timedelta(seconds=wait_seconds)
+        self.add({
+            "item_id": item_id,
+            "status": status,
+            "error_message": error_message,
+            "storage_path": storage_path,
+            "sha256": sha256,
+            "downloaded_at": _iso(now) if downloaded else None,
+            "last_attempt_at": _iso(now),
+            "next_retry_at": _iso(next_retry),
+            "attempts": attempts,
+            "attempts_absolute": attempts_absolute,
+            "pdf_path": pdf_path,
+            "detalle": detalle,
+            "resumen": resumen,
+            "event": event,
+        })
+
+    def add(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._buffer.append(record)
+            self._start_timer_locked()
+            due = (
+                len(self._buffer) >= self.batch_items
+                or time.time() - self._last_flush >= self.batch_seconds
+            )
+            if due:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def replay(self) -> int:
+        """Reaplica un journal dejado por un proceso anterior. Devuelve cuántos resultados recuperó."""
+        with self._lock:
+            if not os.path.exists(self.journal_path):
+                return 0
+            recovered = []
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        recovered.append(json.loads(line))
+                    except ValueError:
+                        # última línea cortada por la caída: se descarta
+                        continue
+            self._buffer = recovered + self._buffer
+            self._flush_locked()
+            return len(recovered)
+
+    def _start_timer_locked(self) -> None:
+        if self._timer is None and self.batch_seconds > 0:
+            self._timer = threading.Thread(
+                target=self._timer_loop, name=f"xml-writer-{self.ruc}-{self.periodo}", daemon=True
+            )
+            self._timer.start()
+
+    def _timer_loop(self) -> None:
+        """Vuelca por tiempo aunque no lleguen más add()."""
+        while True:
+            wait = self._last_flush + self.batch_seconds - time.time()
+            if self._stop.wait(max(wait, 0.1)):
+                return
+            with self._lock:
+                if self._buffer and time.time() - self._last_flush >= self.batch_seconds:
+                    self._flush_locked()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"⚠️ No se pudieron volcar resultados ({e}); quedan en {self.journal_path}")
+
+    def _flush_locked(self) -> None:
+        self._last_flush = time.time()
+        if not self._buffer:
+            self._truncate()
+            return
+        evidencias, detalles, resumenes = self._merge(self._buffer)
+        try:
+            with db_session() as db:
+                upsert_evidencias_bulk(db, evidencias)
+                save_detalles_bulk(db, detalles, extractor_version=EXTRACTOR_VERSION)
+                save_resumenes_bulk(db, resumenes)
+                if self.run_id:
+                    db.query(RCERun).filter(RCERun.id == self.run_id).update(
+                        {RCERun.current_item_id: int(self._buffer[-1]["item_id"])},
+                        synchronize_session=False,
+                    )
+                notify(db, CHANNEL_XML_PROGRESS, self._progress_event(fetch_progress(db, self.ruc, self.periodo)))
+                db.commit()
+        except Exception as e:
+            # el buffer y el journal quedan intactos; se reintenta en el próximo volcado
+            print(f"⚠️ Volcado de {len(self._buffer)} resultados falló: {e}")
+            return
+        self._buffer = []
+        self._truncate()
+
+    def _progress_event(self, counts: Dict[str, int]) -> Dict[str, Any]:
+        """Evento "progress" del volcado; recorta `items` para no pasar el tope de pg_notify."""
+        items = [
+            {
+                "item_id": int(r["item_id"]),
+                "status": r["status"],
+                "error": (r.get("error_message") or "")[:200] or None,
+                **(r.get("event") or {}),
+            }
+            for r in self._buffer
+        ]
+        payload = {
+            "event": "progress",
+            "ruc": self.ruc,
+            "periodo": self.periodo,
+            "run_id": self.run_id,
+            "current_item_id": int(self._buffer[-1]["item_id"]),
+            **counts,
+            "items": items,
+        }
+        if len(json.dumps(payload, default=str)) > NOTIFY_MAX_BYTES:
+            for it in items:
+                it["error"] = None
+        dropped = 0
+        while items and len(json.dumps(payload, default=str)) > NOTIFY_MAX_BYTES:
+            items.pop(0)
+            dropped += 1
+        if dropped:
+            payload["items_dropped"] = dropped
+        return payload
+
+    def _truncate(self) -> None:
+        if os.path.exists(self.journal_path):
+            open(self.journal_path, "w").close()
+
+    @staticmethod
+    def _merge(
+        records: List[Dict[str, Any]],
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Colapsa los resultados por (item, tipo): ON CONFLICT DO UPDATE no admite
+        tocar la misma fila dos veces en un INSERT. Los intentos se suman y el
+        último resultado gana; un intento absoluto descarta lo sumado antes y la
+        fila queda marcada attempt_count_set (fija el valor en la BD).
+        """
+        evidencias: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        detalles: Dict[int, Dict[str, Any]] = {}
+        resumenes: Dict[int, Dict[str, Any]] = {}
+
+        def _put(key, row):
+            prev = evidencias.get(key)
+            if prev:
+                if not row["attempt_count_set"]:
+                    row["attempt_count"] += prev["attempt_count"]
+                    row["attempt_count_set"] = prev["attempt_count_set"]
+                for col in ("storage_path", "sha256", "downloaded_at"):
+                    if row[col] is None:
+                        row[col] = prev[col]
+            evidencias[key] = row
+
+        for r in records:
+            item_id = int(r["item_id"])
+            last_attempt = _dt(r.get("last_attempt_at"))
+            _put((item_id, "XML"), {
+                "propuesta_item_id": item_id,
+                "tipo": "XML",
+                "status": r["status"],
+                "error_message": r.get("error_message"),
+                "storage_path": r.get("storage_path"),
+                "sha256": r.get("sha256"),
+                "downloaded_at": _dt(r.get("downloaded_at")),
+                "attempt_count": int(r.get("attempts", 1)),
+                "attempt_count_set": bool(r.get("attempts_absolute")),
+                "last_attempt_at": last_attempt,
+                "next_retry_at": _dt(r.get("next_retry_at")),
+            })
+            if r.get("pdf_path"):
+                _put((item_id, "PDF"), {
+                    "propuesta_item_id": item_id,
+                    "tipo": "PDF",
+                    "status": "OK",
+                    "error_message": None,
+                    "storage_path": r["pdf_path"],
+                    "sha256": None,
+                    "downloaded_at": None,
+                    "attempt_count": 1,
+                    "attempt_count_set": False,
+                    "last_attempt_at": last_attempt,
+                    "next_retry_at": None,
+                })
+            if r.get("detalle") is not None:
+                detalles[item_id] = {
+                    "propuesta_item_id": item_id,
+                    "detalle_json": r["detalle"],
+                    "source_sha256": r.get("sha256"),
+                }
+            if r.get("resumen") is not None:
+                resumenes[item_id] = {
+                    "propuesta_item_id": item_id,
+                    "resumen_json": r["resumen"],
+                    "source_sha256": r.get("sha256"),
+                }
+        return list(evidencias.values()), list(detalles.values()), list(resumenes.values())
@@ -0,0 +1,73 @@
+import api, { API_BASE_URL } from './apiConfig';
+
+// Suscripción a /events/stream (SSE). EventSource no manda headers, así que cada
+// conexión se abre con un ticket de un solo uso de POST /events/ticket; por eso
+// la reconexión la maneja este helper (pide ticket nuevo) y no el navegador.
+//
+// openEventStream({ channels: 'xml', ruc, periodo }, { progress: fn, run: fn }, onState)
+// devuelve { close }. onState(true|false) avisa si el stream está conectado, para
+// que la vista use su polling solo como respaldo.
+const RECONNECT_MS = 5000;
+
+export function openEventStream(filters = {}, handlers = {}, onState = () => {}) {
+  let source = null;
+  let retryTimer = null;
+  let closed = false;
+
+  const scheduleReconnect = () => {
+    if (closed || retryTimer) return;
+    retryTimer = setTimeout(() => {
+      retryTimer = null;
+      connect();
+    }, RECONNECT_MS);
+  };
+
+  const connect = async () => {
+    if (closed || typeof EventSource === 'undefined') return;
+    let ticket;
+    try {
+      const res = await api.post('/events/ticket');
+      ticket = res.data.ticket;
+    } catch (e) {
+      onState(false);
+      scheduleReconnect();
+      return;
+    }
+    if (closed) return;
+
+    const params = new URLSearchParams({ ticket });
+    for (const [k, v] of Object.entries(filters)) {
+      if (v !== undefined && v !== null && v !== '') params.set(k, v);
+    }
+    source = new EventSource(`${API_BASE_URL}/events/stream?${params.toString()}`);
+    source.onopen = () => onState(true);
+    source.onerror = () => {
+      // el ticket ya se consumió: cerrar y reconectar con uno nuevo
+      if (source) source.close();
+      source = null;
+      onState(false);
+      scheduleReconnect();
+    };
+    for (const [name, fn] of Object.entries(handlers)) {
+      source.addEventListener(name, (ev) => {
+        try {
+          fn(JSON.parse(ev.data));
+        } catch (e) {
+          console.error(`Evento ${name} inválido`, e);
+        }
+      });
+    }
+  };
+
+  connect();
+
+  return {
+    close() {
+      closed = true;
+      if (retryTimer) clearTimeout(retryTimer);
+      if (source) source.close();
+      source = null;
+      onState(false);
+    }
+  };
+}